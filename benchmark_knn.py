@@ -1,39 +1,111 @@
 import numpy as np
-from sklearn import neighbors, cross_validation
+import multiprocessing
+from sklearn import cross_validation, metrics
 import utils
 import file_handler as fh
+import train_models
+from knn_index import KNNIndex
 
 """
-Script to benchmark the performances of KNN (sklearn library)
+Script to benchmark the performances of KNN (knn_index.py)
 Launches cross validations of the model with variation on k and
-the number of features to consider (we use the 20 most important
-features given by the xgboost training, sorted by importance order)
+the number of features to consider (we use the NB_FEATURES most important
+features given by the xgboost training, sorted by importance order: ranking of the
+features selected by train_models.py, see feature_selection.py)
+
+For each number of features and each fold, the neighbors are searched once for the
+largest k: as they are sorted by distance, the prediction for any smaller k is the
+ratio of positive labels among the first k neighbors (cumulative sum of the labels).
+The (number of features, fold) pairs are evaluated by a pool of N_JOBS processes.
 """
 
 k_list = [10,25,50,75]
 
-# 20 most important features given by XGBoost (by descending order)
-features = ['PropertyField37','SalesField5','PersonalField9','Field7','PersonalField2',
-'PersonalField1','SalesField4','PersonalField10A','SalesField1B', 'PersonalField10B',
-'PersonalField12','CoverageField9', 'CoverageField11B','PropertyField26B','PropertyField24A',
-'PersonalField4B', 'PersonalField15','Field8','PropertyField39B', 'CoverageField11A']
+# number of most important features given by XGBoost
+NB_FEATURES = 20
+
+# number of folds of the cross validation
+NFOLD = 3
+
+# number of processes evaluating the folds
+N_JOBS = multiprocessing.cpu_count()
+
+# training set and folds, shared with the processes of the pool (fork)
+shared_data = None
+
+
+def evaluate_fold(args):
+	"""
+	Evaluates the KNN classifier for every k of k_list on a fold, with the first
+	nb_features features. Used by the processes of the pool
+
+	Args:
+		args (tuple): number of features and index of the fold
+
+	Returns:
+		number of features, index of the fold and np.array of the auc for each k
+	"""
+	nb_features, fold = args
+	train, y, folds = shared_data
+	train_index, test_index = folds[fold]
+	# columns of train are sorted by importance
+	fold_features = list(train.columns[:nb_features])
+
+	index = KNNIndex(max(k_list)).fit(train.iloc[train_index], y[train_index], fold_features)
+	neighbors = index.kneighbors(train.iloc[test_index])
+	# positives among the first k neighbors, for each k
+	positives = np.cumsum(index.labels[neighbors], axis=1)
+	scores = [metrics.roc_auc_score(y[test_index], positives[:, k - 1] / float(k))
+		for k in k_list]
+	return nb_features, fold, np.array(scores)
+
+
+
+def benchmark(n_jobs=N_JOBS):
+	"""
+	Runs the cross validations for every number of features and prints the
+	scores of each k
+
+	Args:
+		n_jobs (int): number of processes
+
+	Returns:
+		dict of the scores (np.array: folds x k_list) by number of features
+	"""
+	global shared_data
+	# Transformed data (computed once and cached, shared with the other scripts)
+	train, y, _ = fh.load_derived_data('train_features', ['train'], utils.prepare_train)
+	selection = train_models.get_feature_selection(train, y,
+		fh.get_derived_key(['train'], utils.prepare_train))
+	features = selection['ranking'][:NB_FEATURES]
+	train = train.loc[:, features]
+	folds = list(cross_validation.StratifiedKFold(y, n_folds=NFOLD))
+	shared_data = (train, y, folds)
 
-train = fh.load_data('train')
+	tasks = [(nb_features, fold) for nb_features in xrange(1, len(features))
+		for fold in xrange(NFOLD)]
+	scores = dict((nb_features, np.zeros((NFOLD, len(k_list))))
+		for nb_features in xrange(1, len(features)))
+	if n_jobs > 1:
+		pool = multiprocessing.Pool(n_jobs)
+		try:
+			for nb_features, fold, fold_scores in pool.imap_unordered(evaluate_fold, tasks):
+				scores[nb_features][fold] = fold_scores
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for task in tasks:
+			nb_features, fold, fold_scores = evaluate_fold(task)
+			scores[nb_features][fold] = fold_scores
 
-# Data transformation
-y = train.QuoteConversion_Flag.values
-train = train.drop(['QuoteNumber', 'QuoteConversion_Flag'], axis=1)
-train = train.fillna(-1)
-train = utils.transform_categorical_features_train(train)
+	for nb_features in sorted(scores.keys()):
+		for i, k in enumerate(k_list):
+			print "\nNb of features: %d, K = %d" % (nb_features, k)
+			print scores[nb_features][:, i]
+	return scores
 
-# normalization
-train.apply(lambda x: (x - np.min(x)) / (np.max(x) - np.min(x)))
 
-for index_feat in xrange(1, len(features)):
-	tmp_train = train.loc[:, features[:index_feat]]
-	for k in k_list:
-		clf = neighbors.KNeighborsClassifier(k) 
-		scores = cross_validation.cross_val_score(clf, train.values, y, cv=3, scoring='roc_auc')
-		print "\nNb of features: %d, K = %d" % (index_feat, k)
-		print scores
 
+if __name__ == "__main__":
+	benchmark()
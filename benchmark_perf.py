@@ -0,0 +1,578 @@
+import time
+import os, os.path as path
+import sys
+import json
+import shutil
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+from sklearn import neighbors
+import utils
+import file_handler as fh
+import generate_data
+import train_models
+import predict
+import scoring_service
+import model_registry
+import result_writer
+import tree_ensemble
+from feature_store import FeatureStore
+from knn_index import KNNIndex
+
+"""
+Script to benchmark the speed of the data pipeline (as opposed to benchmark_xgb.py and
+benchmark_knn.py which benchmark the performances of the classifiers).
+
+benchmark_pipeline times the whole pipeline end to end on synthetic data of a given size
+(see generate_data.py): csv loading, cache generation and loading, preprocessing, feature
+pruning (see feature_selection.py), training of both models, batch scoring (as predict.py)
+and online scoring (as scoring_service.py, with ONLINE_CLIENTS concurrent clients). The
+XGBoost training and the batch scoring are also timed on all the columns (_full), to
+report the time and memory saved by the pruning, and on the feature store shared by
+both models (_store, see feature_store.py). Each measure is appended to
+results/benchmarks/perf.jsonl with the git revision, and compared with the best previous
+measure of the same benchmark and size: a throughput lower by more than
+REGRESSION_TOLERANCE is reported as a regression (for measures longer than
+MIN_COMPARED_SECONDS).
+Example: python benchmark_perf.py 10000 100000 (sizes of BENCHMARK_SIZES if not given)
+
+benchmark_result_writing times the writing of the results of predict.py (3 result files)
+on RESULT_SIZES rows: DataFrame.to_csv of each file, as before result_writer.py, then the
+single pass ResultWriter in csv, gzip and with the binary sidecar.
+
+benchmark_startup measures the startup time of the commands of homesite.py, run in a new
+process (cold) and through the daemon (warm): the interpreter alone, homesite.py --help,
+the scoring of STARTUP_ROWS quotes (homesite.py score) and predict (homesite.py predict).
+
+benchmark_trees compares the scoring of the latest xgb artifact by xgboost and by its
+exported trees (NumPy and C evaluators, see tree_ensemble.py) on the test set: latency of
+single rows (TREES_LATENCY_ROWS rows scored one by one) and throughput of a batch of
+TREES_BATCH_ROWS rows, after checking that the probabilities match.
+
+benchmark_preprocessing and benchmark_knn_index compare implementations on the
+Kaggle train set (run when data/csv/train.csv exists).
+"""
+
+# numbers of rows of the synthetic train sets
+BENCHMARK_SIZES = [10000, 100000, 1000000, 10000000]
+
+# file storing the results of the benchmarks (one json object per line)
+results_path = path.join(fh.get_root_dir(), "results", "benchmarks", "perf.jsonl")
+
+# throughput decrease (ratio) reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# measures shorter than this duration (in seconds) are too noisy to be compared
+MIN_COMPARED_SECONDS = 0.5
+
+# online scoring: number of requests and of concurrent clients
+ONLINE_REQUESTS = 1000
+ONLINE_CLIENTS = 8
+
+# numbers of rows of the results written by benchmark_result_writing
+RESULT_SIZES = [1000000, 5000000]
+
+# number of quotes scored by benchmark_startup
+STARTUP_ROWS = 100
+
+# benchmark_trees: number of rows scored one by one and number of rows of the batch
+TREES_LATENCY_ROWS = 1000
+TREES_BATCH_ROWS = 1000000
+
+
+def time_function(function, repeat=3, setup=None):
+	"""
+	Times a function and returns the best of several runs
+
+	Args:
+		function (function): function to time, called with the output of setup
+		repeat (int): number of runs
+		setup (function): function called (untimed) before each run, its output is
+			given as argument to function
+
+	Returns:
+		best run time in seconds
+	"""
+	timings = []
+	for _ in xrange(repeat):
+		args = setup() if setup is not None else None
+		start = time.time()
+		function(args) if setup is not None else function()
+		timings.append(time.time() - start)
+	return min(timings)
+
+
+
+def legacy_preprocessing(data_f):
+	"""
+	Original transformation chain of the scripts (drop, transform_dates, fillna and
+	LabelEncoder based encoding)
+
+	Args:
+		data_f (DataFrame): raw train set
+
+	Returns:
+		transformed DataFrame
+	"""
+	data_f = data_f.drop(['QuoteNumber', 'QuoteConversion_Flag'], axis=1)
+	data_f = utils.transform_dates(data_f)
+	data_f = utils.fill_missing(data_f)
+	return utils.transform_categorical_features_train(data_f)
+
+
+
+def benchmark_preprocessing(tag_name='train', repeat=3):
+	"""
+	Compares the original transformation chain with utils.Preprocessor
+
+	Args:
+		tag_name (str): base name of the data to transform
+		repeat (int): number of runs of each implementation
+	"""
+	data_f = fh.load_data(tag_name)
+	print "\nPreprocessing of %s (%d rows x %d columns)" % ((tag_name,) + data_f.shape)
+
+	legacy_time = time_function(legacy_preprocessing, repeat, lambda: data_f.copy())
+	print "Legacy chain: %.3fs" % legacy_time
+
+	pipeline_time = time_function(lambda: utils.Preprocessor().fit_transform(data_f), repeat)
+	print "Preprocessor fit_transform: %.3fs" % pipeline_time
+
+	preprocessor = utils.Preprocessor().fit(data_f)
+	transform_time = time_function(lambda: preprocessor.transform(data_f), repeat)
+	print "Preprocessor transform: %.3fs" % transform_time
+	print "Speedup (fit_transform): x%.1f" % (legacy_time / pipeline_time)
+
+	# both chains must give the same matrix (up to the categorical codes)
+	legacy = legacy_preprocessing(data_f.copy())
+	features = preprocessor.transform(data_f)
+	assert list(legacy.columns) == list(features.columns)
+	numerical = [col for col in features.columns
+		if col not in preprocessor.encoder.vocabularies]
+	assert np.allclose(legacy[numerical].values, features[numerical].values)
+
+
+
+def benchmark_knn_index(nb_queries=5000, repeat=3):
+	"""
+	Compares the knn index (knn_index.py) with a pickled KNeighborsClassifier fitted
+	on the same normalized points: load time and query throughput (with 1 to
+	cpu_count threads)
+
+	Args:
+		nb_queries (int): number of points queried
+		repeat (int): number of runs of each operation
+	"""
+	train, y, _ = fh.load_derived_data('train_features', ['train'], utils.prepare_train)
+	# features of the KNN classifier, from the selection of the training data
+	features = train_models.get_knn_parameters(train_models.get_feature_selection(train, y,
+		fh.get_derived_key(['train'], utils.prepare_train)))['features']
+	queries = train.loc[:, features].iloc[:nb_queries]
+	print "\nKNN index (%d reference points, %d queries)" % (len(train.index), len(queries.index))
+
+	try:
+		start = time.time()
+		KNNIndex(50).fit(train, y, features).save('benchmark_knn')
+		print "Index fit and save: %.3fs" % (time.time() - start)
+		load_time = time_function(lambda: KNNIndex.load('benchmark_knn').tree, repeat)
+		print "Index load (including tree): %.3fs" % load_time
+
+		index = KNNIndex.load('benchmark_knn')
+		clf = neighbors.KNeighborsClassifier(50).fit(index.points, y)
+		fh.save_model('benchmark_knn', clf)
+		load_time = time_function(lambda: fh.load_model('benchmark_knn'), repeat)
+		print "KNeighborsClassifier unpickling: %.3fs" % load_time
+
+		scaled_queries = index.scale(queries)
+		query_time = time_function(lambda: clf.predict_proba(scaled_queries), repeat)
+		print "KNeighborsClassifier queries: %.0f rows/s" % (nb_queries / query_time)
+		for n_jobs in sorted(set([1, multiprocessing.cpu_count()])):
+			query_time = time_function(lambda: index.predict_proba(queries, n_jobs), repeat)
+			print "Index queries (%d threads): %.0f rows/s" % (n_jobs, nb_queries / query_time)
+	finally:
+		# the benchmark files are not left in the models folder
+		if path.exists(fh.get_index_path('benchmark_knn')):
+			shutil.rmtree(fh.get_index_path('benchmark_knn'))
+		if path.exists(fh.get_model_path('benchmark_knn')):
+			os.remove(fh.get_model_path('benchmark_knn'))
+
+
+
+def get_revision():
+	"""
+	Returns:
+		short hash of the current git revision (None if not in a git repository)
+	"""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=fh.get_root_dir(), stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+
+def load_results():
+	"""
+	Loads the stored results of the benchmarks
+
+	Returns:
+		list of results (dict)
+	"""
+	if not path.exists(results_path):
+		return []
+	return [json.loads(line) for line in open(results_path, 'r') if line.strip()]
+
+
+
+def record_result(result, previous_results):
+	"""
+	Stores the result of a benchmark and compares its throughput with the best
+	previous result of the same benchmark and size
+
+	Args:
+		result (dict): result (benchmark, nb_rows, seconds, rows_per_s,...)
+		previous_results (list): stored results
+
+	Returns:
+		the result, with the regression flag and the best previous throughput
+	"""
+	previous = [previous_result['rows_per_s'] for previous_result in previous_results
+		if previous_result['benchmark'] == result['benchmark']
+		and previous_result['nb_rows'] == result['nb_rows']]
+	result['best_rows_per_s'] = max(previous) if previous else None
+	result['regression'] = bool(previous) and result['seconds'] >= MIN_COMPARED_SECONDS \
+		and result['rows_per_s'] < (1 - REGRESSION_TOLERANCE) * max(previous)
+
+	print "%-24s %9.3fs %12.0f rows/s%s" % (result['benchmark'], result['seconds'],
+		result['rows_per_s'], " REGRESSION (best: %.0f rows/s)" % max(previous)
+		if result['regression'] else "")
+	if not path.exists(path.dirname(results_path)):
+		os.makedirs(path.dirname(results_path))
+	with open(results_path, 'a') as results_file:
+		results_file.write(json.dumps(result) + '\n')
+	return result
+
+
+
+def benchmark_online_scoring(test):
+	"""
+	Scores rows one by one through a ScoringService, with ONLINE_CLIENTS concurrent
+	clients (the models are the scorers of predict.py)
+
+	Args:
+		test (DataFrame): raw rows to score
+
+	Returns:
+		dict of the counters of the service (see ScoringService.get_stats)
+	"""
+	records = test.iloc[:ONLINE_REQUESTS].to_dict('records')
+	service = scoring_service.ScoringService().start()
+	pool = ThreadPool(ONLINE_CLIENTS)
+	try:
+		service.reset_stats()
+		pool.map(service.score_one, records)
+		return service.get_stats()
+	finally:
+		pool.close()
+		service.stop()
+
+
+
+def benchmark_pipeline(nb_rows, repeat=1):
+	"""
+	Times each step of the pipeline on synthetic data of nb_rows rows (train and
+	test sets) and stores the results (see module documentation)
+
+	Args:
+		nb_rows (int): number of rows of the train and test sets
+		repeat (int): number of runs of the loading and scoring steps (best run is kept)
+
+	Returns:
+		list of the results (dict)
+	"""
+	train_tag, test_tag = generate_data.generate_dataset(nb_rows)
+	print "\nPipeline on synthetic data (%d rows)" % nb_rows
+	previous_results = load_results()
+	results = []
+	base = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': get_revision(),
+		'nb_rows': nb_rows, 'cpu_count': multiprocessing.cpu_count()}
+
+	def measure(benchmark, seconds, rows=nb_rows, **extra):
+		result = dict(base, benchmark=benchmark, seconds=seconds,
+			rows_per_s=rows / seconds if seconds > 0 else 0., **extra)
+		results.append(record_result(result, previous_results))
+
+	measure('load_csv', time_function(lambda: fh.load_data(train_tag, use_cache=False,
+		generate_cache=False), repeat))
+	measure('generate_cache', time_function(lambda _: fh.load_data(train_tag), repeat,
+		lambda: fh.remove_cache_file(fh.get_cache_path(train_tag))))
+	measure('load_cache', time_function(lambda: fh.load_data(train_tag), max(repeat, 3)))
+
+	train = fh.load_data(train_tag)
+	start = time.time()
+	X_train, y, preprocessor = utils.prepare_train(train)
+	measure('preprocessing', time.time() - start)
+	del train
+
+	start = time.time()
+	selection = train_models.get_feature_selection(X_train, y)
+	measure('select_features', time.time() - start, columns=len(selection['features']))
+	get_memory = lambda data_f: data_f.memory_usage(index=False).sum() / float(1 << 20)
+	matrix_mb = {'full': get_memory(X_train)}
+
+	start = time.time()
+	clf_xgb_full = train_models.fit_xgb(X_train, y)
+	measure('train_xgb_full', time.time() - start, columns=len(X_train.columns),
+		matrix_mb=matrix_mb['full'])
+	X_train = X_train.loc[:, selection['features']]
+	matrix_mb['pruned'] = get_memory(X_train)
+	start = time.time()
+	clf_xgb = train_models.fit_xgb(X_train, y)
+	measure('train_xgb', time.time() - start, columns=len(X_train.columns),
+		matrix_mb=matrix_mb['pruned'])
+	start = time.time()
+	store = FeatureStore.from_columns(X_train, target=y)
+	measure('feature_store', time.time() - start)
+	matrix_mb['store'] = store.matrix.nbytes / float(1 << 20)
+	del X_train
+	start = time.time()
+	train_models.fit_xgb(store, y)
+	measure('train_xgb_store', time.time() - start, columns=len(store.columns),
+		matrix_mb=matrix_mb['store'])
+	start = time.time()
+	clf_knn = train_models.fit_knn(store, y, selection=selection)
+	measure('train_knn', time.time() - start)
+	del store
+
+	# the scorers of predict.py are replaced by the models trained above (boosters
+	# scoring the feature stores of the chunks, as the artifacts), without cache
+	saved_scorers, saved_versions, saved_cache = \
+		predict.scorers, predict.scorer_versions, predict.cache
+	predict.scorer_versions, predict.cache = None, None
+	scorers = {'score_batch_full': (preprocessor, model_registry.BoosterModel(
+		clf_xgb_full.get_booster(), preprocessor.get_feature_names()), clf_knn),
+		'score_batch': (train_models.select_preprocessor(preprocessor, selection['features']),
+		model_registry.BoosterModel(clf_xgb.get_booster(), selection['features']), clf_knn)}
+	try:
+		fh.load_data(test_tag)
+		for benchmark in sorted(scorers.keys(), reverse=True):
+			predict.scorers = scorers[benchmark]
+			measure(benchmark, time_function(lambda: sum(len(predict.score_chunk(chunk))
+				for chunk in fh.iter_data(test_tag, predict.CHUNK_SIZE,
+				predict.get_input_columns())), repeat))
+		stats = benchmark_online_scoring(next(fh.iter_data(test_tag, ONLINE_REQUESTS)))
+		measure('score_online', stats['records'] / stats['throughput'], stats['records'],
+			p50_ms=stats['p50_ms'], p99_ms=stats['p99_ms'],
+			mean_batch_size=stats['mean_batch_size'])
+	finally:
+		predict.scorers, predict.scorer_versions, predict.cache = \
+			saved_scorers, saved_versions, saved_cache
+
+	seconds = dict((result['benchmark'], result['seconds']) for result in results)
+	saved = lambda full, pruned: 100. * (1 - pruned / full) if full > 0 else 0.
+	print "Pruning savings (%d rows, %d of %d columns): train_xgb %.0f%%, score_batch " \
+		"%.0f%%, feature matrix %.1f MB -> %.1f MB" % (nb_rows, len(selection['features']),
+		selection['nb_columns'], saved(seconds['train_xgb_full'], seconds['train_xgb']),
+		saved(seconds['score_batch_full'], seconds['score_batch']), matrix_mb['full'],
+		matrix_mb['pruned'])
+	print "Feature store: %.1f MB shared by both models (pruned DataFrame: %.1f MB), " \
+		"train_xgb_store %.0f%% faster than train_xgb" % (matrix_mb['store'],
+		matrix_mb['pruned'], saved(seconds['train_xgb'], seconds['train_xgb_store']))
+
+	regressions = [result['benchmark'] for result in results if result['regression']]
+	if regressions:
+		print "Regressions (%d rows): %s" % (nb_rows, ', '.join(regressions))
+	return results
+
+
+
+def benchmark_result_writing(nb_rows, repeat=1):
+	"""
+	Times the writing of the results of nb_rows scored rows (see module documentation)
+	and stores the results
+
+	Args:
+		nb_rows (int): number of rows of the results
+		repeat (int): number of runs of each writer (best run is kept)
+
+	Returns:
+		list of the results (dict)
+	"""
+	print "\nResult writing (%d rows, %d result files)" % (nb_rows, len(predict.result_files))
+	random_state = np.random.RandomState(0)
+	ids = np.arange(1, nb_rows + 1)
+	predictions = dict((name, random_state.rand(nb_rows).astype(np.float32))
+		for name in predict.result_files)
+	results_dir = path.join(fh.get_root_dir(), "results", "benchmarks", "writer")
+	if not path.exists(results_dir):
+		os.makedirs(results_dir)
+	files = dict((name, path.join(results_dir, name + ".csv")) for name in predictions)
+	previous_results = load_results()
+	base = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': get_revision(),
+		'nb_rows': nb_rows, 'cpu_count': multiprocessing.cpu_count()}
+
+	def write_to_csv():
+		for name, values in predictions.items():
+			pd.DataFrame({'QuoteNumber': ids, 'QuoteConversion_Flag': values},
+				columns=['QuoteNumber', 'QuoteConversion_Flag']).to_csv(files[name],
+				index=False)
+
+	def write_results(compress=False, sidecar_dir=None):
+		with result_writer.ResultWriter(files, compress, sidecar_dir) as writer:
+			for start in xrange(0, nb_rows, predict.CHUNK_SIZE):
+				rows = slice(start, start + predict.CHUNK_SIZE)
+				writer.write(ids[rows], dict((name, values[rows])
+					for name, values in predictions.items()))
+
+	results = []
+	for benchmark, function in [('write_to_csv', write_to_csv),
+			('write_results', write_results),
+			('write_results_gzip', lambda: write_results(compress=True)),
+			('write_results_sidecar', lambda: write_results(sidecar_dir=path.join(results_dir,
+			'sidecar')))]:
+		seconds = time_function(function, repeat)
+		results.append(record_result(dict(base, benchmark=benchmark, seconds=seconds,
+			rows_per_s=nb_rows / seconds if seconds > 0 else 0.), previous_results))
+	sizes = dict((compress, sum(path.getsize(file_path + ('.gz' if compress else ''))
+		for file_path in files.values()) / float(1 << 20)) for compress in [False, True])
+	print "Result files: %.1f MB (gzip: %.1f MB), ResultWriter x%.1f faster than to_csv" % (
+		sizes[False], sizes[True], results[0]['seconds'] / results[1]['seconds'])
+	shutil.rmtree(results_dir)
+	return results
+
+
+
+def benchmark_startup(repeat=3):
+	"""
+	Measures the cold and warm startup of the commands of homesite.py (see module
+	documentation) and stores the results. The daemon is started if it is not
+	running (and stopped at the end)
+
+	Args:
+		repeat (int): number of runs of each command (best run is kept)
+
+	Returns:
+		list of the results (dict)
+	"""
+	cli = [sys.executable, path.join(fh.get_root_dir(), 'homesite.py')]
+	# the result files of predict are written aside (the submission files are kept)
+	output_dir = path.join(fh.get_root_dir(), "results", "benchmarks", "startup")
+	if not path.exists(output_dir):
+		os.makedirs(output_dir)
+	quotes_path = path.join(output_dir, "quotes.csv")
+	result_writer.write_csv(quotes_path, next(fh.iter_data('test', STARTUP_ROWS)), index=False)
+	nb_test_rows = len(fh.load_data('test', columns=['QuoteNumber']).index)
+	# name, arguments of the cold and warm runs (no warm run if None), number of scored rows
+	commands = [('python', [sys.executable, '-c', 'pass'], None, 1),
+		('cli_help', cli + ['--help'], None, 1),
+		('score', cli + ['--local', 'score', quotes_path], cli + ['score', quotes_path],
+			STARTUP_ROWS),
+		('predict', cli + ['--local', 'predict', '--output-dir', output_dir],
+			cli + ['predict', '--output-dir', output_dir], nb_test_rows)]
+	print "\nStartup of homesite.py (cold: new process, warm: through the daemon)"
+
+	devnull = open(os.devnull, 'w')
+	run = lambda arguments: subprocess.check_call(arguments, stdout=devnull, stderr=devnull)
+	previous_results = load_results()
+	base = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': get_revision(),
+		'nb_rows': STARTUP_ROWS, 'cpu_count': multiprocessing.cpu_count()}
+	results = []
+	started = subprocess.call(cli + ['daemon', 'status'], stdout=devnull) != 0
+	if started:
+		run(cli + ['daemon', 'start'])
+	try:
+		for name, cold, warm, rows in commands:
+			for mode, arguments in [('cold', cold), ('warm', warm)]:
+				if arguments is None:
+					continue
+				seconds = time_function(lambda: run(arguments), repeat)
+				results.append(record_result(dict(base, benchmark='startup_%s_%s' % (name,
+					mode), seconds=seconds, rows_per_s=rows / seconds), previous_results))
+	finally:
+		if started:
+			run(cli + ['daemon', 'stop'])
+		shutil.rmtree(output_dir)
+
+	seconds = dict((result['benchmark'], result['seconds']) for result in results)
+	for name, _, warm, _ in commands:
+		if warm is not None:
+			print "%s: cold %.3fs, warm %.3fs (x%.1f)" % (name, seconds['startup_%s_cold' % name],
+				seconds['startup_%s_warm' % name], seconds['startup_%s_cold' % name]
+				/ seconds['startup_%s_warm' % name])
+	return results
+
+
+
+def benchmark_trees(repeat=3):
+	"""
+	Compares the scoring of the latest xgb artifact by xgboost and by its exported trees
+	(see module documentation) and stores the results
+
+	Args:
+		repeat (int): number of runs of each measure (best run is kept)
+
+	Returns:
+		list of the results (dict)
+	"""
+	artifact = model_registry.load_artifact('xgb')
+	booster, features = artifact.model.booster, artifact.manifest['features']
+	ensemble = artifact.model.ensemble or tree_ensemble.TreeEnsemble.from_booster(booster,
+		features)
+	test = artifact.preprocessor.transform_store(fh.load_data('test',
+		columns=artifact.preprocessor.get_input_columns())).get_matrix(features)
+	print "\nExported trees (xgb version %d: %d trees, %d nodes, depth %d)" % (
+		artifact.version, ensemble.n_trees, len(ensemble.value), ensemble.max_depth)
+	print "Max difference with xgboost (%d test rows): %g" % (len(test),
+		ensemble.verify(booster, test))
+
+	scorers = [('xgboost', model_registry.BoosterModel(booster, features).predict_proba),
+		('numpy', lambda X: ensemble.predict(X, 'numpy')),
+		('c', lambda X: ensemble.predict(X, 'c'))]
+	rows = [test[i:i + 1] for i in xrange(min(TREES_LATENCY_ROWS, len(test)))]
+	batch = np.tile(test, (TREES_BATCH_ROWS // len(test) + 1, 1))[:TREES_BATCH_ROWS]
+	previous_results = load_results()
+	base = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': get_revision(),
+		'cpu_count': multiprocessing.cpu_count()}
+	results = []
+	for name, score in scorers:
+		seconds = time_function(lambda: [score(row) for row in rows], repeat)
+		results.append(record_result(dict(base, benchmark='trees_latency_' + name,
+			nb_rows=len(rows), seconds=seconds, rows_per_s=len(rows) / seconds,
+			latency_us=1e6 * seconds / len(rows)), previous_results))
+	for name, score in scorers:
+		seconds = time_function(lambda: score(batch), repeat)
+		results.append(record_result(dict(base, benchmark='trees_batch_' + name,
+			nb_rows=len(batch), seconds=seconds, rows_per_s=len(batch) / seconds),
+			previous_results))
+
+	print "Single row latency: " + ", ".join("%s %.0fus" % (name, result['latency_us'])
+		for (name, _), result in zip(scorers, results))
+	return results
+
+
+
+def run_benchmarks(sizes=None):
+	"""
+	Runs the benchmarks of the pipeline (given sizes, BENCHMARK_SIZES if None), of the
+	result writing, of the exported trees of the latest xgb model (if one was trained)
+	and the comparisons on the Kaggle train set if it exists
+
+	Args:
+		sizes (list): numbers of rows of the synthetic data
+	"""
+	for nb_rows in sizes or BENCHMARK_SIZES:
+		benchmark_pipeline(nb_rows)
+	for nb_rows in RESULT_SIZES:
+		benchmark_result_writing(nb_rows)
+	if model_registry.list_versions('xgb'):
+		benchmark_trees()
+	if path.exists(fh.get_csv_path('train')):
+		benchmark_preprocessing()
+		benchmark_knn_index()
+
+
+
+if __name__ == "__main__":
+	run_benchmarks([int(arg) for arg in sys.argv[1:]])
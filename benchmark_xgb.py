@@ -1,28 +1,37 @@
-import pandas as pd
 import numpy as np
 import xgboost as xgb
+import os.path as path
+import multiprocessing
+import itertools
+import hashlib
+import json
+import time
+import random
 import utils
 import file_handler as fh
 
 """
 Script to benchmark the performances of XGBoost
-Launches cross validations of the model, we can choose some
-parameters to make vary in order to compare performances and
-tune the parameters values
-"""
+Launches cross validations of the model over the space of the parameters to tune
+(xgb_tune_parameters) in order to compare performances and tune the parameters values.
 
-train = fh.load_data('train')
+Search modes (SEARCH_MODE):
+- grid: every combination of the values of xgb_tune_parameters
+- random: N_RANDOM_TRIALS combinations drawn from the grid
+- halving: successive halving, all the combinations are evaluated on a subsample of the
+  training set, the best 1/HALVING_RATE are evaluated again on a subsample HALVING_RATE
+  times larger, and so on until the full training set
 
-# Data transformation
-y = train.QuoteConversion_Flag.values
-train = train.drop(['QuoteNumber', 'QuoteConversion_Flag'], axis=1)
-train = utils.transform_dates(train)
-train = train.fillna(-1)
-train = utils.transform_categorical_features_train(train)
-data_dm = xgb.DMatrix(train.values, y)  
+Trials are run by a pool of N_JOBS processes, which share the training matrix through a
+read-only memory-mapped file. Each finished trial is appended to results/xgb_search.jsonl:
+an interrupted search is resumed without running the finished trials again. Trials are
+keyed by the training matrix (fingerprint of the data and of the preprocessing, and list
+of the features), so that the trials of a previous matrix are not reused. The best
+parameters are saved with file_handler.save_parameters (used by train_models.py).
+"""
 
 # base values for parameters
-xgb_base_parameters = {  
+xgb_base_parameters = {
 	'nthread':-1,
 	'n_estimators':25,
     'max_depth':15,
@@ -41,12 +50,222 @@ xgb_tune_parameters = {
     'learning_rate': [0.01, 0.025, 0.05],
 }
 
-# choose name of the parameter which should vary
-chosen_param = 'subsample'  
+# search mode: 'grid', 'random' or 'halving'
+SEARCH_MODE = 'halving'
+
+# number of combinations evaluated by the random search
+N_RANDOM_TRIALS = 30
+
+# ratio of the combinations kept (and of the subsample growth) at each halving step
+HALVING_RATE = 3
+
+# number of processes running the trials
+N_JOBS = multiprocessing.cpu_count()
+
+# cross validation settings
+NUM_BOOST_ROUND = 10
+NFOLD = 2
+SEED = 1200
+
+# file storing the results of the trials (one json object per line)
+results_path = path.join(fh.get_root_dir(), "results", "xgb_search.jsonl")
+
+# paths of the memory-mapped training matrix shared by the processes
+matrix_path = path.join(fh.get_root_dir(), "data", "cache", "xgb_search_X.npy")
+target_path = path.join(fh.get_root_dir(), "data", "cache", "xgb_search_y.npy")
+
+# training matrix of the current process (see init_worker)
+shared_data = None
+
+
+def init_worker():
+	"""
+	Memory-maps the training matrix in the current process
+	"""
+	global shared_data
+	shared_data = (np.load(matrix_path, mmap_mode='r'), np.load(target_path, mmap_mode='r'))
+
+
+
+def get_data_key(features):
+	"""
+	Returns the key identifying the training matrix of the search
+
+	Args:
+		features (list): names of the columns of the training matrix
+
+	Returns:
+		String containing the key: fingerprint of the training data and of the
+		preprocessing (key of the derived train features), and of the features
+	"""
+	content = json.dumps([fh.get_derived_key(['train'], utils.prepare_train), list(features)])
+	return hashlib.sha1(content).hexdigest()
+
+
+
+def get_trial_key(parameters, nb_rows, data_key):
+	"""
+	Returns the key identifying a trial in the results file
+
+	Args:
+		parameters (dict): parameters of the classifier
+		nb_rows (int): number of rows of the training subsample
+		data_key (str): key of the training matrix (see get_data_key)
+
+	Returns:
+		String containing the key
+	"""
+	content = json.dumps([parameters, nb_rows, data_key, NUM_BOOST_ROUND, NFOLD, SEED],
+		sort_keys=True)
+	return hashlib.sha1(content).hexdigest()
+
+
+
+def run_trial(args):
+	"""
+	Cross validates the classifier with the given parameters on a subsample of
+	the training matrix. Used by the processes of the pool
+
+	Args:
+		args (tuple): parameters (dict), number of rows of the subsample, number of
+			threads given to xgboost and key of the training matrix
+
+	Returns:
+		dict describing the trial and its results
+	"""
+	parameters, nb_rows, nthread, data_key = args
+	X, y = shared_data
+	start = time.time()
+	if nb_rows < len(y):
+		rows = np.sort(np.random.RandomState(SEED).choice(len(y), nb_rows, replace=False))
+		data_dm = xgb.DMatrix(X[rows], np.asarray(y[rows]))
+	else:
+		data_dm = xgb.DMatrix(np.asarray(X), np.asarray(y))
+
+	cv_parameters = dict(parameters, nthread=nthread)
+	cv = xgb.cv(cv_parameters, data_dm, NUM_BOOST_ROUND, nfold=NFOLD,
+		metrics={'error', 'auc'}, seed=SEED)
+	return {'key': get_trial_key(parameters, nb_rows, data_key), 'parameters': parameters,
+		'nb_rows': nb_rows, 'auc': float(cv['test-auc-mean'].iloc[-1]),
+		'auc_std': float(cv['test-auc-std'].iloc[-1]),
+		'error': float(cv['test-error-mean'].iloc[-1]), 'time': time.time() - start}
+
+
+
+def load_results():
+	"""
+	Loads the results of the finished trials
+
+	Returns:
+		dict of the trials results, by key
+	"""
+	results = {}
+	if path.exists(results_path):
+		for line in open(results_path, 'r'):
+			if line.strip():
+				result = json.loads(line)
+				results[result['key']] = result
+	return results
+
+
+
+def run_trials(candidates, nb_rows, results, pool, nthread, data_key):
+	"""
+	Runs the trials of the candidates on a subsample of nb_rows rows, skipping the
+	trials already in results. Finished trials are appended to the results file
+
+	Args:
+		candidates (list): list of parameters (dict)
+		nb_rows (int): number of rows of the training subsample
+		results (dict): results of the finished trials (updated)
+		pool (multiprocessing.Pool): pool running the trials
+		nthread (int): number of threads given to xgboost by each trial
+		data_key (str): key of the training matrix (see get_data_key)
+
+	Returns:
+		list of the results of the candidates, by descending auc
+	"""
+	tasks = [(parameters, nb_rows, nthread, data_key) for parameters in candidates
+		if get_trial_key(parameters, nb_rows, data_key) not in results]
+	print "\n%d rows: %d trials (%d already done)" % (nb_rows, len(candidates),
+		len(candidates) - len(tasks))
+
+	with open(results_path, 'a') as results_file:
+		for result in pool.imap_unordered(run_trial, tasks):
+			results[result['key']] = result
+			results_file.write(json.dumps(result) + '\n')
+			results_file.flush()
+			print "auc %.5f (+/- %.5f) in %.1fs: %s" % (result['auc'], result['auc_std'],
+				result['time'], result['parameters'])
+
+	trials = [results[get_trial_key(parameters, nb_rows, data_key)]
+		for parameters in candidates]
+	return sorted(trials, key=lambda result: -result['auc'])
+
+
+
+def get_candidates(mode):
+	"""
+	Returns the combinations of parameters to evaluate
+
+	Args:
+		mode (str): search mode ('grid', 'random' or 'halving')
+
+	Returns:
+		list of parameters (dict)
+	"""
+	names = sorted(xgb_tune_parameters.keys())
+	grid = [dict(xgb_base_parameters, **dict(zip(names, values)))
+		for values in itertools.product(*[xgb_tune_parameters[name] for name in names])]
+	if mode == 'random':
+		return random.Random(SEED).sample(grid, min(N_RANDOM_TRIALS, len(grid)))
+	return grid
+
+
+
+def search(mode=SEARCH_MODE, n_jobs=N_JOBS):
+	"""
+	Searches the best parameters (see module documentation) and saves them
+
+	Args:
+		mode (str): search mode ('grid', 'random' or 'halving')
+		n_jobs (int): number of processes
+
+	Returns:
+		result of the best trial
+	"""
+	train, y, _ = fh.load_derived_data('train_features', ['train'], utils.prepare_train)
+	np.save(matrix_path, np.ascontiguousarray(train.values, dtype=np.float32))
+	np.save(target_path, y)
+	nb_rows = len(y)
+	data_key = get_data_key(train.columns)
+	del train
+
+	candidates = get_candidates(mode)
+	results = load_results()
+	nthread = max(1, multiprocessing.cpu_count() // n_jobs)
+	pool = multiprocessing.Pool(n_jobs, initializer=init_worker)
+	try:
+		if mode == 'halving':
+			nb_steps = int(np.ceil(np.log(len(candidates)) / np.log(HALVING_RATE))) + 1
+			for step in xrange(nb_steps):
+				step_rows = max(nb_rows // HALVING_RATE ** (nb_steps - 1 - step), 1000)
+				trials = run_trials(candidates, min(step_rows, nb_rows), results, pool, nthread,
+					data_key)
+				nb_kept = max(1, len(candidates) // HALVING_RATE)
+				candidates = [trial['parameters'] for trial in trials[:nb_kept]]
+		else:
+			trials = run_trials(candidates, nb_rows, results, pool, nthread, data_key)
+	finally:
+		pool.close()
+		pool.join()
+
+	best = trials[0]
+	print "\nBest auc %.5f: %s" % (best['auc'], best['parameters'])
+	fh.save_parameters('xgb', best['parameters'])
+	return best
+
+
 
-print "Start cross validation, with variation on: ", chosen_param
-for val in xgb_tune_parameters[chosen_param]:
-	print "\nValue:", val
-	xgb_base_parameters[chosen_param] = val
-	print xgb.cv(xgb_base_parameters, data_dm, 10, 
-		nfold=2, metrics={'error', 'auc'}, seed = 1200)   
+if __name__ == "__main__":
+	search()
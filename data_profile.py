@@ -0,0 +1,379 @@
+import pandas as pd
+import numpy as np
+import multiprocessing
+import file_handler as fh
+
+"""
+Library providing a single-pass, chunked profiler of the datasets (used by summary.py).
+
+profile_data reads the data once, in chunks of CHUNK_SIZE rows, and computes for each
+column: the number of rows, the missing values rate, the number of distinct values,
+the mode and its share, and for each value its count and its ratio of positive targets
+(QuoteConversion_Flag), as needed by the purity plots.
+
+The values of a column are counted exactly (ColumnProfile.counts) while the column has
+at most EXACT_LIMIT distinct values. Above this limit, the column switches to mergeable
+sketches, so that memory does not depend on the size of the data:
+- heavy hitters: Misra-Gries summary of the HEAVY_HITTERS most frequent values (counts
+  are underestimated by at most ColumnProfile.error)
+- distinct count: HyperLogLog with 2^HLL_PRECISION registers (about 1.6% of error)
+Profiles of different chunks are merged (DatasetProfile.merge), so that the chunks can be
+profiled by a pool of N_JOBS processes. With the columnar cache, each process reads its
+own rows from the memory-mapped files.
+"""
+
+# number of rows profiled at once
+CHUNK_SIZE = 100000
+
+# number of processes profiling the chunks
+N_JOBS = multiprocessing.cpu_count()
+
+# maximum number of distinct values counted exactly
+EXACT_LIMIT = 1000
+
+# number of values kept by the heavy hitters summary
+HEAVY_HITTERS = 200
+
+# number of bits of the hash indexing the HyperLogLog registers
+HLL_PRECISION = 12
+
+# name of the target column
+TARGET = 'QuoteConversion_Flag'
+
+
+def hash_values(values):
+	"""
+	Returns 64 bits hashes of values. Values are hashed as objects, so that a value has
+	the same hash in the chunks where the column is parsed as int and as float
+
+	Args:
+		values (np.array): values to hash
+
+	Returns:
+		np.array of uint64
+	"""
+	return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+
+class HyperLogLog(object):
+	"""
+	Mergeable sketch estimating the number of distinct values
+	"""
+
+	def __init__(self, precision=HLL_PRECISION):
+		self.precision = precision
+		self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+	def add(self, values):
+		"""
+		Adds values to the sketch
+
+		Args:
+			values (np.array): values (duplicates are allowed)
+		"""
+		if len(values) == 0:
+			return
+		hashes = hash_values(values)
+		nb_bits = 64 - self.precision
+		index = (hashes >> np.uint64(nb_bits)).astype(np.intp)
+		# the remaining bits fit in the mantissa of a float64: frexp gives their length
+		remaining = (hashes & np.uint64((1 << nb_bits) - 1)).astype(np.float64)
+		rank = (nb_bits + 1 - np.frexp(remaining)[1]).astype(np.uint8)
+		np.maximum.at(self.registers, index, rank)
+
+	def merge(self, other):
+		"""
+		Merges another sketch (of the same precision) into this one
+
+		Args:
+			other (HyperLogLog): sketch to merge
+		"""
+		np.maximum(self.registers, other.registers, out=self.registers)
+
+	def count(self):
+		"""
+		Returns:
+			estimated number of distinct values
+		"""
+		nb_registers = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / nb_registers)
+		estimate = alpha * nb_registers ** 2 / np.sum(2. ** -self.registers.astype(np.float64))
+		nb_zeros = np.count_nonzero(self.registers == 0)
+		if estimate <= 2.5 * nb_registers and nb_zeros > 0:
+			# linear counting for small cardinalities
+			estimate = nb_registers * np.log(1. * nb_registers / nb_zeros)
+		return int(round(estimate))
+
+
+
+class ColumnProfile(object):
+	"""
+	Counters of a column: exact counts by value, or heavy hitters and HyperLogLog
+	sketches above EXACT_LIMIT distinct values (see module documentation)
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.nb_rows = 0
+		self.nb_missing = 0
+		self.nb_positives = 0
+		# value -> [count, number of positive targets]
+		self.counts = {}
+		self.exact = True
+		self.error = 0
+		self.hll = None
+
+	def update(self, values, target=None):
+		"""
+		Counts the values of a chunk of the column
+
+		Args:
+			values (pd.Series or np.array): values of the column
+			target (np.array): target values of the rows (None if unknown)
+		"""
+		codes, uniques = pd.factorize(values)
+		valid = codes >= 0
+		self.nb_rows += len(codes)
+		self.nb_missing += len(codes) - np.count_nonzero(valid)
+		counts = np.bincount(codes[valid], minlength=len(uniques))
+		if target is not None:
+			positives = np.bincount(codes[valid], weights=target[valid], minlength=len(uniques))
+			self.nb_positives += int(positives.sum())
+		else:
+			positives = np.zeros(len(uniques))
+		uniques = np.asarray(uniques)
+		self.add_counts(dict((value, [int(count), int(nb_positives)]) for value, count,
+			nb_positives in zip(uniques.tolist(), counts, positives)), uniques)
+
+	def add_counts(self, counts, values):
+		"""
+		Adds counts by value to the counters
+
+		Args:
+			counts (dict): value -> [count, number of positive targets]
+			values (np.array): distinct values of counts (hashed by the HyperLogLog)
+		"""
+		for value, (count, nb_positives) in counts.iteritems():
+			current = self.counts.get(value)
+			if current is None:
+				self.counts[value] = [count, nb_positives]
+			else:
+				current[0] += count
+				current[1] += nb_positives
+
+		if self.exact and len(self.counts) > EXACT_LIMIT:
+			# switch to the sketches: the HyperLogLog is fed with the values seen so far
+			self.exact = False
+			self.hll = HyperLogLog()
+			self.hll.add(np.array(self.counts.keys(), dtype=object))
+		elif not self.exact:
+			self.hll.add(values)
+		if not self.exact:
+			self.prune()
+
+	def prune(self):
+		"""
+		Keeps the HEAVY_HITTERS most frequent values (Misra-Gries): the count of the
+		next value is subtracted from the kept counts
+		"""
+		if len(self.counts) <= HEAVY_HITTERS:
+			return
+		ranked = sorted(self.counts.iteritems(), key=lambda item: -item[1][0])
+		threshold = ranked[HEAVY_HITTERS][1][0]
+		self.error += threshold
+		self.counts = {}
+		for value, (count, nb_positives) in ranked[:HEAVY_HITTERS]:
+			if count > threshold:
+				# positives are scaled to keep the positive ratio of the value
+				self.counts[value] = [count - threshold,
+					int(round(nb_positives * (count - threshold) / float(count)))]
+
+	def merge(self, other):
+		"""
+		Merges the counters of another chunk of the same column into this one
+
+		Args:
+			other (ColumnProfile): counters to merge
+		"""
+		self.nb_rows += other.nb_rows
+		self.nb_missing += other.nb_missing
+		self.nb_positives += other.nb_positives
+		self.error += other.error
+		if not other.exact:
+			if self.exact:
+				self.exact = False
+				self.hll = HyperLogLog()
+				self.hll.add(np.array(self.counts.keys(), dtype=object))
+			self.hll.merge(other.hll)
+		self.add_counts(other.counts, np.array(other.counts.keys(), dtype=object)
+			if other.exact else np.array([], dtype=object))
+
+	def get_cardinality(self):
+		"""
+		Returns:
+			number of distinct non missing values (estimated with the sketches)
+		"""
+		return len(self.counts) if self.exact else max(self.hll.count(), len(self.counts))
+
+	def get_mode(self):
+		"""
+		Returns:
+			most frequent value (None if the column has only missing values) and
+			its share of the rows
+		"""
+		if not self.counts:
+			return None, 0.
+		value, (count, _) = max(self.counts.iteritems(), key=lambda item: item[1][0])
+		return value, 1. * count / max(self.nb_rows, 1)
+
+	def get_positive_ratios(self):
+		"""
+		Returns:
+			dict: value -> (count, ratio of positive targets), for all the values
+			(exact counters) or the heavy hitters
+		"""
+		return dict((value, (count, 1. * nb_positives / count))
+			for value, (count, nb_positives) in self.counts.iteritems() if count > 0)
+
+	def summary(self):
+		"""
+		Returns:
+			dict with the rows count, missing rate, cardinality, mode and mode share
+		"""
+		mode, mode_share = self.get_mode()
+		return {'rows': self.nb_rows,
+			'missing_rate': 1. * self.nb_missing / max(self.nb_rows, 1),
+			'cardinality': self.get_cardinality(), 'exact': self.exact,
+			'mode': mode, 'mode_share': mode_share}
+
+
+
+class DatasetProfile(object):
+	"""
+	Profiles of all the columns of a dataset
+	"""
+
+	def __init__(self, target=TARGET):
+		self.target = target
+		self.columns = {}
+		self.column_names = []
+
+	def update(self, data_f):
+		"""
+		Profiles a chunk of the dataset
+
+		Args:
+			data_f (DataFrame): chunk of rows
+
+		Returns:
+			the updated DatasetProfile
+		"""
+		target = None
+		if self.target in data_f.columns:
+			target = np.asarray(data_f[self.target].values, dtype=np.float64)
+			target[np.isnan(target)] = 0
+		for col in data_f.columns:
+			if col not in self.columns:
+				self.columns[col] = ColumnProfile(col)
+				self.column_names.append(col)
+			self.columns[col].update(data_f[col], target)
+		return self
+
+	def merge(self, other):
+		"""
+		Merges the profile of another chunk into this one
+
+		Args:
+			other (DatasetProfile): profile to merge
+
+		Returns:
+			the merged DatasetProfile
+		"""
+		for col in other.column_names:
+			if col in self.columns:
+				self.columns[col].merge(other.columns[col])
+			else:
+				self.columns[col] = other.columns[col]
+				self.column_names.append(col)
+		return self
+
+	def summary(self):
+		"""
+		Returns:
+			DataFrame with a row per column (see ColumnProfile.summary)
+		"""
+		return pd.DataFrame([self.columns[col].summary() for col in self.column_names],
+			index=self.column_names, columns=['rows', 'missing_rate', 'cardinality', 'exact',
+			'mode', 'mode_share'])
+
+
+
+def profile_chunk(task):
+	"""
+	Profiles a chunk. Used by the processes of the pool
+
+	Args:
+		task (DataFrame or tuple): chunk, or path of a columnar cache and slice of
+			the rows to read
+
+	Returns:
+		DatasetProfile of the chunk
+	"""
+	if not isinstance(task, pd.DataFrame):
+		task = fh.read_columnar_cache(*task)
+	return DatasetProfile().update(task)
+
+
+
+def profile_frame(data_f, chunk_size=CHUNK_SIZE):
+	"""
+	Profiles a DataFrame loaded in memory (in the current process)
+
+	Args:
+		data_f (DataFrame): data to profile
+		chunk_size (int): number of rows profiled at once
+
+	Returns:
+		DatasetProfile
+	"""
+	profile = DatasetProfile()
+	for start in xrange(0, len(data_f.index), chunk_size):
+		profile.update(data_f.iloc[start:start + chunk_size])
+	return profile
+
+
+
+def profile_data(tag_name='train', chunk_size=CHUNK_SIZE, n_jobs=N_JOBS):
+	"""
+	Profiles a dataset in a single pass over its chunks (see module documentation)
+
+	Args:
+		tag_name (str): base name of the data to profile
+		chunk_size (int): number of rows profiled at once
+		n_jobs (int): number of processes
+
+	Returns:
+		DatasetProfile
+	"""
+	cache_path = fh.find_valid_cache_file(tag_name)
+	if cache_path is not None and not cache_path.endswith('.pkl'):
+		nrows = fh.load_columnar_manifest(cache_path)['nrows']
+		tasks = [(cache_path, None, slice(start, start + chunk_size))
+			for start in xrange(0, nrows, chunk_size)]
+	else:
+		tasks = fh.iter_data(tag_name, chunk_size)
+
+	profile = DatasetProfile()
+	if n_jobs > 1:
+		pool = multiprocessing.Pool(n_jobs)
+		try:
+			for chunk_profile in pool.imap_unordered(profile_chunk, tasks):
+				profile.merge(chunk_profile)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for task in tasks:
+			profile.merge(profile_chunk(task))
+	return profile
@@ -0,0 +1,271 @@
+import pandas as pd
+import numpy as np
+import os, os.path as path
+import json
+import hashlib
+import xgboost as xgb
+import utils
+import file_handler as fh
+import profiling
+
+"""
+Library providing the out-of-core training of the XGBoost classifier, for training sets
+larger than the memory.
+
+The training set is never loaded as a whole: it is read from the cache (memory-mapped
+columnar files, compact dtypes) in batches of rows sized by the memory budget
+BATCH_MEMORY (in MB). Without a cache, the batches are read from the csv file with the
+dtypes of a single schema (see file_handler.get_data_schema), so that a column has the
+same dtype in every batch of every pass:
+- first pass: the Preprocessor is fitted batch by batch (Preprocessor.partial_fit)
+- second pass: each batch is transformed and appended to a libsvm file (every value is
+  written, so that zeros are not taken as missing values). Only the input columns of the
+  Preprocessor are read (the columns dropped by feature_selection.py are not loaded)
+XGBoost then trains from this file with its external memory mode (DMatrix built from
+'<file>#<cache prefix>'): the matrix is converted into pages cached on disk and only
+one page is in memory at a time. The libsvm file is kept in data/cache/external, keyed
+by the fingerprints of the data and of the preprocessing, so that it is only written
+again when one of them changed.
+
+The booster is saved as the usual xgb artifact (see model_registry.py), with the fitted
+preprocessing: predict.py uses it as the in-memory trained model.
+"""
+
+# memory budget of a batch of rows, in MB
+BATCH_MEMORY = 256
+
+# estimated memory used by a value of a batch, in bytes (raw chunk, transformed
+# columns and libsvm text)
+BATCH_BYTES_PER_VALUE = 48
+
+
+def get_batch_rows(nb_columns, batch_memory=BATCH_MEMORY):
+	"""
+	Returns the number of rows of the batches fitting in the memory budget
+
+	Args:
+		nb_columns (int): number of columns of the data
+		batch_memory (int): memory budget of a batch, in MB
+
+	Returns:
+		number of rows
+	"""
+	return max(1000, int(batch_memory * (1 << 20) / (nb_columns * BATCH_BYTES_PER_VALUE)))
+
+
+
+def get_external_path(tag_name, key):
+	"""
+	Returns the path of the libsvm file of a training set
+
+	Args:
+		tag_name (str): base name of the training data
+		key (str): fingerprint of the data and of the features (see get_external_key)
+
+	Returns:
+		String containing the path of the .libsvm file
+	"""
+	return path.join(fh.get_root_dir(), "data", "cache", "external", tag_name+"-"+key+".libsvm")
+
+
+
+def get_external_key(data_fingerprint, features):
+	"""
+	Returns the key of the libsvm file of a training set
+
+	Args:
+		data_fingerprint (str): fingerprint of the training data
+		features (list): names of the transformed features
+
+	Returns:
+		String containing the key
+	"""
+	return hashlib.sha1(json.dumps([data_fingerprint, list(features)])).hexdigest()[:16]
+
+
+
+def get_data_batch_rows(tag_name, batch_memory=BATCH_MEMORY, schema=None):
+	"""
+	Returns the number of rows of the batches of a dataset fitting in the memory budget
+
+	Args:
+		tag_name (str): base name of the data
+		batch_memory (int): memory budget of a batch, in MB
+		schema (dict): schema of the data (see file_handler.get_data_schema)
+
+	Returns:
+		number of rows
+	"""
+	# the first chunk gives the number of columns
+	return get_batch_rows(len(next(fh.iter_data(tag_name, 1, schema=schema)).columns),
+		batch_memory)
+
+
+
+@profiling.profiled('external.fit_preprocessor')
+def fit_preprocessor(tag_name, batch_rows, schema=None):
+	"""
+	Fits the Preprocessor on the training set, batch by batch
+
+	Args:
+		tag_name (str): base name of the training data
+		batch_rows (int): number of rows of the batches
+		schema (dict): schema of the data (see file_handler.get_data_schema)
+
+	Returns:
+		fitted utils.Preprocessor
+	"""
+	preprocessor = utils.Preprocessor()
+	for chunk in fh.iter_data(tag_name, batch_rows, schema=schema):
+		preprocessor.partial_fit(chunk)
+	return preprocessor
+
+
+
+def format_libsvm(features, labels):
+	"""
+	Formats a batch of rows in the libsvm format. Each distinct value of a column is
+	formatted once
+
+	Args:
+		features (DataFrame): transformed batch
+		labels (np.array): target values of the rows
+
+	Returns:
+		String containing the lines of the batch
+	"""
+	fields = [np.asarray(labels).astype(np.int64).astype(str).astype(object)]
+	for i, col in enumerate(features.columns):
+		codes, uniques = pd.factorize(features[col].values)
+		# float32 values are written with enough digits to be read back unchanged
+		lookup = ["%d:%.9g" % (i, value) for value in uniques]
+		fields.append(np.array(lookup + ["%d:nan" % i], dtype=object)[codes])
+	rows = np.column_stack(fields).tolist()
+	return '\n'.join(' '.join(row) for row in rows) + '\n'
+
+
+
+@profiling.profiled('external.write_libsvm')
+def write_libsvm(libsvm_path, tag_name, preprocessor, batch_rows, schema=None):
+	"""
+	Transforms the training set batch by batch and writes it in a libsvm file
+
+	Args:
+		libsvm_path (str): path of the file to write
+		tag_name (str): base name of the training data
+		preprocessor (utils.Preprocessor): fitted preprocessing
+		batch_rows (int): number of rows of the batches
+		schema (dict): schema of the data (see file_handler.get_data_schema)
+
+	Returns:
+		number of rows written
+	"""
+	print "Generate libsvm file: " + libsvm_path
+	external_dir = path.dirname(libsvm_path)
+	if not path.exists(external_dir):
+		os.makedirs(external_dir)
+	# evict the files of the previous versions of the data
+	for entry in os.listdir(external_dir):
+		if entry.rsplit('-', 1)[0] == tag_name:
+			os.remove(path.join(external_dir, entry))
+
+	nb_rows = 0
+	tmp_path = libsvm_path + '.tmp'
+	columns = preprocessor.get_input_columns() + [preprocessor.target]
+	with open(tmp_path, 'w') as output:
+		for chunk in fh.iter_data(tag_name, batch_rows, columns, schema=schema):
+			features = preprocessor.transform(chunk)
+			output.write(format_libsvm(features, chunk[preprocessor.target].values))
+			nb_rows += len(chunk.index)
+	os.rename(tmp_path, libsvm_path)
+	return nb_rows
+
+
+
+def get_booster_parameters(parameters):
+	"""
+	Converts the parameters of XGBClassifier into the parameters of xgb.train
+
+	Args:
+		parameters (dict): parameters of XGBClassifier
+
+	Returns:
+		dict of the booster parameters and number of boosting rounds
+	"""
+	parameters = dict(parameters)
+	num_boost_round = parameters.pop('n_estimators', 100)
+	names = {'learning_rate': 'eta', 'reg_alpha': 'alpha', 'reg_lambda': 'lambda',
+		'min_split_loss': 'gamma'}
+	booster_parameters = dict((names.get(name, name), value)
+		for name, value in parameters.items())
+	booster_parameters.setdefault('objective', 'binary:logistic')
+	booster_parameters['silent'] = int(booster_parameters.get('silent', True))
+	if booster_parameters.get('nthread') == -1:
+		del booster_parameters['nthread']
+	return booster_parameters, num_boost_round
+
+
+
+@profiling.profiled('external.train_xgb')
+def train_xgb_external(tag_name, parameters, batch_memory=BATCH_MEMORY, preprocessor=None,
+		schema=None):
+	"""
+	Trains the XGBoost classifier from the cache of the training set, without
+	loading it in memory (see module documentation)
+
+	Args:
+		tag_name (str): base name of the training data
+		parameters (dict): parameters of XGBClassifier
+		batch_memory (int): memory budget of a batch, in MB
+		preprocessor (utils.Preprocessor): fitted preprocessing, restricted to the
+			selected features (fitted on the training set if None)
+		schema (dict): schema of the data (see file_handler.get_data_schema, read
+			once for all the passes if None)
+
+	Returns:
+		trained xgb.Booster, fitted utils.Preprocessor and fingerprint of the data
+	"""
+	if schema is None:
+		schema = fh.get_data_schema(tag_name)
+	batch_rows = get_data_batch_rows(tag_name, batch_memory, schema)
+	if preprocessor is None:
+		preprocessor = fit_preprocessor(tag_name, batch_rows, schema)
+
+	# same fingerprint as the in-memory training data (see train_models.py)
+	data_fingerprint = fh.get_derived_key([tag_name], utils.prepare_train)
+	libsvm_path = get_external_path(tag_name, get_external_key(data_fingerprint,
+		preprocessor.get_feature_names()))
+	if not path.exists(libsvm_path):
+		write_libsvm(libsvm_path, tag_name, preprocessor, batch_rows, schema)
+
+	booster_parameters, num_boost_round = get_booster_parameters(parameters)
+	cache_prefix = path.splitext(libsvm_path)[0] + '.cache'
+	data_dm = xgb.DMatrix(libsvm_path + '#' + cache_prefix)
+	booster = xgb.train(booster_parameters, data_dm, num_boost_round)
+	return booster, preprocessor, data_fingerprint
+
+
+
+@profiling.profiled('external.load_features')
+def load_features(tag_name, preprocessor, columns, batch_memory=BATCH_MEMORY, schema=None):
+	"""
+	Builds the transformed matrix of a few features, batch by batch (e.g the
+	features of the KNN classifier)
+
+	Args:
+		tag_name (str): base name of the training data
+		preprocessor (utils.Preprocessor): fitted preprocessing
+		columns (list): names of the transformed features to keep
+		batch_memory (int): memory budget of a batch, in MB
+		schema (dict): schema of the data (see file_handler.get_data_schema)
+
+	Returns:
+		DataFrame of the features (float32) and np.array of the target values
+	"""
+	input_columns = preprocessor.get_input_columns() + [preprocessor.target]
+	parts, targets = [], []
+	for chunk in fh.iter_data(tag_name, get_batch_rows(len(input_columns), batch_memory),
+			input_columns, schema=schema):
+		parts.append(preprocessor.transform(chunk).loc[:, columns].astype(np.float32))
+		targets.append(chunk[preprocessor.target].values)
+	return pd.concat(parts, ignore_index=True), np.concatenate(targets)
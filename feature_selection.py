@@ -0,0 +1,259 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import time
+import xgboost as xgb
+import profiling
+import external_memory
+
+"""
+Library providing the pruning of the columns of the feature matrix, before training and
+scoring.
+
+select_features drops, in this order:
+- near-constant columns: the mode covers more than MODE_THRESHOLD of the rows (as the
+  features listed by summary.py)
+- duplicate columns: same values as a previous column (compared by hash, then exactly)
+- correlated columns: absolute correlation with a previous kept column above
+  CORRELATION_THRESHOLD (computed on SAMPLE_ROWS rows)
+- low gain columns: share of the total gain below MIN_GAIN_SHARE in a short XGBoost
+  training (GAIN_ROUNDS rounds on SAMPLE_ROWS rows)
+The selection (kept features in the order of the matrix, kept features ranked by gain,
+dropped features by reason) is saved with the models: the preprocessing is restricted to
+the kept features (see Preprocessor.select), so that the dropped columns are neither
+loaded, encoded nor scored. The KNN classifier uses the first features of the ranking.
+The savings of the pruning are measured on the sample and reported with the selection
+(print_selection): time of a short XGBoost training and of the scoring of the sample on all
+the columns and on the kept ones, and memory of the feature matrix.
+"""
+
+# share of the rows covered by the mode above which a column is near-constant
+MODE_THRESHOLD = 0.99
+
+# absolute correlation above which the second of two columns is dropped
+CORRELATION_THRESHOLD = 0.98
+
+# share of the total gain below which a column is dropped
+MIN_GAIN_SHARE = 0.001
+
+# number of rows sampled for the correlations and the gains
+SAMPLE_ROWS = 50000
+
+# number of boosting rounds of the model ranking the columns by gain
+GAIN_ROUNDS = 20
+
+
+def get_sample(X, y, nb_rows=SAMPLE_ROWS, seed=0):
+	"""
+	Returns a random sample of the rows of a matrix
+
+	Args:
+		X (DataFrame): feature matrix
+		y (np.array): target values
+		nb_rows (int): number of rows of the sample
+		seed (int): seed of the sample
+
+	Returns:
+		sampled DataFrame and target values
+	"""
+	if len(X.index) <= nb_rows:
+		return X, np.asarray(y)
+	rows = np.sort(np.random.RandomState(seed).choice(len(X.index), nb_rows, replace=False))
+	return X.iloc[rows], np.asarray(y)[rows]
+
+
+
+def find_constant_columns(X, threshold=MODE_THRESHOLD):
+	"""
+	Returns the columns whose mode covers more than threshold of the rows
+
+	Args:
+		X (DataFrame): feature matrix
+		threshold (float): share of the rows
+
+	Returns:
+		list of column names
+	"""
+	constant = []
+	for col in X.columns:
+		codes, _ = pd.factorize(X[col].values)
+		counts = np.bincount(codes[codes >= 0])
+		if len(counts) == 0 or counts.max() > threshold * len(codes):
+			constant.append(col)
+	return constant
+
+
+
+def find_duplicate_columns(X):
+	"""
+	Returns the columns having the same values as a previous column
+
+	Args:
+		X (DataFrame): feature matrix
+
+	Returns:
+		dict: duplicate column -> previous column
+	"""
+	first_columns = {}
+	duplicates = {}
+	for col in X.columns:
+		values = np.ascontiguousarray(X[col].values, dtype=np.float64)
+		digest = hashlib.sha1(values.view(np.uint8)).hexdigest()
+		candidates = first_columns.setdefault(digest, [])
+		for previous in candidates:
+			if np.array_equal(values, X[previous].values):
+				duplicates[col] = previous
+				break
+		else:
+			candidates.append(col)
+	return duplicates
+
+
+
+def find_correlated_columns(X, threshold=CORRELATION_THRESHOLD):
+	"""
+	Returns the columns correlated with a previous kept column
+
+	Args:
+		X (DataFrame): feature matrix (sample)
+		threshold (float): absolute correlation
+
+	Returns:
+		dict: correlated column -> previous kept column
+	"""
+	# standardized columns in float32: correlations are their scaled dot products
+	values = X.values.astype(np.float32)
+	values -= values.mean(axis=0)
+	norms = np.sqrt((values ** 2).sum(axis=0))
+	values /= np.where(norms > 0, norms, 1)
+	correlations = np.abs(values.T.dot(values))
+
+	correlated = {}
+	columns = list(X.columns)
+	for i, col in enumerate(columns):
+		if col in correlated:
+			continue
+		for j in np.nonzero(correlations[i, i + 1:] > threshold)[0] + i + 1:
+			correlated.setdefault(columns[j], col)
+	return correlated
+
+
+
+@profiling.profiled()
+def rank_columns(X, y, parameters, nb_rounds=GAIN_ROUNDS):
+	"""
+	Ranks the columns by their share of the total gain in a short XGBoost training
+
+	Args:
+		X (DataFrame): feature matrix (sample)
+		y (np.array): target values
+		parameters (dict): parameters of XGBClassifier
+		nb_rounds (int): number of boosting rounds
+
+	Returns:
+		list of (column name, share of the gain), by descending gain
+	"""
+	booster_parameters, _ = external_memory.get_booster_parameters(parameters)
+	data_dm = xgb.DMatrix(X.values.astype(np.float32), label=y,
+		feature_names=[str(col) for col in X.columns])
+	booster = xgb.train(booster_parameters, data_dm, nb_rounds)
+	gains = booster.get_score(importance_type='total_gain')
+	total = sum(gains.values()) or 1.
+	return sorted(((col, gains.get(col, 0.) / total) for col in X.columns),
+		key=lambda item: -item[1])
+
+
+
+def time_columns(X, y, parameters, nb_rounds=GAIN_ROUNDS):
+	"""
+	Times a short XGBoost training and the scoring of a matrix (building of the DMatrix
+	included)
+
+	Args:
+		X (DataFrame): feature matrix (sample)
+		y (np.array): target values
+		parameters (dict): parameters of XGBClassifier
+		nb_rounds (int): number of boosting rounds
+
+	Returns:
+		training and scoring times, in seconds
+	"""
+	booster_parameters, _ = external_memory.get_booster_parameters(parameters)
+	start = time.time()
+	data_dm = xgb.DMatrix(X.values.astype(np.float32), label=y)
+	booster = xgb.train(booster_parameters, data_dm, nb_rounds)
+	fit_seconds = time.time() - start
+	start = time.time()
+	booster.predict(xgb.DMatrix(X.values.astype(np.float32)))
+	return fit_seconds, time.time() - start
+
+
+
+@profiling.profiled()
+def select_features(X, y, parameters, min_gain_share=MIN_GAIN_SHARE):
+	"""
+	Selects the columns of the feature matrix (see module documentation)
+
+	Args:
+		X (DataFrame): feature matrix
+		y (np.array): target values
+		parameters (dict): parameters of XGBClassifier (used to rank by gain)
+		min_gain_share (float): share of the total gain below which a column is dropped
+
+	Returns:
+		dict with the kept features ('features', in the order of X), the kept features
+		by descending gain ('ranking', with their share of the gain in 'gains'), the
+		dropped features by reason ('dropped') and the measured training and scoring
+		times of the sample on all the columns and on the kept ones ('timings')
+	"""
+	dropped = {'constant': find_constant_columns(X)}
+	remaining = [col for col in X.columns if col not in set(dropped['constant'])]
+	duplicates = find_duplicate_columns(X.loc[:, remaining])
+	dropped['duplicate'] = sorted(duplicates.keys())
+	remaining = [col for col in remaining if col not in duplicates]
+
+	sample, y_sample = get_sample(X.loc[:, remaining], y)
+	correlated = find_correlated_columns(sample)
+	dropped['correlated'] = sorted(correlated.keys())
+	remaining = [col for col in remaining if col not in correlated]
+
+	ranking = rank_columns(sample.loc[:, remaining], y_sample, parameters)
+	dropped['low_gain'] = sorted(col for col, share in ranking if share < min_gain_share)
+	ranking = [(col, share) for col, share in ranking if share >= min_gain_share]
+	kept = set(col for col, _ in ranking)
+	features = [col for col in remaining if col in kept]
+
+	# same rows as the sample of the remaining columns
+	full_sample, _ = get_sample(X, y)
+	timings = {'full': time_columns(full_sample, y_sample, parameters),
+		'kept': time_columns(full_sample.loc[:, features], y_sample, parameters)}
+	return {'features': features, 'ranking': [col for col, _ in ranking],
+		'gains': dict(ranking), 'dropped': dropped, 'nb_columns': len(X.columns),
+		'timings': timings}
+
+
+
+def print_selection(selection, X=None):
+	"""
+	Prints the number of dropped columns by reason, and the training time, scoring time
+	and memory saved on the feature matrix
+
+	Args:
+		selection (dict): selection returned by select_features
+		X (DataFrame): full feature matrix (memory is not reported if None)
+	"""
+	print "Feature pruning: %d of %d columns kept (%s)" % (len(selection['features']),
+		selection['nb_columns'], ', '.join("%s: %d dropped" % (reason, len(columns))
+		for reason, columns in sorted(selection['dropped'].items())))
+	saved = lambda full, kept: 100. * (1 - kept / full) if full > 0 else 0.
+	if 'timings' in selection:
+		(full_fit, full_score), (kept_fit, kept_score) = selection['timings']['full'], \
+			selection['timings']['kept']
+		print "Training (%d rounds on the sample): %.3fs -> %.3fs (%.0f%% saved), scoring: " \
+			"%.3fs -> %.3fs (%.0f%% saved)" % (GAIN_ROUNDS, full_fit, kept_fit,
+			saved(full_fit, kept_fit), full_score, kept_score, saved(full_score, kept_score))
+	if X is not None:
+		full = X.memory_usage(index=False).sum() / float(1 << 20)
+		kept = X.loc[:, selection['features']].memory_usage(index=False).sum() / float(1 << 20)
+		print "Feature matrix: %.1f MB -> %.1f MB (%.0f%% saved)" % (full, kept,
+			saved(full, kept))
@@ -0,0 +1,223 @@
+import numpy as np
+import os, os.path as path
+import json
+import hashlib
+import shutil
+import xgboost as xgb
+import file_handler as fh
+
+"""
+Library providing the feature store: the encoded feature matrix held once, in a single
+contiguous float32 buffer (row-major) with named columns, shared by the classifiers.
+
+The classifiers consume the store through views of the buffer, without copying it:
+- XGBoost: the DMatrix is built directly from the buffer (see FeatureStore.get_dmatrix,
+  xgboost does not copy a C-contiguous float32 array before converting it)
+- KNN: each column is a strided view of the buffer (see FeatureStore.column), only the
+  KNN_FEATURES columns of the KNN classifier are gathered when the points are scaled
+All the encoded features fit in float32 exactly (codes, counts and date parts are small
+integers, the numerical columns are float32 in the cache), so that a single dtype is
+used: the target is stored aside as int8.
+
+A store can be written in data/cache/features/<name>-<key> (matrix.npy, target.npy and
+store.json): the buffer is then memory-mapped, and the processes training the models
+attach to it by path (FeatureStore.open). Pickling a persisted store only pickles its
+directory, so that a store sent to another process (pipeline task, pool of processes) is
+attached again instead of being copied.
+"""
+
+# number of rows copied at once into the buffer
+BLOCK_ROWS = 16384
+
+# name of the file describing the columns of a persisted store
+STORE_MANIFEST = 'store.json'
+
+
+def get_store_path(name, data_fingerprint, features):
+	"""
+	Returns the path of the directory of a persisted store
+
+	Args:
+		name (str): name of the store (e.g base name of the data)
+		data_fingerprint (str): fingerprint of the data
+		features (list): names of the columns of the store
+
+	Returns:
+		String containing the path of the directory
+	"""
+	key = hashlib.sha1(json.dumps([data_fingerprint, list(features)])).hexdigest()[:16]
+	return path.join(fh.get_root_dir(), "data", "cache", "features", name+"-"+key)
+
+
+
+def evict_stores(name):
+	"""
+	Removes the persisted stores of the given name
+
+	Args:
+		name (str): name of the stores
+	"""
+	stores_dir = path.dirname(get_store_path(name, '', []))
+	if not path.exists(stores_dir):
+		return
+	for entry in os.listdir(stores_dir):
+		if entry.rsplit('-', 1)[0] == name:
+			print "Remove outdated feature store: " + entry
+			shutil.rmtree(path.join(stores_dir, entry))
+
+
+
+def fill_matrix(matrix, columns, names):
+	"""
+	Copies columns into the buffer, by blocks of BLOCK_ROWS rows (the block of the
+	buffer being written stays in the CPU cache)
+
+	Args:
+		matrix (np.array): buffer (n_rows, n_columns)
+		columns (DataFrame or dict): columns to copy, by name
+		names (list): names of the columns, in the order of the buffer
+	"""
+	values = [np.asarray(columns[col]) for col in names]
+	for start in xrange(0, len(matrix), BLOCK_ROWS):
+		block = matrix[start:start + BLOCK_ROWS]
+		for j, column in enumerate(values):
+			block[:, j] = column[start:start + BLOCK_ROWS]
+
+
+
+class FeatureStore(object):
+	"""
+	Feature matrix in a contiguous float32 buffer with named columns (see module
+	documentation)
+	"""
+
+	def __init__(self, matrix, columns, target=None, store_dir=None):
+		self.matrix = matrix
+		self.columns = [str(col) for col in columns]
+		self.positions = dict((col, j) for j, col in enumerate(self.columns))
+		self.target = target
+		self.store_dir = store_dir
+
+	@classmethod
+	def from_columns(cls, columns, names=None, target=None, store_dir=None):
+		"""
+		Builds a store from the columns of a feature matrix
+
+		Args:
+			columns (DataFrame or dict): columns, by name
+			names (list): names of the columns to store, in order (all the columns of
+				the DataFrame if None)
+			target (np.array): target values (optional)
+			store_dir (str): directory where the store is written (kept in memory if
+				None, the directory is replaced if it exists)
+
+		Returns:
+			FeatureStore (memory-mapped if store_dir is given)
+		"""
+		names = list(columns.columns if names is None else names)
+		nb_rows = len(np.asarray(columns[names[0]])) if names else len(target)
+		if store_dir is None:
+			matrix = np.empty((nb_rows, len(names)), dtype=np.float32)
+			fill_matrix(matrix, columns, names)
+			return cls(matrix, names, None if target is None
+				else np.asarray(target, dtype=np.int8), None)
+
+		tmp_dir = store_dir + '.tmp'
+		for directory in (tmp_dir, store_dir):
+			if path.exists(directory):
+				shutil.rmtree(directory)
+		os.makedirs(tmp_dir)
+		matrix = np.lib.format.open_memmap(path.join(tmp_dir, 'matrix.npy'), mode='w+',
+			dtype=np.float32, shape=(nb_rows, len(names)))
+		fill_matrix(matrix, columns, names)
+		matrix.flush()
+		del matrix
+		if target is not None:
+			np.save(path.join(tmp_dir, 'target.npy'), np.asarray(target, dtype=np.int8))
+		json.dump({'columns': names, 'nrows': nb_rows},
+			open(path.join(tmp_dir, STORE_MANIFEST), 'w'))
+		os.rename(tmp_dir, store_dir)
+		return cls.open(store_dir)
+
+	@classmethod
+	def open(cls, store_dir):
+		"""
+		Attaches to a persisted store (the buffer is memory-mapped, read-only)
+
+		Args:
+			store_dir (str): directory of the store
+
+		Returns:
+			FeatureStore
+		"""
+		manifest = json.load(open(path.join(store_dir, STORE_MANIFEST), 'r'))
+		matrix = np.load(path.join(store_dir, 'matrix.npy'), mmap_mode='r')
+		target_path = path.join(store_dir, 'target.npy')
+		target = np.load(target_path, mmap_mode='r') if path.exists(target_path) else None
+		return cls(matrix, manifest['columns'], target, store_dir)
+
+	def __getstate__(self):
+		# a persisted store is attached again by path
+		if self.store_dir is not None:
+			return {'store_dir': self.store_dir}
+		return self.__dict__
+
+	def __setstate__(self, state):
+		if 'matrix' not in state:
+			state = FeatureStore.open(state['store_dir']).__dict__
+		self.__dict__.update(state)
+
+	def __len__(self):
+		return self.matrix.shape[0]
+
+	@property
+	def shape(self):
+		return self.matrix.shape
+
+	def column(self, name):
+		"""
+		Args:
+			name (str): name of a column
+
+		Returns:
+			np.array view of the column (strided, not copied)
+		"""
+		return self.matrix[:, self.positions[name]]
+
+	def get_matrix(self, columns=None):
+		"""
+		Returns the matrix of the given columns: the buffer itself when the columns are
+		all the columns of the store, in order, or a copy of the gathered columns
+
+		Args:
+			columns (list): names of the columns (all the columns if None)
+
+		Returns:
+			np.array (n_rows, n_columns) of float32
+		"""
+		if columns is None or list(columns) == self.columns:
+			return self.matrix
+		matrix = np.empty((len(self), len(columns)), dtype=np.float32)
+		for j, col in enumerate(columns):
+			matrix[:, j] = self.column(col)
+		return matrix
+
+	def get_dmatrix(self, columns=None, label=None, feature_names=None):
+		"""
+		Builds the xgb.DMatrix of the given columns, from the buffer when they are all
+		the columns of the store (see get_matrix)
+
+		Args:
+			columns (list): names of the columns (all the columns if None)
+			label (np.array): target values (target of the store if None)
+			feature_names (list): names of the features of the DMatrix (names of the
+				columns if None)
+
+		Returns:
+			xgb.DMatrix
+		"""
+		columns = self.columns if columns is None else list(columns)
+		label = self.target if label is None else label
+		# float32 labels are passed to xgboost as a buffer instead of value by value
+		return xgb.DMatrix(self.get_matrix(columns), label=None if label is None
+			else np.asarray(label, dtype=np.float32), feature_names=feature_names or columns)
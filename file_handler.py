@@ -1,7 +1,14 @@
 import pandas as pd
+import numpy as np
 import os, os.path as path
 import cPickle as pickle
 import json
+import shutil
+import hashlib
+import inspect
+import ingestion
+import profiling
+import result_writer
 
 """
 Library providing an abstraction level on the source of the Data/Models/Parameters.
@@ -9,13 +16,40 @@ Library providing an abstraction level on the source of the Data/Models/Paramete
 Data:
 The two main functions are load_data and save_data which respectively
 load and save DataFrames given a basename (e.g load_data('train') will get data from train.csv).
-On top of that, these functions are able to handle cache files (using pickle), which
-significantly improves the loading time. use_cache and generate_cache options allow to
-use this functionality.
+On top of that, these functions are able to handle cache files, which significantly improves
+the loading time. use_cache and generate_cache options allow to use this functionality.
 Original data is expected in data/csv folder. Generated cache files will be located in
 data/cache
 
+Two cache formats are available (see CACHE_FORMAT):
+- columnar (default): one directory per DataFrame, holding a manifest.json and one typed
+  binary .npy file per column. Files are memory-mapped when loading, so that
+  load_data('train', columns=[...]) only reads the requested columns. Object columns are
+  stored as integer codes, their distinct values being kept in the manifest
+- pickle: the whole DataFrame pickled in a single .pkl file. Used as a fallback when a
+  DataFrame can not be stored in the columnar format
+Csv files are read in parallel with compact dtypes (see ingestion.py). The schema of the data
+(dtypes and categories) is saved next to its cache, in data/cache/<basename>.schema.json, and
+enforced when the csv file is read again.
+Each cache file keeps the fingerprint (size, modification time and content hash) of the csv
+file it comes from: a cache whose source file changed is evicted and regenerated.
+
+Partitions:
+New quotes are appended to a dataset as partitions (append_partition/append_csv_partition):
+data/cache/partitions/<dataset>/<id>, each partition being a columnar cache directory. The
+partitions are never modified, so that the models can be refreshed from the partitions
+they were not trained on (see refresh.py) without reading the whole history.
+
+Derived data:
+load_derived_data caches the output of a transformation (e.g the preprocessed feature
+matrices) in data/cache/derived. The entries are keyed by the fingerprints of the source
+data and of the code of the transformation, so that the output is computed once and shared
+by all the scripts until the data or the transformation changes (stale entries are evicted).
+
 Models:
+Python objects can be pickled in the models folder (save_model/load_model). The classifiers
+used for prediction are saved as versioned artifacts in models/<name>/<version>, with their
+fitted preprocessing (see model_registry.py).
 
 Parameters:
 Parameters for the classifiers are stored in json files in the parameters folder. They can be
@@ -24,6 +58,22 @@ Example: load_parameters('xgb') will return the parameters for the xgb classifie
 parameters/xgb.json
 """
 
+# default format of the generated cache files ('columnar' or 'pickle')
+CACHE_FORMAT = 'columnar'
+
+# name of the file describing the content of a columnar cache directory
+COLUMNAR_MANIFEST = 'manifest.json'
+
+# name of the file describing the content of a derived data directory
+DERIVED_MANIFEST = 'derived.json'
+
+# size of the blocks read when computing the hash of a file
+HASH_BLOCK_SIZE = 1 << 20
+
+# fingerprints already computed by the process, by (path, size, mtime)
+_fingerprints = {}
+
+
 
 def get_root_dir():
 	"""
@@ -48,17 +98,50 @@ def get_csv_path(basename):
 
 
 
-def get_cache_path(basename):
+def get_cache_path(basename, cache_format=None):
 	"""
 	Returns the path of the cache file containing the data corresponding to
 	basename
 
 	Args:
 		basename (str): base name of the file
+		cache_format (str): 'columnar' or 'pickle' (defaults to CACHE_FORMAT)
 	Returns:
-		String containing the path of the cache file
+		String containing the path of the cache file (a directory for the
+		columnar format)
 	"""
-	return path.join(get_root_dir(), "data", "cache", basename+".pkl")
+	if (cache_format or CACHE_FORMAT) == 'pickle':
+		return path.join(get_root_dir(), "data", "cache", basename+".pkl")
+	return path.join(get_root_dir(), "data", "cache", basename)
+
+
+
+def get_schema_path(basename):
+	"""
+	Returns the path of the json file containing the schema (dtypes and categories)
+	of the data corresponding to basename
+
+	Args:
+		basename (str): base name of the file
+	Returns:
+		String containing the path of the json file
+	"""
+	return path.join(get_root_dir(), "data", "cache", basename+".schema.json")
+
+
+
+def get_derived_path(artifact_name, key):
+	"""
+	Returns the path of the directory containing the derived data corresponding
+	to artifact_name and key
+
+	Args:
+		artifact_name (str): name of the derived data
+		key (str): hash identifying the sources and transformation of the data
+	Returns:
+		String containing the path of the derived data directory
+	"""
+	return path.join(get_root_dir(), "data", "cache", "derived", artifact_name+"-"+key)
 
 
 
@@ -89,37 +172,98 @@ def get_model_path(basename):
 
 
 
-def load_data(tag_name='train', use_cache=True, generate_cache=True):
+def get_index_path(basename):
+	"""
+	Returns the path of the directory containing the knn index related to basename
+	(see knn_index.py)
+
+	Args:
+		basename (str): base name of the directory
+	Returns:
+		String containing the path of the directory
+	"""
+	return path.join(get_root_dir(), "models", basename+".knn")
+
+
+
+def get_artifact_path(basename, version=None):
+	"""
+	Returns the path of the directory containing the artifacts of the model related
+	to basename, or the path of one version of the artifact
+
+	Args:
+		basename (str): base name of the model
+		version (int): version of the artifact (None for the directory of all versions)
+	Returns:
+		String containing the path of the directory
+	"""
+	if version is None:
+		return path.join(get_root_dir(), "models", basename)
+	return path.join(get_root_dir(), "models", basename, str(version))
+
+
+
+def get_partitions_path(dataset, partition_id=None):
+	"""
+	Returns the path of the directory containing the partitions of a dataset, or the
+	path of one partition
+
+	Args:
+		dataset (str): name of the partitioned dataset
+		partition_id (int): id of the partition (None for the directory of all partitions)
+	Returns:
+		String containing the path of the directory
+	"""
+	if partition_id is None:
+		return path.join(get_root_dir(), "data", "cache", "partitions", dataset)
+	return path.join(get_root_dir(), "data", "cache", "partitions", dataset,
+		"%05d" % partition_id)
+
+
+
+@profiling.profiled('load_data')
+def load_data(tag_name='train', use_cache=True, generate_cache=True, columns=None):
 	"""
 	Function to get the data from the basename of the input file. The input file
 	can be either a cache file or a csv file (switch with use_cache). If cache option
 	is chosen and no cache file is found, data is taken from csv file.
 	The cache file can be generated from the csv file using the generate_cache option.
+	The columnar cache is looked up first, then the pickle one.
 
 	Args:
 		tag_name (str): base name of the csv/cache file to read
 		use_cache (bool): indicates if data must be taken from cache file (if exists)
 		generate_cache (bool): indicates if a cache file must be generated from the csv
+		columns (list): names of the columns to load (all columns if None). With the
+			columnar cache, only the files of these columns are read
 	Returns:
 		Pandas DataFrame containing the data
 	Raises:
 		Exception if no csv file was found when not using the cache
 	"""
-	cache_path = get_cache_path(tag_name)
+	csv_path = get_csv_path(tag_name)
+	cache_path = find_valid_cache_file(tag_name) if use_cache else None
 
-	if use_cache and os.path.exists(cache_path):
+	if cache_path is not None and not cache_path.endswith('.pkl'):
+		return read_columnar_cache(cache_path, columns)
+
+	elif cache_path is not None:
 		data = pickle.load(open(cache_path, 'rb'))
-		return data
+		return data if columns is None else data.loc[:, columns]
 
 	# default on csv file reading if cache does not exists (or if use_cache is
 	# set to False)
 	else:
-		csv_path = get_csv_path(tag_name)
 		if os.path.exists(csv_path):
-			data = pd.read_csv(csv_path)
+			schema_path = get_schema_path(tag_name)
+			schema = ingestion.load_schema(schema_path) if path.exists(schema_path) else None
+			# the whole file is needed to generate the cache
+			data = ingestion.read_csv(csv_path, None if generate_cache else columns, schema)
 			if generate_cache:
-				generate_cache_file(cache_path, data)
-			return data
+				generate_cache_file(get_cache_path(tag_name), data,
+					get_file_fingerprint(csv_path))
+				ingestion.save_schema(schema_path, ingestion.get_schema(data))
+			return data if columns is None else data.loc[:, columns]
 
 		# Failed to get the file, raise exception
 		else:
@@ -127,6 +271,109 @@ def load_data(tag_name='train', use_cache=True, generate_cache=True):
 
 
 
+def get_data_schema(tag_name, chunk_size=100000):
+	"""
+	Returns the schema of a dataset: the saved schema of its cache if it exists, or the
+	schema inferred from its csv file (see ingestion.infer_schema)
+
+	Args:
+		tag_name (str): base name of the csv/cache file
+		chunk_size (int): number of rows of the chunks read to infer the schema
+
+	Returns:
+		dict describing the columns
+	"""
+	schema_path = get_schema_path(tag_name)
+	if path.exists(schema_path):
+		return ingestion.load_schema(schema_path)
+	return ingestion.infer_schema(get_csv_path(tag_name), chunk_size)
+
+
+
+def iter_data(tag_name='test', chunk_size=100000, columns=None, use_cache=True, schema=None):
+	"""
+	Generator yielding the data in chunks of chunk_size rows, so that data larger
+	than the memory can be processed. Chunks are read from the memory-mapped files
+	of the columnar cache if it exists, from the csv file otherwise (no cache is
+	generated). A pickle cache is fully loaded, then sliced. All the chunks of a csv
+	file are read with the dtypes of the schema (categorical columns as strings), so
+	that a column does not change type from one chunk to the next.
+
+	Args:
+		tag_name (str): base name of the csv/cache file to read
+		chunk_size (int): number of rows of the chunks
+		columns (list): names of the columns to load (all columns if None)
+		use_cache (bool): indicates if data must be taken from cache file (if exists)
+		schema (dict): schema of the csv file (see get_data_schema if None)
+	Returns:
+		Generator of Pandas DataFrames
+	Raises:
+		Exception if neither a csv nor a cache file was found
+	"""
+	csv_path = get_csv_path(tag_name)
+	cache_path = find_valid_cache_file(tag_name) if use_cache else None
+
+	if cache_path is not None and not cache_path.endswith('.pkl'):
+		nrows = load_columnar_manifest(cache_path)['nrows']
+		for start in xrange(0, nrows, chunk_size):
+			yield read_columnar_cache(cache_path, columns, slice(start, start + chunk_size))
+
+	elif cache_path is not None:
+		data = load_data(tag_name, columns=columns)
+		for start in xrange(0, len(data.index), chunk_size):
+			yield data.iloc[start:start + chunk_size]
+
+	elif os.path.exists(csv_path):
+		dtypes = ingestion.get_csv_dtypes(schema or get_data_schema(tag_name, chunk_size),
+			columns)
+		for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunk_size,
+				dtype=dtypes):
+			yield chunk
+
+	else:
+		raise Exception("Failure when attempting to get: " + csv_path)
+
+
+
+def find_valid_cache_file(tag_name):
+	"""
+	Returns the path of the existing cache file of the given data (see
+	find_cache_file). A cache whose csv file changed is removed.
+
+	Args:
+		tag_name (str): base name of the csv/cache file
+	Returns:
+		String containing the path of the cache file, None if there is no valid cache
+	"""
+	cache_path = find_cache_file(tag_name)
+	if cache_path is not None and is_cache_stale(cache_path, get_csv_path(tag_name)):
+		print "Source file changed, remove stale cache: " + cache_path
+		remove_cache_file(cache_path)
+		cache_path = None
+	return cache_path
+
+
+
+def find_cache_file(tag_name):
+	"""
+	Returns the path of the existing cache file of the given data, the columnar
+	cache being preferred over the pickle one
+
+	Args:
+		tag_name (str): base name of the csv/cache file
+	Returns:
+		String containing the path of the cache file, None if there is no cache
+	"""
+	columnar_path = get_cache_path(tag_name, 'columnar')
+	if path.exists(path.join(columnar_path, COLUMNAR_MANIFEST)):
+		return columnar_path
+	pickle_path = get_cache_path(tag_name, 'pickle')
+	if path.exists(pickle_path):
+		return pickle_path
+	return None
+
+
+
 def save_data(data, tag_name='train', generate_csv=True, generate_cache=True):
 	"""
 	Function that saves the given DataFrame into csv or cache file (depending on
@@ -153,8 +400,8 @@ def save_data(data, tag_name='train', generate_csv=True, generate_cache=True):
 
 def generate_csv_file(csv_path, data):
 	"""
-	Function that writes the input DataFrame into a csv file. It overides the file
-	if it already exists
+	Function that writes the input DataFrame into a csv file (see result_writer.py).
+	It overides the file if it already exists
 
 	Args:
 		csv_path (str): path of the csv file to create
@@ -164,24 +411,522 @@ def generate_csv_file(csv_path, data):
 	if path.exists(csv_path):
 		print "Remove current csv..." 
 		os.remove(csv_path)
-	data.to_csv(csv_path)
+	result_writer.write_csv(csv_path, data)
+
+
+
+def list_partitions(dataset):
+	"""
+	Returns the ids of the partitions of a dataset
+
+	Args:
+		dataset (str): name of the partitioned dataset
+	Returns:
+		sorted list of partition ids (int)
+	"""
+	partitions_dir = get_partitions_path(dataset)
+	if not path.isdir(partitions_dir):
+		return []
+	return sorted(int(entry) for entry in os.listdir(partitions_dir) if entry.isdigit()
+		and path.exists(path.join(partitions_dir, entry, COLUMNAR_MANIFEST)))
 
 
 
-def generate_cache_file(cache_path, data):
+def append_partition(dataset, data, source=None):
+	"""
+	Appends a DataFrame to a dataset as a new partition
+
+	Args:
+		dataset (str): name of the partitioned dataset
+		data (DataFrame): rows to append
+		source (dict): fingerprint of the csv file the data comes from (if any)
+	Returns:
+		id of the new partition
+	"""
+	partitions = list_partitions(dataset)
+	partition_id = partitions[-1] + 1 if partitions else 0
+	partition_path = get_partitions_path(dataset, partition_id)
+	print "Generate partition: " + partition_path
+	if not path.exists(path.dirname(partition_path)):
+		os.makedirs(path.dirname(partition_path))
+	write_columnar_cache(partition_path, data, source)
+	return partition_id
+
+
+
+def append_csv_partition(dataset, csv_path):
+	"""
+	Appends the rows of a csv file to a dataset as a new partition, unless this file
+	was already appended (same fingerprint)
+
+	Args:
+		dataset (str): name of the partitioned dataset
+		csv_path (str): path of the csv file
+	Returns:
+		id of the partition containing the rows of the file
+	"""
+	source = get_file_fingerprint(csv_path)
+	for partition_id in list_partitions(dataset):
+		partition_source = get_cache_source(get_partitions_path(dataset, partition_id))
+		if partition_source is not None and partition_source.get('sha1') == source['sha1']:
+			print "Already appended in partition %d: %s" % (partition_id, csv_path)
+			return partition_id
+	return append_partition(dataset, ingestion.read_csv(csv_path), source)
+
+
+
+def load_partitions(dataset, partition_ids, columns=None):
+	"""
+	Loads partitions of a dataset in a single DataFrame
+
+	Args:
+		dataset (str): name of the partitioned dataset
+		partition_ids (list): ids of the partitions to load
+		columns (list): names of the columns to load (all columns if None)
+	Returns:
+		Pandas DataFrame containing the rows of the partitions, in order
+	"""
+	parts = [read_columnar_cache(get_partitions_path(dataset, partition_id), columns)
+		for partition_id in partition_ids]
+	if len(parts) == 1:
+		return parts[0]
+	# categories may differ between partitions: categorical columns are concatenated
+	# as objects
+	for part in parts:
+		for col in part.columns:
+			if str(part[col].dtype) == 'category':
+				part[col] = part[col].astype(object)
+	return pd.concat(parts, ignore_index=True)
+
+
+
+@profiling.profiled('write_cache')
+def generate_cache_file(cache_path, data, source=None):
 	"""
 	Function that writes the input DataFrame into a cache file. It overides the file
-	if it already exists. Data is serialized using cPickle with HIGHEST_PROTOCOL option
+	if it already exists. The format is deduced from the path: a .pkl file is serialized
+	using cPickle with HIGHEST_PROTOCOL option, any other path is a columnar cache
+	directory. If the DataFrame can not be stored in the columnar format, the pickle
+	format is used instead
 
 	Args:
-		cache_path (str): path of the csv file to create
+		cache_path (str): path of the cache file to create
 		data (DataFrame): data to convert into cache file
+		source (dict): fingerprint of the csv file the data comes from (if any)
 	"""
 	print "Generate cache in file: " + cache_path
 	if path.exists(cache_path):
 		print "Remove current cache..." 
-		os.remove(cache_path)
+		remove_cache_file(cache_path)
+
+	if not cache_path.endswith('.pkl'):
+		try:
+			write_columnar_cache(cache_path, data, source)
+			return
+		except TypeError as e:
+			print "Columnar cache not supported (%s), fallback on pickle" % e
+			cache_path = cache_path + '.pkl'
 	pickle.dump(data, open(cache_path, 'wb'), pickle.HIGHEST_PROTOCOL)
+	if source is not None:
+		json.dump(source, open(cache_path + '.json', 'w'))
+
+
+
+def remove_cache_file(cache_path):
+	"""
+	Removes the given cache file (pickle file or columnar cache directory)
+
+	Args:
+		cache_path (str): path of the cache file to remove
+	"""
+	if path.isdir(cache_path):
+		shutil.rmtree(cache_path)
+	elif path.exists(cache_path):
+		os.remove(cache_path)
+		if path.exists(cache_path + '.json'):
+			os.remove(cache_path + '.json')
+
+
+
+def get_file_fingerprint(file_path):
+	"""
+	Computes the fingerprint of a file: its size, modification time and the sha1
+	hash of its content. Fingerprints are memoized for the duration of the process
+
+	Args:
+		file_path (str): path of the file
+	Returns:
+		dict with size, mtime and sha1 keys
+	"""
+	stat = os.stat(file_path)
+	memo_key = (path.abspath(file_path), stat.st_size, stat.st_mtime)
+	if memo_key not in _fingerprints:
+		sha1 = hashlib.sha1()
+		with open(file_path, 'rb') as f:
+			for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+				sha1.update(block)
+		_fingerprints[memo_key] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+			'sha1': sha1.hexdigest()}
+	return dict(_fingerprints[memo_key])
+
+
+
+def fingerprint_matches(fingerprint, file_path):
+	"""
+	Checks if a file still matches the given fingerprint. The content hash is only
+	computed when the size matches but the modification time changed
+
+	Args:
+		fingerprint (dict): fingerprint previously computed by get_file_fingerprint
+		file_path (str): path of the file
+	Returns:
+		True if the content of the file did not change
+	"""
+	stat = os.stat(file_path)
+	if stat.st_size != fingerprint['size']:
+		return False
+	if stat.st_mtime == fingerprint['mtime']:
+		return True
+	return get_file_fingerprint(file_path)['sha1'] == fingerprint['sha1']
+
+
+
+def get_cache_source(cache_path):
+	"""
+	Returns the fingerprint of the csv file a cache file was generated from
+
+	Args:
+		cache_path (str): path of the cache file
+	Returns:
+		dict containing the fingerprint, None if it was not recorded
+	"""
+	if not cache_path.endswith('.pkl'):
+		return load_columnar_manifest(cache_path).get('source')
+	if path.exists(cache_path + '.json'):
+		return json.load(open(cache_path + '.json', 'r'))
+	return None
+
+
+
+def is_cache_stale(cache_path, csv_path):
+	"""
+	Checks if a cache file is outdated regarding the csv file it was generated from.
+	A cache without csv file is never stale, and a cache without recorded fingerprint
+	is stale if the csv file is more recent.
+
+	Args:
+		cache_path (str): path of the cache file
+		csv_path (str): path of the source csv file
+	Returns:
+		True if the cache must be regenerated
+	"""
+	if not path.exists(csv_path):
+		return False
+	source = get_cache_source(cache_path)
+	if source is None:
+		return path.getmtime(csv_path) > path.getmtime(cache_path)
+	return not fingerprint_matches(source, csv_path)
+
+
+
+def get_data_fingerprint(tag_name):
+	"""
+	Returns a hash identifying the content of the given data: the hash of its csv
+	file when it exists (taken from the cache when the file did not change), the
+	hash of its cache otherwise
+
+	Args:
+		tag_name (str): base name of the csv/cache file
+	Returns:
+		String containing the hash
+	Raises:
+		Exception if neither a csv nor a cache file exists
+	"""
+	csv_path = get_csv_path(tag_name)
+	cache_path = find_cache_file(tag_name)
+	if path.exists(csv_path):
+		source = get_cache_source(cache_path) if cache_path is not None else None
+		if source is not None and fingerprint_matches(source, csv_path):
+			return source['sha1']
+		return get_file_fingerprint(csv_path)['sha1']
+
+	elif cache_path is not None:
+		if cache_path.endswith('.pkl'):
+			return get_file_fingerprint(cache_path)['sha1']
+		return get_file_fingerprint(path.join(cache_path, COLUMNAR_MANIFEST))['sha1']
+
+	else:
+		raise Exception("Failure when attempting to get: " + csv_path)
+
+
+
+def get_transform_fingerprint(transform):
+	"""
+	Returns a hash identifying a transformation function: the hash of the source
+	code of its module, so that any change of the function or of the helpers it
+	relies on invalidates the derived data
+
+	Args:
+		transform (function): transformation function
+	Returns:
+		String containing the hash
+	"""
+	source = inspect.getsource(inspect.getmodule(transform))
+	return hashlib.sha1(source + transform.__name__).hexdigest()
+
+
+
+@profiling.profiled('load_derived_data')
+def load_derived_data(artifact_name, tag_names, transform, use_cache=True):
+	"""
+	Returns the output of transform applied to the given data. The output is cached
+	in data/cache/derived, keyed by the fingerprints of the input data and of the
+	transformation, so that it is only computed when one of them changed. Outdated
+	entries of the same artifact are evicted.
+
+	Args:
+		artifact_name (str): name of the derived data
+		tag_names (list): base names of the data given as arguments to transform
+		transform (function): function taking the loaded DataFrames (in the order of
+			tag_names) and returning a DataFrame, or a tuple of DataFrames/objects
+		use_cache (bool): indicates if the output must be taken from cache (if exists)
+	Returns:
+		The output of transform
+	"""
+	derived_path = get_derived_path(artifact_name, get_derived_key(tag_names, transform))
+
+	if use_cache and path.exists(path.join(derived_path, DERIVED_MANIFEST)):
+		return read_derived_data(derived_path)
+
+	outputs = transform(*[load_data(tag_name) for tag_name in tag_names])
+	evict_derived_data(artifact_name)
+	write_derived_data(derived_path, outputs)
+	return outputs
+
+
+
+def get_derived_key(tag_names, transform):
+	"""
+	Returns the key identifying the output of transform applied to the given data:
+	hash of the fingerprints of the data and of the transformation
+
+	Args:
+		tag_names (list): base names of the input data
+		transform (function): transformation function
+	Returns:
+		String containing the key
+	"""
+	key_items = [get_data_fingerprint(tag_name) for tag_name in tag_names]
+	key_items.append(get_transform_fingerprint(transform))
+	return hashlib.sha1('|'.join(key_items)).hexdigest()[:16]
+
+
+
+def write_derived_data(derived_path, outputs):
+	"""
+	Writes the output of a transformation in a derived data directory. DataFrames
+	are stored as cache files, other objects are pickled
+
+	Args:
+		derived_path (str): path of the directory to create
+		outputs (object): DataFrame, or tuple of DataFrames/objects
+	"""
+	tmp_path = derived_path + '.tmp'
+	remove_cache_file(tmp_path)
+	os.makedirs(tmp_path)
+
+	manifest = {'tuple': isinstance(outputs, tuple), 'outputs': []}
+	for i, output in enumerate(outputs if manifest['tuple'] else (outputs,)):
+		if isinstance(output, pd.DataFrame):
+			generate_cache_file(path.join(tmp_path, str(i)), output)
+			manifest['outputs'].append('data')
+		else:
+			pickle.dump(output, open(path.join(tmp_path, str(i) + '.obj'), 'wb'),
+				pickle.HIGHEST_PROTOCOL)
+			manifest['outputs'].append('object')
+
+	json.dump(manifest, open(path.join(tmp_path, DERIVED_MANIFEST), 'w'))
+	os.rename(tmp_path, derived_path)
+
+
+
+def read_derived_data(derived_path):
+	"""
+	Reads the output of a transformation from a derived data directory
+
+	Args:
+		derived_path (str): path of the derived data directory
+	Returns:
+		DataFrame, or tuple of DataFrames/objects
+	"""
+	manifest = json.load(open(path.join(derived_path, DERIVED_MANIFEST), 'r'))
+	outputs = []
+	for i, kind in enumerate(manifest['outputs']):
+		if kind == 'object':
+			outputs.append(pickle.load(open(path.join(derived_path, str(i) + '.obj'), 'rb')))
+		elif path.isdir(path.join(derived_path, str(i))):
+			outputs.append(read_columnar_cache(path.join(derived_path, str(i))))
+		else:
+			outputs.append(pickle.load(open(path.join(derived_path, str(i) + '.pkl'), 'rb')))
+	return tuple(outputs) if manifest['tuple'] else outputs[0]
+
+
+
+def evict_derived_data(artifact_name):
+	"""
+	Removes all the cached versions of the given derived data
+
+	Args:
+		artifact_name (str): name of the derived data
+	"""
+	derived_dir = path.dirname(get_derived_path(artifact_name, ''))
+	if not path.exists(derived_dir):
+		return
+	for entry in os.listdir(derived_dir):
+		if entry.rsplit('-', 1)[0] == artifact_name:
+			print "Remove outdated derived data: " + entry
+			remove_cache_file(path.join(derived_dir, entry))
+
+
+
+def write_columnar_cache(cache_dir, data, source=None):
+	"""
+	Writes the given DataFrame in the columnar format: each column is saved in its
+	own .npy file and a manifest describes the columns (name, file, dtype, kind and
+	categories). Object and categorical columns are stored as int32 codes (-1 for
+	missing values), their categories being saved in the manifest.
+	Files are first written in a temporary directory which is renamed at the end,
+	so that a partially written cache is never read.
+
+	Args:
+		cache_dir (str): path of the directory to create
+		data (DataFrame): data to store
+		source (dict): fingerprint of the csv file the data comes from (if any)
+	Raises:
+		TypeError if the categories of a column can not be stored in the manifest
+	"""
+	tmp_dir = cache_dir + '.tmp'
+	remove_cache_file(tmp_dir)
+	os.makedirs(tmp_dir)
+
+	manifest = {'nrows': len(data.index), 'columns': [], 'index': None, 'source': source}
+	try:
+		for i, col in enumerate(data.columns):
+			file_name = "%04d.npy" % i
+			series = data[col]
+			entry = {'name': col, 'file': file_name}
+
+			if series.dtype == 'object' or str(series.dtype) == 'category':
+				entry['kind'] = 'category' if str(series.dtype) == 'category' else 'object'
+				categorical = pd.Categorical(series)
+				entry['categories'] = categorical.categories.tolist()
+				json.dumps(entry['categories'])
+				values = categorical.codes.astype(np.int32)
+			else:
+				entry['kind'] = 'numeric'
+				values = series.values
+			entry['dtype'] = str(values.dtype)
+
+			np.save(path.join(tmp_dir, file_name), values)
+			manifest['columns'].append(entry)
+
+		# the index is only stored when it differs from the default one
+		if not data.index.equals(pd.Index(np.arange(len(data.index)))):
+			np.save(path.join(tmp_dir, 'index.npy'), np.asarray(data.index.values))
+			manifest['index'] = 'index.npy'
+
+	except TypeError:
+		shutil.rmtree(tmp_dir)
+		raise
+
+	json.dump(manifest, open(path.join(tmp_dir, COLUMNAR_MANIFEST), 'w'), indent=1)
+	remove_cache_file(cache_dir)
+	os.rename(tmp_dir, cache_dir)
+
+
+
+def load_columnar_manifest(cache_dir):
+	"""
+	Loads the manifest of a columnar cache directory
+
+	Args:
+		cache_dir (str): path of the cache directory
+
+	Returns:
+		Dictionary describing the stored columns
+	"""
+	return json.load(open(path.join(cache_dir, COLUMNAR_MANIFEST), 'r'))
+
+
+
+def read_columnar_column(cache_dir, entry, mmap=True, rows=None):
+	"""
+	Reads a single column of a columnar cache. Numerical columns are returned as
+	(read-only) memory-mapped arrays when mmap is set
+
+	Args:
+		cache_dir (str): path of the cache directory
+		entry (dict): description of the column in the manifest
+		mmap (bool): indicates if the file must be memory-mapped
+		rows (slice): rows to read (all rows if None)
+
+	Returns:
+		np.array or pd.Categorical containing the values of the column
+	"""
+	values = np.load(path.join(cache_dir, entry['file']), mmap_mode='r' if mmap else None)
+	if rows is not None:
+		values = values[rows]
+	if entry['kind'] == 'numeric':
+		return values
+
+	categories = entry['categories']
+	if entry['kind'] == 'category':
+		return pd.Categorical.from_codes(np.asarray(values), categories)
+
+	# object column: codes are mapped back to values, -1 (missing) being mapped to
+	# the last item of the lookup array
+	lookup = np.empty(len(categories) + 1, dtype=object)
+	lookup[:-1] = categories
+	lookup[-1] = np.nan
+	return lookup[np.asarray(values)]
+
+
+
+@profiling.profiled('read_cache')
+def read_columnar_cache(cache_dir, columns=None, rows=None):
+	"""
+	Builds a DataFrame from a columnar cache directory. Only the files of the
+	requested columns (and the requested rows) are read.
+
+	Args:
+		cache_dir (str): path of the cache directory
+		columns (list): names of the columns to load (all columns if None)
+		rows (slice): rows to read (all rows if None)
+
+	Returns:
+		Pandas DataFrame containing the data
+	Raises:
+		KeyError if a requested column is not in the cache
+	"""
+	manifest = load_columnar_manifest(cache_dir)
+	entries = dict((entry['name'], entry) for entry in manifest['columns'])
+	if columns is None:
+		columns = [entry['name'] for entry in manifest['columns']]
+
+	rows = rows if rows is not None else slice(None)
+	if manifest['index'] is not None:
+		index = np.load(path.join(cache_dir, manifest['index']), mmap_mode='r')
+		index = pd.Index(np.asarray(index[rows]))
+	else:
+		index = pd.RangeIndex(*rows.indices(manifest['nrows']))
+
+	values = {}
+	for col in columns:
+		if col not in entries:
+			raise KeyError("Column %s not found in cache %s" % (col, cache_dir))
+		values[col] = read_columnar_column(cache_dir, entries[col], rows=rows)
+	data = pd.DataFrame(values, index=index, columns=columns)
+	return data
 
 
 
@@ -198,6 +943,8 @@ def save_parameters(model_name, parameters):
 	if path.exists(parameters_path):
 		print "Remove current cache..." 
 		os.remove(parameters_path)
+	elif not path.exists(path.dirname(parameters_path)):
+		os.makedirs(path.dirname(parameters_path))
 	json.dump(parameters, open(parameters_path, 'w'))
 
 
@@ -246,4 +993,4 @@ def load_model(model_name):
 	"""
 	model_path = get_model_path(model_name)
 	model = pickle.load(open(model_path, 'rb'))
-	return model
\ No newline at end of file
+	return model
@@ -0,0 +1,285 @@
+import pandas as pd
+import numpy as np
+import os, os.path as path
+import sys
+import multiprocessing
+import file_handler as fh
+
+"""
+Script generating synthetic train/test csv files shaped like the Homesite dataset, so that
+the pipeline can be benchmarked (see benchmark_perf.py) without the Kaggle files and at any
+number of rows.
+
+The generated files have the schema traits of the original data:
+- QuoteNumber (id), Original_Quote_Date (dates as strings) and QuoteConversion_Flag (target,
+  about 19% of positives, train file only)
+- 258 features named after the original ones (Field*, CoverageField*, SalesField*,
+  PersonalField*, PropertyField*, GeographicField*): small integer codes, floats, and
+  object columns (letters, Y/N flags, numbers with thousands separators)
+- missing values in some numerical and object columns (rate drawn per column)
+- a target depending on a few features (so that the models learn something)
+Columns are drawn from a RandomState seeded by the name of the column and the index of
+the chunk: the files only depend on the number of rows and the seed.
+
+Rows are generated in chunks of CHUNK_SIZE rows by a pool of N_JOBS processes and appended
+to the csv file in order, so that files larger than the memory can be generated.
+Example: python generate_data.py 1000000 (data/csv/synthetic_1000000_train.csv and
+data/csv/synthetic_1000000_test.csv)
+"""
+
+# number of rows generated at once
+CHUNK_SIZE = 50000
+
+# number of processes generating the chunks
+N_JOBS = multiprocessing.cpu_count()
+
+# features of each group: (name, numbers) where a number followed by 'AB' gives two
+# columns (e.g. 'PersonalField10AB' gives PersonalField10A and PersonalField10B)
+feature_groups = [
+	('Field', [str(i) for i in xrange(6, 13)]),
+	('CoverageField', ['1AB', '2AB', '3AB', '4AB', '5AB', '6AB', '8', '9', '11AB']),
+	('SalesField', ['1AB', '2AB', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13',
+		'14', '15']),
+	('PersonalField', ['1', '2', '4AB', '5', '6', '7', '8', '9', '10AB', '11', '12', '13',
+		'14', '15', '16', '17', '18', '19', '22', '23', '24', '25', '26', '27'] +
+		[str(i) for i in xrange(28, 85)]),
+	('PropertyField', ['1AB', '2AB', '3', '4', '5', '6', '7', '8', '9', '10', '11AB', '12',
+		'13', '14', '15', '16AB', '17', '18', '19', '20', '21AB', '22', '23', '24AB', '25',
+		'26AB', '27', '28', '29', '30', '31', '32', '33', '34', '35', '36', '37', '38',
+		'39AB']),
+	('GeographicField', [str(i) + 'AB' for i in xrange(1, 43)] + ['50', '62', '63', '64']),
+]
+
+# object features: values drawn from the given list
+object_features = {
+	'Field6': list('ABCDEFJK'), 'Field10': ['548', '564', '935', '965', '1,113', '1,165',
+	'1,480', '1,487'], 'Field12': ['N', 'Y'], 'CoverageField8': list('TVWXYZ'),
+	'CoverageField9': list('ABCDEFGJKL'), 'SalesField7': list('MPQRTV'),
+	'PersonalField7': ['N', 'Y'], 'PersonalField16': ['XB', 'XC', 'XD', 'XE', 'XF', 'ZA'],
+	'PersonalField17': ['XA', 'XB', 'YD', 'YE', 'YF', 'ZA'], 'PersonalField18': ['XR',
+	'XS', 'YJ', 'YK', 'ZO', 'ZP'], 'PersonalField19': ['XZ', 'YG', 'YH', 'ZA', 'ZB'],
+	'PropertyField3': ['N', 'Y'], 'PropertyField4': ['N', 'Y'],
+	'PropertyField5': ['N', 'Y'], 'PropertyField7': list('ABCDEFHIJKLMNOPR'),
+	'PropertyField14': list('ABCD'), 'PropertyField28': list('ABCD'),
+	'PropertyField30': ['N', 'Y'], 'PropertyField31': list('KLMN'),
+	'PropertyField32': ['N', 'Y'], 'PropertyField33': list('EFGH'),
+	'PropertyField34': ['N', 'Y'], 'PropertyField36': ['N', 'Y'],
+	'PropertyField37': ['N', 'Y'], 'PropertyField38': ['N', 'Y'],
+	'GeographicField63': [' ', 'N', 'Y'], 'GeographicField64': ['CA', 'IL', 'NJ', 'TX'],
+}
+
+# float features
+float_features = ['Field8', 'Field9', 'Field11']
+
+# missing values rate of the features with missing values
+missing_features = {
+	'PersonalField7': 0.0005, 'PersonalField84': 0.47, 'PropertyField3': 0.0003,
+	'PropertyField4': 0.0002, 'PropertyField29': 0.77, 'PropertyField32': 0.0003,
+	'PropertyField34': 0.0003, 'PropertyField36': 0.0005, 'PropertyField38': 0.005,
+}
+
+# first day and number of days of the quote dates
+FIRST_DATE = '2013-01-01'
+NB_DATES = 870
+
+# base rate of the target
+POSITIVE_RATE = 0.19
+
+
+def get_feature_names():
+	"""
+	Returns:
+		list of the names of the generated features, in order
+	"""
+	names = []
+	for prefix, numbers in feature_groups:
+		for number in numbers:
+			if number.endswith('AB'):
+				names += [prefix + number[:-2] + 'A', prefix + number[:-2] + 'B']
+			else:
+				names.append(prefix + number)
+	return names
+
+
+
+def get_random_state(seed, name, chunk):
+	"""
+	Returns the RandomState drawing a column of a chunk
+
+	Args:
+		seed (int): seed of the file
+		name (str): name of the column
+		chunk (int): index of the chunk
+
+	Returns:
+		np.random.RandomState
+	"""
+	return np.random.RandomState([seed, chunk, sum(ord(c) * (i + 1) for i, c in enumerate(name))])
+
+
+
+def generate_column(name, nb_rows, seed, chunk):
+	"""
+	Draws the values of a feature
+
+	Args:
+		name (str): name of the feature
+		nb_rows (int): number of rows
+		seed (int): seed of the file
+		chunk (int): index of the chunk
+
+	Returns:
+		np.array of the values
+	"""
+	random_state = get_random_state(seed, name, chunk)
+	# the parameters of the distribution only depend on the name of the column
+	column_state = get_random_state(0, name, 0)
+	if name in object_features:
+		values = np.array(object_features[name], dtype=object)
+		probabilities = column_state.dirichlet(np.ones(len(values)))
+		column = values[random_state.choice(len(values), nb_rows, p=probabilities)]
+	elif name in float_features:
+		column = np.round(random_state.beta(2, 5, nb_rows) * column_state.randint(1, 3), 4)
+	else:
+		low = -1 if column_state.rand() < 0.3 else 0
+		high = column_state.choice([2, 3, 5, 10, 25])
+		column = random_state.randint(low, high + 1, nb_rows)
+
+	if name in missing_features:
+		column = column.astype(object if name in object_features else np.float64)
+		column[random_state.rand(nb_rows) < missing_features[name]] = np.nan
+	return column
+
+
+
+def generate_chunk(args):
+	"""
+	Generates a chunk of rows and formats it as csv. Used by the processes of the pool
+
+	Args:
+		args (tuple): kind of file ('train' or 'test'), index of the chunk, number of
+			rows of the chunk, first QuoteNumber of the chunk and seed of the file
+
+	Returns:
+		String containing the csv lines of the chunk (with the header for the first chunk)
+	"""
+	kind, chunk, nb_rows, first_number, seed = args
+	columns = [('QuoteNumber', np.arange(first_number, first_number + nb_rows))]
+	random_state = get_random_state(seed, 'Original_Quote_Date', chunk)
+	dates = pd.date_range(FIRST_DATE, periods=NB_DATES).strftime('%Y-%m-%d')
+	columns.append(('Original_Quote_Date', np.asarray(dates)[random_state.randint(0,
+		NB_DATES, nb_rows)]))
+	features = [(name, generate_column(name, nb_rows, seed, chunk))
+		for name in get_feature_names()]
+
+	if kind == 'train':
+		data = dict(features)
+		scale = lambda values: (values - values.mean()) / max(values.std(), 1e-6)
+		# the intercept is lowered so that the mean probability stays close to POSITIVE_RATE
+		score = np.log(POSITIVE_RATE / (1 - POSITIVE_RATE)) - 0.5 \
+			+ 1.2 * scale(data['PropertyField37'] == 'Y') \
+			+ 0.6 * scale(data['SalesField5']) - 0.4 * scale(data['PersonalField9']) \
+			+ 0.3 * scale(data['Field7'])
+		random_state = get_random_state(seed, 'QuoteConversion_Flag', chunk)
+		target = random_state.rand(nb_rows) < 1 / (1 + np.exp(-score))
+		columns.append(('QuoteConversion_Flag', target.astype(np.int8)))
+	columns += features
+
+	# the csv lines are built from the formatted columns (much faster than to_csv)
+	rows = np.column_stack([format_column(values) for _, values in columns]).tolist()
+	lines = '\n'.join(','.join(row) for row in rows) + '\n'
+	if chunk == 0:
+		lines = ','.join(name for name, _ in columns) + '\n' + lines
+	return lines
+
+
+
+def format_column(values):
+	"""
+	Formats the values of a column as csv fields: each distinct value is formatted
+	once (missing values as empty fields, strings containing commas are quoted)
+
+	Args:
+		values (np.array): values of the column
+
+	Returns:
+		np.array of strings
+	"""
+	codes, uniques = pd.factorize(values)
+	if values.dtype.kind == 'f':
+		lookup = [repr(float(value)) for value in uniques]
+	else:
+		lookup = ['"%s"' % value if ',' in str(value) else str(value) for value in uniques]
+	# missing values (code -1) map to the last item of the lookup
+	return np.array(lookup + [''], dtype=object)[codes]
+
+
+
+def generate_file(tag_name, nb_rows, kind='train', seed=0, n_jobs=N_JOBS):
+	"""
+	Generates a synthetic csv file in data/csv
+
+	Args:
+		tag_name (str): base name of the csv file
+		nb_rows (int): number of rows
+		kind (str): 'train' (with the target) or 'test'
+		seed (int): seed of the file
+		n_jobs (int): number of processes
+
+	Returns:
+		path of the csv file
+	"""
+	csv_path = fh.get_csv_path(tag_name)
+	print "Generate synthetic data: %s (%d rows)" % (csv_path, nb_rows)
+	# test quotes are numbered after the train ones
+	first_number = 1 if kind == 'train' else 1 + nb_rows * 2
+	tasks = [(kind, chunk, min(CHUNK_SIZE, nb_rows - start), first_number + start, seed)
+		for chunk, start in enumerate(xrange(0, nb_rows, CHUNK_SIZE))]
+
+	tmp_path = csv_path + '.tmp'
+	with open(tmp_path, 'w') as output:
+		if n_jobs > 1 and len(tasks) > 1:
+			pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+			try:
+				for lines in pool.imap(generate_chunk, tasks):
+					output.write(lines)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			for task in tasks:
+				output.write(generate_chunk(task))
+	os.rename(tmp_path, csv_path)
+	return csv_path
+
+
+
+def generate_dataset(nb_rows, nb_test_rows=None, prefix='synthetic', seed=0, n_jobs=N_JOBS):
+	"""
+	Generates synthetic train and test files (data/csv/<prefix>_<nb_rows>_train.csv and
+	data/csv/<prefix>_<nb_rows>_test.csv), unless they already exist
+
+	Args:
+		nb_rows (int): number of rows of the train file
+		nb_test_rows (int): number of rows of the test file (same as train if None)
+		prefix (str): prefix of the base names of the files
+		seed (int): seed of the files
+		n_jobs (int): number of processes
+
+	Returns:
+		base names of the train and test files
+	"""
+	nb_test_rows = nb_rows if nb_test_rows is None else nb_test_rows
+	tag_names = []
+	for kind, kind_rows, kind_seed in [('train', nb_rows, seed), ('test', nb_test_rows, seed + 1)]:
+		tag_name = "%s_%d_%s" % (prefix, nb_rows, kind)
+		if not path.exists(fh.get_csv_path(tag_name)):
+			generate_file(tag_name, kind_rows, kind, kind_seed, n_jobs)
+		tag_names.append(tag_name)
+	return tuple(tag_names)
+
+
+
+if __name__ == "__main__":
+	for nb_rows in (sys.argv[1:] or ['100000']):
+		generate_dataset(int(nb_rows))
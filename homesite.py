@@ -0,0 +1,485 @@
+import os, os.path as path
+import sys
+import time
+import json
+import glob
+import socket
+import argparse
+import tempfile
+import traceback
+import SocketServer
+
+"""
+Command-line entry point of the scripts, with a subcommand per step:
+	python homesite.py ingest [TAG ...] [--append CSV ...]
+	python homesite.py train [--force] [--external | --refresh]
+	python homesite.py predict [TAG] [--gzip] [--output-dir DIR] [--sidecar DIR] [--jobs N]
+	python homesite.py score CSV [--model NAME]
+	python homesite.py profile [TAG] [--plots]
+	python homesite.py bench {perf,xgb,knn,startup,trees} [SIZE ...]
+	python homesite.py daemon {start,stop,status}
+
+Only the standard library is imported at startup: each subcommand imports the modules it
+needs when it runs (pandas, sklearn and xgboost are imported by the commands using them,
+matplotlib and seaborn by profile --plots only), so that the light commands and the
+parsing of the arguments do not pay the import time of the heavy libraries.
+
+Daemon mode: python homesite.py daemon start forks a local server (unix socket
+DAEMON_SOCKET, log in DAEMON_LOG) which imports the libraries, loads the models (scorers
+of predict.py, see model_registry.py) and preprocesses the test set once: its feature
+store is kept in memory (predict.KEEP_FEATURE_STORES). While it runs, the subcommands are
+sent to it and executed in its warm process (their output is sent back when they finish),
+so that repeated invocations pay neither the imports, the loading of the models nor the
+reading and preprocessing of the test set, and share the prediction cache of the process
+(see prediction_cache.py). A command is run in the calling process when
+the daemon is not running, when --local is given, when a source file changed after the
+daemon started, and for the bench, daemon and train commands (see LOCAL_COMMANDS). The
+daemon reloads the models after the ingest command, and before a command when a model was
+retrained by another process (see predict.reload_scorers).
+
+python homesite.py bench startup measures the cold (new process) and warm (through the
+daemon) startup of the commands (see benchmark_perf.benchmark_startup).
+"""
+
+# root directory of the project
+ROOT_DIR = path.dirname(path.abspath(__file__))
+
+# unix socket of the daemon
+DAEMON_SOCKET = path.join(ROOT_DIR, "data", "cache", "homesite.sock")
+
+# output of the daemon process
+DAEMON_LOG = path.join(ROOT_DIR, "data", "cache", "homesite.log")
+
+# maximum time (in seconds) waited for the daemon to be ready
+DAEMON_TIMEOUT = 300
+
+# commands always run in the calling process (train forks the training processes, which
+# must not inherit the OpenMP threads started by the scoring of the daemon, see pipeline.py)
+LOCAL_COMMANDS = ('bench', 'daemon', 'train')
+
+# commands after which the daemon reloads the models
+RELOAD_COMMANDS = ('ingest',)
+
+
+def run_ingest(args):
+	"""
+	Generates the caches of the datasets and appends new quotes as partitions
+	"""
+	import file_handler as fh
+	import refresh
+	for tag_name in args.tags or ([] if args.append else ['train', 'test']):
+		print "%s: %d rows x %d columns" % ((tag_name,) + fh.load_data(tag_name).shape)
+	for csv_path in args.append:
+		print "Partition %d: %s" % (fh.append_csv_partition(refresh.DATASET, csv_path),
+			csv_path)
+
+
+
+def run_train(args):
+	"""
+	Trains the classifiers (see train_models.py), or refreshes them with the new
+	partitions (see refresh.py)
+	"""
+	if args.refresh:
+		import refresh
+		refresh.refresh()
+	else:
+		import train_models
+		train_models.train('external' if args.external else train_models.TRAINING_MODE,
+			args.force)
+
+
+
+def run_predict(args):
+	"""
+	Scores a dataset and writes the result files (see predict.py)
+	"""
+	import predict
+	predict.predict_batches(args.tag, n_jobs=args.jobs, compress=args.gzip,
+		sidecar_dir=args.sidecar, output_dir=args.output_dir)
+
+
+
+def run_score(args):
+	"""
+	Scores the quotes of a csv file and prints their predictions
+	"""
+	import ingestion
+	import predict
+	import result_writer
+	# the encoded columns are read as strings, as in the cache of the training set
+	data_f = ingestion.read_csv(args.csv, columns=predict.get_input_columns(),
+		schema=predict.get_input_schema())
+	predictions = predict.score_data(data_f)[args.model]
+	sys.stdout.write("QuoteNumber,QuoteConversion_Flag\n" + result_writer.join_fields([
+		result_writer.format_column(data_f.QuoteNumber.values),
+		result_writer.format_floats(predictions)]))
+
+
+
+def run_profile(args):
+	"""
+	Profiles a dataset (see data_profile.py), and renders its plots (see summary.py)
+	"""
+	if args.plots:
+		import summary
+		summary.summarize(args.tag)
+	else:
+		import data_profile
+		print data_profile.profile_data(args.tag).summary()
+
+
+
+def run_bench(args):
+	"""
+	Runs a benchmark
+	"""
+	if args.benchmark == 'perf':
+		import benchmark_perf
+		benchmark_perf.run_benchmarks(args.sizes or None)
+	elif args.benchmark == 'xgb':
+		import benchmark_xgb
+		benchmark_xgb.search()
+	elif args.benchmark == 'knn':
+		import benchmark_knn
+		benchmark_knn.benchmark()
+	elif args.benchmark == 'trees':
+		import benchmark_perf
+		benchmark_perf.benchmark_trees()
+	else:
+		import benchmark_perf
+		benchmark_perf.benchmark_startup()
+
+
+
+def run_daemon(args):
+	"""
+	Starts, stops or describes the daemon
+
+	Returns:
+		exit status (1 if the daemon is not running)
+	"""
+	if args.action == 'start':
+		return start_daemon()
+	response = send_request({'action': args.action})
+	if response is None:
+		print "Daemon not running"
+		return 1
+	if args.action == 'stop':
+		print "Daemon stopped"
+	else:
+		print "Daemon running (pid %d, up %.0fs, %d requests, warm-up %.1fs)" % (
+			response['pid'], time.time() - response['started'], response['requests'],
+			response['warm_up'])
+	return 0
+
+
+
+def get_parser():
+	"""
+	Returns:
+		argparse.ArgumentParser of the command line
+	"""
+	parser = argparse.ArgumentParser(prog='homesite.py',
+		description="Homesite quote conversion pipeline")
+	parser.add_argument('--local', action='store_true',
+		help="run the command in this process, even if the daemon is running")
+	commands = parser.add_subparsers(dest='command')
+
+	command = commands.add_parser('ingest', help="generate the caches of the datasets")
+	command.add_argument('tags', nargs='*', metavar='TAG',
+		help="base names of the datasets (train and test if no csv is appended)")
+	command.add_argument('--append', nargs='+', default=[], type=path.abspath,
+		metavar='CSV', help="csv files of new quotes, appended as partitions")
+	command.set_defaults(function=run_ingest)
+
+	command = commands.add_parser('train', help="train the classifiers")
+	command.add_argument('--force', action='store_true',
+		help="execute the cached stages again")
+	modes = command.add_mutually_exclusive_group()
+	modes.add_argument('--external', action='store_true', help="out-of-core training")
+	modes.add_argument('--refresh', action='store_true',
+		help="refresh the models with the new partitions")
+	command.set_defaults(function=run_train)
+
+	command = commands.add_parser('predict', help="score a dataset")
+	command.add_argument('tag', nargs='?', default='test', metavar='TAG')
+	command.add_argument('--gzip', action='store_true', help="compress the result files")
+	command.add_argument('--output-dir', type=path.abspath, metavar='DIR',
+		help="directory of the result files (results folder by default)")
+	command.add_argument('--sidecar', type=path.abspath, metavar='DIR',
+		help="directory of the binary sidecar of the predictions")
+	command.add_argument('--jobs', type=int, default=1, help="number of processes")
+	command.set_defaults(function=run_predict)
+
+	command = commands.add_parser('score', help="score the quotes of a csv file")
+	command.add_argument('csv', type=path.abspath, metavar='CSV')
+	command.add_argument('--model', choices=['xgb', 'knn', 'avg'], default='avg')
+	command.set_defaults(function=run_score)
+
+	command = commands.add_parser('profile', help="profile a dataset")
+	command.add_argument('tag', nargs='?', default='train', metavar='TAG')
+	command.add_argument('--plots', action='store_true',
+		help="describe the dataset and render its plots")
+	command.set_defaults(function=run_profile)
+
+	command = commands.add_parser('bench', help="run a benchmark")
+	command.add_argument('benchmark', choices=['perf', 'xgb', 'knn', 'startup', 'trees'])
+	command.add_argument('sizes', nargs='*', type=int, metavar='SIZE',
+		help="numbers of rows (perf)")
+	command.set_defaults(function=run_bench)
+
+	command = commands.add_parser('daemon', help="manage the warm daemon")
+	command.add_argument('action', choices=['start', 'stop', 'status'])
+	command.set_defaults(function=run_daemon)
+	return parser
+
+
+
+def get_sources_mtime():
+	"""
+	Returns:
+		last modification time of the source files
+	"""
+	return max(path.getmtime(source) for source in glob.glob(path.join(ROOT_DIR, '*.py')))
+
+
+
+def send_request(request, socket_path=DAEMON_SOCKET):
+	"""
+	Sends a request to the daemon and waits for its response
+
+	Args:
+		request (dict): request (action and arguments)
+		socket_path (str): unix socket of the daemon
+
+	Returns:
+		dict of the response (None if the daemon is not running)
+	"""
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(socket_path)
+	except socket.error:
+		client.close()
+		return None
+	try:
+		client.sendall(json.dumps(request) + '\n')
+		response = client.makefile('r').readline()
+	finally:
+		client.close()
+	return json.loads(response) if response else None
+
+
+
+def run_captured(function):
+	"""
+	Calls a function, capturing the output written to the standard output and error
+	(including the output of the C libraries and of the forked processes)
+
+	Args:
+		function (function): function to call
+
+	Returns:
+		captured output and exit status
+	"""
+	output = tempfile.TemporaryFile()
+	sys.stdout.flush()
+	sys.stderr.flush()
+	saved = [os.dup(1), os.dup(2)]
+	os.dup2(output.fileno(), 1)
+	os.dup2(output.fileno(), 2)
+	try:
+		status = function() or 0
+	except SystemExit as error:
+		status = error.code or 0
+	except Exception:
+		traceback.print_exc()
+		status = 1
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os.dup2(saved[0], 1)
+		os.dup2(saved[1], 2)
+		os.close(saved[0])
+		os.close(saved[1])
+	output.seek(0)
+	return output.read(), status
+
+
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+	"""
+	Handler of a request sent to the daemon
+	"""
+
+	def handle(self):
+		request = json.loads(self.rfile.readline())
+		self.wfile.write(json.dumps(self.server.daemon.execute(request)) + '\n')
+
+
+
+class Daemon(object):
+	"""
+	Warm process executing the commands (see module documentation)
+	"""
+
+	def __init__(self, socket_path=DAEMON_SOCKET):
+		self.socket_path = socket_path
+		self.started = time.time()
+		self.nb_requests = 0
+		self.warm_up_seconds = 0.
+		self.stopped = False
+
+	def warm_up(self):
+		"""
+		Imports the libraries, loads the models and keeps the feature store of the test
+		set in memory
+		"""
+		start = time.time()
+		# modules of the commands (imported once, by the daemon)
+		import file_handler as fh
+		import train_models
+		import predict
+		import result_writer
+		predict.KEEP_FEATURE_STORES = True
+		try:
+			if fh.find_cache_file('test') or path.exists(fh.get_csv_path('test')):
+				predict.get_feature_store('test')
+			else:
+				predict.load_scorers()
+		except Exception:
+			# models not trained yet: they are loaded by the first command using them
+			traceback.print_exc()
+		self.warm_up_seconds = time.time() - start
+		print "Daemon ready (warm-up %.1fs)" % self.warm_up_seconds
+
+	def reset_models(self):
+		"""
+		Removes the loaded models, so that the new versions are used
+		"""
+		if 'predict' in sys.modules:
+			sys.modules['predict'].scorers = None
+		if 'model_registry' in sys.modules:
+			sys.modules['model_registry'].registry.clear()
+
+	def execute(self, request):
+		"""
+		Executes a request
+
+		Args:
+			request (dict): action ('run', 'status' or 'stop'), arguments of the
+				command and working directory of the client ('run')
+
+		Returns:
+			dict of the response: output and exit status of the command ('run'),
+			counters ('status'), stale flag when the sources changed
+		"""
+		if request['action'] == 'status':
+			return {'pid': os.getpid(), 'started': self.started,
+				'requests': self.nb_requests, 'warm_up': self.warm_up_seconds}
+		if request['action'] == 'stop':
+			self.stopped = True
+			return {}
+		if get_sources_mtime() > self.started:
+			return {'stale': True}
+
+		self.nb_requests += 1
+		os.chdir(request['cwd'])
+		args = get_parser().parse_args(request['argv'])
+
+		def run():
+			# models retrained by another process (e.g train --local)
+			if 'predict' in sys.modules:
+				sys.modules['predict'].reload_scorers()
+			args.function(args)
+
+		output, status = run_captured(run)
+		if args.command in RELOAD_COMMANDS:
+			self.reset_models()
+		return {'output': output, 'status': status}
+
+	def serve(self):
+		"""
+		Warms up, then executes the requests until a stop request
+		"""
+		self.warm_up()
+		if path.exists(self.socket_path):
+			os.remove(self.socket_path)
+		server = SocketServer.UnixStreamServer(self.socket_path, DaemonHandler)
+		server.daemon = self
+		try:
+			while not self.stopped:
+				server.handle_request()
+		finally:
+			server.server_close()
+			os.remove(self.socket_path)
+
+
+
+def start_daemon():
+	"""
+	Starts the daemon in a detached process and waits until it is ready
+
+	Returns:
+		exit status (1 if the daemon did not start)
+	"""
+	if send_request({'action': 'status'}) is not None:
+		print "Daemon already running"
+		return 0
+	start = time.time()
+	if not path.exists(path.dirname(DAEMON_LOG)):
+		os.makedirs(path.dirname(DAEMON_LOG))
+	pid = os.fork()
+	if pid == 0:
+		# detached process (new session, second fork), output in the log file
+		os.setsid()
+		if os.fork() > 0:
+			os._exit(0)
+		log = open(DAEMON_LOG, 'a')
+		os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+		os.dup2(log.fileno(), 1)
+		os.dup2(log.fileno(), 2)
+		try:
+			Daemon().serve()
+		except Exception:
+			traceback.print_exc()
+		finally:
+			sys.stdout.flush()
+			os._exit(0)
+	os.waitpid(pid, 0)
+
+	while time.time() - start < DAEMON_TIMEOUT:
+		response = send_request({'action': 'status'})
+		if response is not None:
+			print "Daemon started (pid %d, %.1fs)" % (response['pid'], time.time() - start)
+			return 0
+		time.sleep(0.1)
+	print "Daemon not ready after %ds (see %s)" % (DAEMON_TIMEOUT, DAEMON_LOG)
+	return 1
+
+
+
+def main(argv):
+	"""
+	Runs a command, through the daemon when it is running (see module documentation)
+
+	Args:
+		argv (list): arguments of the command line
+
+	Returns:
+		exit status
+	"""
+	args = get_parser().parse_args(argv)
+	if args.command not in LOCAL_COMMANDS and not args.local:
+		response = send_request({'action': 'run', 'argv': argv, 'cwd': os.getcwd()})
+		if response is not None and response.get('stale'):
+			print "Sources changed since the daemon started, command run locally"
+		elif response is not None:
+			sys.stdout.write(response['output'])
+			return response['status']
+	return args.function(args) or 0
+
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,417 @@
+import pandas as pd
+import numpy as np
+import os
+import io
+import json
+import multiprocessing
+import profiling
+
+"""
+Library to read large csv files in parallel with compact dtypes.
+
+The file is split into byte ranges (aligned on line boundaries) which are parsed by a pool
+of processes. Each process downcasts its chunk before sending it back: integer columns get
+the narrowest integer type (int8/int16/int32/int64), float columns (and integer columns with
+missing values) are stored as float32 and object columns as categorical codes. The chunks
+are then merged column by column (widest dtype of the chunks, union of the categories), the
+parts of a column being released as soon as it is assembled, so that the final DataFrame is
+built without holding two copies of the data.
+
+A schema (dtype and categories of each column) can be extracted from a DataFrame with
+get_schema and saved as json. Giving a schema to read_csv enforces its dtypes (when the
+values fit) and its category order, which keeps the categorical codes of a new quote file
+consistent with the train set.
+
+Note: quoted fields spanning several lines are not supported (not used by the dataset).
+"""
+
+# size (in bytes) of the chunks of csv file parsed by each process
+CHUNK_SIZE = 16 << 20
+
+# float values are stored in this type
+FLOAT_DTYPE = np.float32
+
+
+def get_int_dtype(min_value, max_value):
+	"""
+	Returns the narrowest integer type that can hold the given range of values
+
+	Args:
+		min_value (int): minimum value
+		max_value (int): maximum value
+
+	Returns:
+		numpy dtype
+	"""
+	for dtype in [np.int8, np.int16, np.int32]:
+		info = np.iinfo(dtype)
+		if info.min <= min_value and max_value <= info.max:
+			return np.dtype(dtype)
+	return np.dtype(np.int64)
+
+
+
+def get_code_dtype(nb_categories):
+	"""
+	Returns the narrowest integer type for the codes of a categorical column
+	(-1 being used for missing values)
+
+	Args:
+		nb_categories (int): number of categories
+
+	Returns:
+		numpy dtype
+	"""
+	return get_int_dtype(-1, nb_categories)
+
+
+
+def split_csv(csv_path, chunk_size=CHUNK_SIZE):
+	"""
+	Splits a csv file into byte ranges of about chunk_size bytes, each range
+	starting at the beginning of a line
+
+	Args:
+		csv_path (str): path of the csv file
+		chunk_size (int): approximate size of the ranges
+
+	Returns:
+		header line (str) and list of (start, end) byte offsets
+	"""
+	file_size = os.path.getsize(csv_path)
+	ranges = []
+	with open(csv_path, 'rb') as f:
+		header = f.readline()
+		start = f.tell()
+		while start < file_size:
+			f.seek(min(start + chunk_size, file_size))
+			f.readline()
+			end = min(f.tell(), file_size)
+			ranges.append((start, end))
+			start = end
+	return header, ranges
+
+
+
+def compact_values(values):
+	"""
+	Converts an array of parsed values into its compact representation
+
+	Args:
+		values (np.array): values of a column, as parsed by pandas
+
+	Returns:
+		np.array of compact values and list of categories (None for
+		non categorical values)
+	"""
+	if values.dtype == object:
+		codes, categories = pd.factorize(values, sort=True)
+		return codes.astype(get_code_dtype(len(categories))), categories.tolist()
+	if values.dtype.kind in 'iu' and len(values) > 0:
+		return values.astype(get_int_dtype(values.min(), values.max())), None
+	if values.dtype.kind == 'f':
+		return values.astype(FLOAT_DTYPE), None
+	return values, None
+
+
+
+def format_category(value):
+	"""
+	Returns the field of a category: the value of a field parsed as a number by pandas
+	(e.g 965 or 965.0 for the field 965) is converted back to a string
+
+	Args:
+		value: category of a parsed chunk
+
+	Returns:
+		str
+	"""
+	if isinstance(value, basestring):
+		return value
+	if isinstance(value, (float, np.floating)) and float(value).is_integer():
+		return str(int(value))
+	return str(value)
+
+
+
+def parse_chunk(args):
+	"""
+	Parses a byte range of a csv file and returns its compacted columns.
+	Used by the processes of the pool
+
+	Args:
+		args (tuple): path of the csv file, header line, (start, end) offsets,
+			list of the columns to read (None for all) and list of the
+			columns to read as strings
+
+	Returns:
+		list of (column name, compact values, categories)
+	"""
+	csv_path, header, (start, end), columns, object_columns = args
+	with open(csv_path, 'rb') as f:
+		f.seek(start)
+		block = f.read(end - start)
+	dtypes = dict((col, object) for col in object_columns)
+	chunk = pd.read_csv(io.BytesIO(header + block), usecols=columns, dtype=dtypes)
+	del block
+
+	result = []
+	for col in chunk.columns:
+		values, categories = compact_values(chunk[col].values)
+		result.append((col, values, categories))
+	return result
+
+
+
+def merge_column(parts, schema_entry=None):
+	"""
+	Assembles the compact parts of a column parsed in different chunks. Numerical
+	parts are promoted to their widest type, categorical parts are re-encoded with
+	the union of their categories (schema categories first, if given)
+
+	Args:
+		parts (list): list of (values, categories) of each chunk
+		schema_entry (dict): description of the column in the schema (if any)
+
+	Returns:
+		np.array or pd.Categorical containing the column
+	"""
+	if all(categories is None for _, categories in parts) and \
+			(schema_entry is None or schema_entry['dtype'] != 'category'):
+		values = np.concatenate([values for values, _ in parts])
+		if schema_entry is not None:
+			values = cast_values(values, np.dtype(str(schema_entry['dtype'])))
+		return values
+
+	# a chunk where a categorical column only contains numbers (or missing
+	# values) is converted to categories, and the numbers are converted back to their
+	# fields, as in the chunks holding strings (the codes do not depend on the chunks)
+	parts = [(values, categories) if categories is not None
+		else compact_values(np.where(pd.isnull(values), None, values).astype(object))
+		for values, categories in parts]
+	parts = [(values, [format_category(category) for category in categories])
+		for values, categories in parts]
+
+	all_categories = set()
+	for _, categories in parts:
+		all_categories.update(categories)
+	merged = list(schema_entry['categories']) if schema_entry is not None else []
+	merged += sorted(all_categories.difference(merged))
+	positions = dict((category, i) for i, category in enumerate(merged))
+
+	code_dtype = get_code_dtype(len(merged))
+	codes = np.empty(sum(len(values) for values, _ in parts), dtype=code_dtype)
+	offset = 0
+	for values, categories in parts:
+		# local code -1 (missing) maps to the last item of the lookup, i.e -1
+		lookup = np.array([positions[c] for c in categories] + [-1], dtype=code_dtype)
+		codes[offset:offset + len(values)] = lookup[values]
+		offset += len(values)
+	return pd.Categorical.from_codes(codes, merged)
+
+
+
+def cast_values(values, dtype):
+	"""
+	Casts numerical values to the given dtype if it does not lose information
+
+	Args:
+		values (np.array): values to cast
+		dtype (np.dtype): target dtype
+
+	Returns:
+		np.array casted values (unchanged values if the cast loses information)
+	"""
+	if values.dtype == dtype:
+		return values
+	casted = values.astype(dtype)
+	if values.dtype.kind == 'f' and dtype.kind == 'f':
+		return casted
+	if np.array_equal(casted, values):
+		return casted
+	return values
+
+
+
+@profiling.profiled('read_csv')
+def read_csv(csv_path, columns=None, schema=None, n_jobs=None, chunk_size=CHUNK_SIZE):
+	"""
+	Reads a csv file in parallel and returns a DataFrame with compact dtypes
+	(see module documentation)
+
+	Args:
+		csv_path (str): path of the csv file
+		columns (list): names of the columns to read (all columns if None)
+		schema (dict): schema to enforce (see get_schema), None to infer the dtypes
+		n_jobs (int): number of processes (number of cpus if None)
+		chunk_size (int): size in bytes of the chunks parsed by each process
+
+	Returns:
+		Pandas DataFrame containing the data
+	"""
+	header, ranges = split_csv(csv_path, chunk_size)
+	schema_entries = {}
+	if schema is not None:
+		schema_entries = dict((entry['name'], entry) for entry in schema['columns'])
+	object_columns = get_categorical_columns(schema, columns)
+	tasks = [(csv_path, header, byte_range, columns, object_columns) for byte_range in ranges]
+
+	n_jobs = min(n_jobs or multiprocessing.cpu_count(), max(len(tasks), 1))
+	if n_jobs > 1:
+		pool = multiprocessing.Pool(n_jobs)
+		try:
+			chunks = pool.map(parse_chunk, tasks, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		chunks = [parse_chunk(task) for task in tasks]
+
+	if not chunks:
+		return pd.read_csv(io.BytesIO(header), usecols=columns)
+
+	names = [col for col, _, _ in chunks[0]]
+	data = pd.DataFrame(index=pd.RangeIndex(sum(len(chunk[0][1]) for chunk in chunks)))
+	for i, col in enumerate(names):
+		parts = [chunk[i][1:] for chunk in chunks]
+		# release the parts as soon as the column is assembled
+		for chunk in chunks:
+			chunk[i] = None
+		data[col] = merge_column(parts, schema_entries.get(col))
+		del parts
+	return data
+
+
+
+def get_schema(data_f):
+	"""
+	Extracts the schema of a DataFrame: dtype of each column, and categories of
+	the categorical columns
+
+	Args:
+		data_f (DataFrame): input Pandas DataFrame
+
+	Returns:
+		dict describing the columns (json serializable)
+	"""
+	columns = []
+	for col in data_f.columns:
+		entry = {'name': col, 'dtype': str(data_f[col].dtype)}
+		if entry['dtype'] == 'category':
+			entry['categories'] = data_f[col].cat.categories.tolist()
+		columns.append(entry)
+	return {'columns': columns}
+
+
+
+def get_categorical_columns(schema, columns=None):
+	"""
+	Returns the categorical columns of a schema (read as strings)
+
+	Args:
+		schema (dict): schema (see get_schema), or None
+		columns (list): names of the columns to read (all columns if None)
+
+	Returns:
+		list of the names of the categorical columns
+	"""
+	if schema is None:
+		return []
+	return [entry['name'] for entry in schema['columns'] if entry['dtype'] == 'category'
+		and (columns is None or entry['name'] in columns)]
+
+
+
+def get_categorical_schema(columns):
+	"""
+	Returns a schema reading the given columns as categories (the dtypes of the other
+	columns are inferred), e.g the columns encoded by a fitted preprocessing
+
+	Args:
+		columns (list): names of the categorical columns
+
+	Returns:
+		dict describing the columns
+	"""
+	return {'columns': [{'name': col, 'dtype': 'category', 'categories': []}
+		for col in sorted(columns)]}
+
+
+
+def infer_schema(csv_path, chunk_size=100000):
+	"""
+	Infers the schema of a csv file in a pass over chunks of rows (memory bounded): the
+	columns holding strings in any chunk are categorical, the other ones are numerical
+	(float32 if they hold floats or missing values in any chunk)
+
+	Args:
+		csv_path (str): path of the csv file
+		chunk_size (int): number of rows of the chunks
+
+	Returns:
+		dict describing the columns (without the categories)
+	"""
+	dtypes = {}
+	names = []
+	for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+		for col in chunk.columns:
+			kind = chunk[col].dtype.kind
+			previous = dtypes.get(col, kind)
+			dtypes[col] = 'O' if 'O' in (kind, previous) else 'f' if 'f' in (kind, previous) \
+				else kind
+		names = list(chunk.columns)
+	columns = []
+	for col in names:
+		if dtypes[col] == 'O':
+			columns.append({'name': col, 'dtype': 'category', 'categories': []})
+		else:
+			columns.append({'name': col, 'dtype': str(np.dtype(FLOAT_DTYPE))
+				if dtypes[col] == 'f' else 'int64'})
+	return {'columns': columns}
+
+
+
+def get_csv_dtypes(schema, columns=None):
+	"""
+	Returns the dtypes of the columns of a csv file read with pd.read_csv, so that all
+	the chunks of a file are read with the same dtypes: categorical columns as strings
+	and float columns as floats (the dtypes of the other columns are inferred)
+
+	Args:
+		schema (dict): schema (see get_schema)
+		columns (list): names of the columns to read (all columns if None)
+
+	Returns:
+		dict: name of the column -> dtype
+	"""
+	dtypes = dict((col, object) for col in get_categorical_columns(schema, columns))
+	for entry in schema['columns']:
+		if entry['dtype'].startswith('float') and (columns is None or entry['name'] in columns):
+			dtypes[entry['name']] = np.dtype(entry['dtype'])
+	return dtypes
+
+
+
+def save_schema(schema_path, schema):
+	"""
+	Saves a schema in a json file
+
+	Args:
+		schema_path (str): path of the json file
+		schema (dict): schema returned by get_schema
+	"""
+	json.dump(schema, open(schema_path, 'w'), indent=1)
+
+
+
+def load_schema(schema_path):
+	"""
+	Loads a schema from a json file
+
+	Args:
+		schema_path (str): path of the json file
+
+	Returns:
+		dict describing the columns
+	"""
+	return json.load(open(schema_path, 'r'))
@@ -0,0 +1,318 @@
+import numpy as np
+import os, os.path as path
+import json
+import shutil
+from multiprocessing.pool import ThreadPool
+from sklearn.neighbors import KDTree
+import file_handler as fh
+
+"""
+Library providing the neighbor index used by the KNN classifier.
+
+KNNIndex stores on disk (in models/<name>.knn):
+- meta.json: features, parameters of the min-max scaler and number of neighbors
+- points.npy: the scaled reference points, as a contiguous float32 array (memory-mapped
+  when loading)
+- labels.npy: the target values of the reference points
+Only numpy arrays and json are stored (no pickled sklearn object), so that an index can be
+loaded with other versions of the libraries. Loading an index only reads the meta file: the
+points are memory-mapped and the KD-tree is built from them on the first query. The
+probability of a query point is the ratio of positive labels among its k nearest neighbors
+(same as KNeighborsClassifier.predict_proba with uniform weights). Batches of queries are
+split between threads.
+
+New reference points are added with extend (see refresh.py): they are scaled with the
+existing scaler and kept in a delta set (delta_points.npy, delta_labels.npy), searched with
+its own small KD-tree, the neighbors of both sets being merged by distance. The delta set is
+merged into the main points (and the tree rebuilt) when it exceeds REBUILD_RATIO times the
+main points. When an extended index is saved, the unchanged files of the main points are
+hard-linked from the directory it was loaded from instead of being written again, so that
+the cost of a refresh depends on the number of new points.
+"""
+
+# size of the delta set (relative to the main points) triggering a rebuild of the tree
+REBUILD_RATIO = 0.1
+
+
+class KNNIndex(object):
+	"""
+	Persisted, memory-mapped k-nearest neighbors index (see module documentation)
+	"""
+
+	def __init__(self, n_neighbors=50, leaf_size=40):
+		self.n_neighbors = n_neighbors
+		self.leaf_size = leaf_size
+		self.features = None
+		self.min_values = None
+		self.ranges = None
+		self.points = None
+		self.labels = None
+		self._tree = None
+		self.delta_points = None
+		self.delta_labels = None
+		self._delta_tree = None
+		self.source_dir = None
+
+	def fit(self, X, y, features=None):
+		"""
+		Fits the min-max scaler, stores the scaled reference points and builds the tree
+
+		Args:
+			X (DataFrame, FeatureStore or np.array): reference points
+			y (np.array): target values (0 or 1)
+			features (list): names of the features to use when X is a DataFrame
+				(all its columns if None)
+
+		Returns:
+			the fitted KNNIndex
+		"""
+		if hasattr(X, 'get_matrix'):
+			# only the knn features are gathered from the store (see feature_store.py)
+			self.features = list(features or X.columns)
+			X = X.get_matrix(self.features)
+		elif hasattr(X, 'columns'):
+			self.features = list(features or X.columns)
+			X = X.loc[:, self.features].values
+		X = np.asarray(X, dtype=np.float64)
+		self.min_values = X.min(axis=0)
+		ranges = X.max(axis=0) - self.min_values
+		# constant features are left unscaled
+		self.ranges = np.where(ranges > 0, ranges, 1.)
+		self.points = np.ascontiguousarray(self.scale(X), dtype=np.float32)
+		self.labels = np.asarray(y, dtype=np.int8)
+		self._tree = KDTree(self.points, leaf_size=self.leaf_size)
+		self.delta_points = self.delta_labels = self._delta_tree = None
+		self.source_dir = None
+		return self
+
+	def extend(self, X, y):
+		"""
+		Adds reference points to the index (see module documentation). The scaler is
+		not refitted, so that the existing points are unchanged
+
+		Args:
+			X (DataFrame, FeatureStore or np.array): new reference points
+			y (np.array): target values (0 or 1)
+
+		Returns:
+			the extended KNNIndex
+		"""
+		points = np.ascontiguousarray(self.scale(X), dtype=np.float32)
+		labels = np.asarray(y, dtype=np.int8)
+		if self.delta_points is not None:
+			points = np.vstack((self.delta_points, points))
+			labels = np.concatenate((self.delta_labels, labels))
+		self.delta_points, self.delta_labels, self._delta_tree = points, labels, None
+
+		if len(self.delta_points) > REBUILD_RATIO * len(self.points):
+			print "Rebuild knn index (%d + %d points)" % (len(self.points), len(points))
+			self.points = np.vstack((self.points, self.delta_points))
+			self.labels = np.concatenate((self.labels, self.delta_labels))
+			self._tree = KDTree(self.points, leaf_size=self.leaf_size)
+			self.delta_points = self.delta_labels = None
+			self.source_dir = None
+		return self
+
+	def get_labels(self):
+		"""
+		Returns:
+			np.array of the labels of the main points followed by the labels of the
+			delta points (indexed by kneighbors)
+		"""
+		if self.delta_labels is None:
+			return self.labels
+		return np.concatenate((self.labels, self.delta_labels))
+
+	def scale(self, X):
+		"""
+		Applies the min-max scaler fitted on the reference points
+
+		Args:
+			X (DataFrame, FeatureStore or np.array): points to scale
+
+		Returns:
+			np.array of the scaled points (float64)
+		"""
+		if hasattr(X, 'get_matrix'):
+			X = X.get_matrix(self.features)
+		elif hasattr(X, 'columns'):
+			X = X.loc[:, self.features].values
+		return (np.asarray(X, dtype=np.float64) - self.min_values) / self.ranges
+
+	@property
+	def tree(self):
+		"""
+		KD-tree of the reference points (built on first access)
+		"""
+		if self._tree is None:
+			self._tree = KDTree(self.points, leaf_size=self.leaf_size)
+		return self._tree
+
+	@property
+	def delta_tree(self):
+		"""
+		KD-tree of the delta points (built on first access)
+		"""
+		if self._delta_tree is None:
+			self._delta_tree = KDTree(self.delta_points, leaf_size=self.leaf_size)
+		return self._delta_tree
+
+	def query(self, X, n_neighbors):
+		"""
+		Finds the nearest reference points of scaled points, in the main points and
+		in the delta points
+
+		Args:
+			X (np.array): scaled query points
+			n_neighbors (int): number of neighbors
+
+		Returns:
+			np.array (n_points, n_neighbors) of the indices of the neighbors (delta
+			points are numbered after the main points), sorted by distance
+		"""
+		if self.delta_points is None:
+			return self.tree.query(X, n_neighbors, return_distance=False)
+		distances, neighbors = self.tree.query(X, n_neighbors)
+		delta_distances, delta_neighbors = self.delta_tree.query(X,
+			min(n_neighbors, len(self.delta_points)))
+		distances = np.hstack((distances, delta_distances))
+		neighbors = np.hstack((neighbors, delta_neighbors + len(self.points)))
+		order = np.argsort(distances, axis=1, kind='mergesort')[:, :n_neighbors]
+		return neighbors[np.arange(len(X))[:, np.newaxis], order]
+
+	def kneighbors(self, X, n_neighbors=None, n_jobs=1):
+		"""
+		Finds the nearest reference points of the given points
+
+		Args:
+			X (DataFrame, FeatureStore or np.array): query points (not scaled)
+			n_neighbors (int): number of neighbors (self.n_neighbors if None)
+			n_jobs (int): number of threads sharing the queries
+
+		Returns:
+			np.array (n_points, n_neighbors) of the indices of the neighbors,
+			sorted by distance
+		"""
+		n_neighbors = n_neighbors or self.n_neighbors
+		X = self.scale(X)
+		# the trees are loaded before the threads start
+		self.tree
+		if self.delta_points is not None:
+			self.delta_tree
+		query = lambda batch: self.query(batch, n_neighbors)
+		if n_jobs <= 1 or len(X) < 2 * n_jobs:
+			return query(X)
+		pool = ThreadPool(n_jobs)
+		try:
+			return np.vstack(pool.map(query, np.array_split(X, n_jobs)))
+		finally:
+			pool.close()
+
+	def predict_proba(self, X, n_jobs=1):
+		"""
+		Probability of each class: ratio of labels among the nearest neighbors
+
+		Args:
+			X (DataFrame, FeatureStore or np.array): query points (not scaled)
+			n_jobs (int): number of threads sharing the queries
+
+		Returns:
+			np.array (n_points, 2) of the probabilities of the classes 0 and 1
+		"""
+		neighbors = self.kneighbors(X, n_jobs=n_jobs)
+		proba = self.get_labels()[neighbors].mean(axis=1)
+		return np.column_stack((1 - proba, proba))
+
+	def save(self, name):
+		"""
+		Saves the index in models/<name>.knn
+
+		Args:
+			name (str): name of the index
+		"""
+		self.save_dir(fh.get_index_path(name))
+
+	def save_dir(self, index_dir):
+		"""
+		Saves the index in the given directory (overridden if it exists)
+
+		Args:
+			index_dir (str): path of the directory
+		"""
+		print "Generate knn index: " + index_dir
+		tmp_dir = index_dir + '.tmp'
+		fh.remove_cache_file(tmp_dir)
+		os.makedirs(tmp_dir)
+
+		if self.source_dir is not None and path.abspath(self.source_dir) != path.abspath(index_dir):
+			# main points unchanged since loading: the files are shared
+			for file_name in ['points.npy', 'labels.npy']:
+				link_file(path.join(self.source_dir, file_name), path.join(tmp_dir, file_name))
+		else:
+			np.save(path.join(tmp_dir, 'points.npy'), self.points)
+			np.save(path.join(tmp_dir, 'labels.npy'), self.labels)
+		if self.delta_points is not None:
+			np.save(path.join(tmp_dir, 'delta_points.npy'), self.delta_points)
+			np.save(path.join(tmp_dir, 'delta_labels.npy'), self.delta_labels)
+		meta = {'n_neighbors': self.n_neighbors, 'leaf_size': self.leaf_size,
+			'features': self.features, 'min_values': self.min_values.tolist(),
+			'ranges': self.ranges.tolist()}
+		json.dump(meta, open(path.join(tmp_dir, 'meta.json'), 'w'))
+
+		if path.exists(index_dir):
+			print "Remove current index..."
+			shutil.rmtree(index_dir)
+		os.rename(tmp_dir, index_dir)
+
+	@classmethod
+	def load(cls, name):
+		"""
+		Loads an index saved in models/<name>.knn (the points are memory-mapped and
+		the tree is built on the first query)
+
+		Args:
+			name (str): name of the index
+
+		Returns:
+			KNNIndex
+		"""
+		return cls.load_dir(fh.get_index_path(name))
+
+	@classmethod
+	def load_dir(cls, index_dir):
+		"""
+		Loads an index saved in the given directory (see load)
+
+		Args:
+			index_dir (str): path of the directory
+
+		Returns:
+			KNNIndex
+		"""
+		meta = json.load(open(path.join(index_dir, 'meta.json'), 'r'))
+		index = cls(meta['n_neighbors'], meta['leaf_size'])
+		index.features = meta['features']
+		index.min_values = np.array(meta['min_values'])
+		index.ranges = np.array(meta['ranges'])
+		index.points = np.load(path.join(index_dir, 'points.npy'), mmap_mode='r')
+		index.labels = np.load(path.join(index_dir, 'labels.npy'))
+		if path.exists(path.join(index_dir, 'delta_points.npy')):
+			index.delta_points = np.load(path.join(index_dir, 'delta_points.npy'))
+			index.delta_labels = np.load(path.join(index_dir, 'delta_labels.npy'))
+		index.source_dir = index_dir
+		return index
+
+
+
+def link_file(source_path, link_path):
+	"""
+	Hard-links a file (copies it if the file system does not support links)
+
+	Args:
+		source_path (str): path of the existing file
+		link_path (str): path of the link to create
+	"""
+	try:
+		os.link(source_path, link_path)
+	except OSError:
+		shutil.copyfile(source_path, link_path)
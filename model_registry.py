@@ -0,0 +1,314 @@
+import numpy as np
+import os, os.path as path
+import json
+import shutil
+import time
+import threading
+from collections import OrderedDict
+import xgboost as xgb
+import utils
+import file_handler as fh
+import profiling
+from knn_index import KNNIndex
+import tree_ensemble
+
+"""
+Library handling the versioned model artifacts and the process-wide model registry.
+
+An artifact is a directory models/<name>/<version> (versions are increasing integers)
+holding the model in a native format and a manifest.json describing it:
+- xgb models: the booster in the xgboost binary format (booster.bin) and its trees
+  exported as flat arrays (trees, see tree_ensemble.py), written when the export matches
+  the probabilities of xgboost
+- knn models: the raw arrays of the index (see knn_index.py)
+- manifest: kind of model, feature order, parameters, fitted preprocessing (including
+  the encoder vocabularies), fingerprint of the training data, creation date and the
+  partitions the model was trained on (refreshed models, see refresh.py)
+Artifacts do not depend on pickled sklearn/xgboost wrappers, so that they can be loaded
+with other versions of the libraries.
+
+The registry lazily loads the artifacts and keeps the most recently used ones in memory
+(LRU eviction), so that a model is deserialized once per process.
+
+Batches of at most TREES_MAX_ROWS rows are scored by the exported trees of the xgb models,
+without the xgboost wrapper (larger batches are scored by xgboost, which is multi-threaded).
+"""
+
+# number of versions kept on disk for each model
+KEEP_VERSIONS = 5
+
+# number of artifacts kept in memory by the registry
+REGISTRY_SIZE = 4
+
+# maximum number of rows of the batches scored by the exported trees (None: all the batches)
+TREES_MAX_ROWS = 10000
+
+
+class BoosterModel(object):
+	"""
+	XGBoost booster with the predict_proba interface of XGBClassifier
+	"""
+
+	def __init__(self, booster, features, ensemble=None):
+		"""
+		Args:
+			booster (xgb.Booster): trained booster
+			features (list): names of the features, in the order of the training matrix
+			ensemble (tree_ensemble.TreeEnsemble): trees exported from the booster (optional)
+		"""
+		self.booster = booster
+		self.features = features
+		self.ensemble = ensemble
+
+	def get_matrix(self, X):
+		"""
+		Args:
+			X (DataFrame, FeatureStore or np.array): feature matrix
+
+		Returns:
+			np.array of float32, columns in the order of the training matrix
+		"""
+		if hasattr(X, 'get_matrix'):
+			return X.get_matrix(self.features)
+		if hasattr(X, 'columns'):
+			X = X.loc[:, self.features].values
+		return np.asarray(X, dtype=np.float32)
+
+	def predict_proba(self, X):
+		"""
+		Args:
+			X (DataFrame, FeatureStore or np.array): feature matrix (columns are
+				reordered as at training time)
+
+		Returns:
+			np.array (n_rows, 2) of the probabilities of the classes 0 and 1
+		"""
+		if self.ensemble is not None and (TREES_MAX_ROWS is None or len(X) <= TREES_MAX_ROWS):
+			# the exported trees are evaluated without the xgboost wrapper
+			proba = self.ensemble.predict(self.get_matrix(X))
+		elif hasattr(X, 'get_dmatrix'):
+			# the DMatrix is built from the buffer of the store (see feature_store.py)
+			proba = self.booster.predict(X.get_dmatrix(self.features,
+				feature_names=self.booster.feature_names))
+		else:
+			proba = self.booster.predict(xgb.DMatrix(self.get_matrix(X),
+				feature_names=self.booster.feature_names))
+		return np.column_stack((1 - proba, proba))
+
+
+
+class ModelArtifact(object):
+	"""
+	Loaded artifact: manifest, model and fitted preprocessing
+	"""
+
+	def __init__(self, name, version, manifest, model):
+		self.name = name
+		self.version = version
+		self.manifest = manifest
+		self.model = model
+		self._preprocessor = None
+
+	@property
+	def preprocessor(self):
+		"""
+		Fitted utils.Preprocessor of the training data (None if not recorded)
+		"""
+		if self._preprocessor is None and self.manifest.get('preprocessing') is not None:
+			self._preprocessor = utils.Preprocessor.from_dict(self.manifest['preprocessing'])
+		return self._preprocessor
+
+	def predict_proba(self, X):
+		return self.model.predict_proba(X)
+
+
+
+def list_versions(name):
+	"""
+	Returns the versions of the artifacts of a model
+
+	Args:
+		name (str): name of the model
+
+	Returns:
+		sorted list of versions (int)
+	"""
+	model_dir = fh.get_artifact_path(name)
+	if not path.isdir(model_dir):
+		return []
+	return sorted(int(entry) for entry in os.listdir(model_dir) if entry.isdigit()
+		and path.exists(path.join(model_dir, entry, 'manifest.json')))
+
+
+
+@profiling.profiled()
+def export_trees(booster, features, trees_dir):
+	"""
+	Exports the trees of a booster as flat arrays (see tree_ensemble.py). The trees are
+	only saved if their probabilities match the ones of xgboost
+
+	Args:
+		booster (xgb.Booster): trained booster
+		features (list): names of the features, in the order of the training matrix
+		trees_dir (str): directory of the exported trees
+
+	Returns:
+		True if the trees were saved
+	"""
+	ensemble = tree_ensemble.TreeEnsemble.from_booster(booster, features)
+	error = ensemble.verify(booster)
+	if error > tree_ensemble.TOLERANCE:
+		print "Exported trees differ from xgboost (%g), not saved" % error
+		return False
+	ensemble.save_dir(trees_dir)
+	return True
+
+
+
+@profiling.profiled()
+def save_artifact(name, model, features, parameters=None, preprocessing=None,
+		data_fingerprint=None, metadata=None):
+	"""
+	Saves a model as a new version of its artifact. Only the last KEEP_VERSIONS
+	versions are kept
+
+	Args:
+		name (str): name of the model
+		model (object): fitted XGBClassifier, xgb.Booster or KNNIndex
+		features (list): names of the features, in the order of the training matrix
+		parameters (dict): parameters of the model
+		preprocessing (dict): fitted state of the preprocessing (Preprocessor.to_dict())
+		data_fingerprint (str): fingerprint of the training data
+		metadata (dict): additional entries of the manifest (e.g the trained partitions,
+			see refresh.py)
+
+	Returns:
+		version of the artifact (int)
+	"""
+	versions = list_versions(name)
+	version = versions[-1] + 1 if versions else 1
+	artifact_dir = fh.get_artifact_path(name, version)
+	print "Generate model artifact: " + artifact_dir
+	tmp_dir = artifact_dir + '.tmp'
+	fh.remove_cache_file(tmp_dir)
+	os.makedirs(tmp_dir)
+
+	if isinstance(model, KNNIndex):
+		kind = 'knn'
+		model.save_dir(path.join(tmp_dir, 'knn'))
+	else:
+		kind = 'xgb'
+		if isinstance(model, xgb.XGBModel):
+			model = model.get_booster() if hasattr(model, 'get_booster') else model.booster()
+		model.save_model(path.join(tmp_dir, 'booster.bin'))
+		export_trees(model, features, path.join(tmp_dir, 'trees'))
+
+	manifest = {'name': name, 'version': version, 'kind': kind, 'features': list(features),
+		'parameters': parameters, 'preprocessing': preprocessing,
+		'data_fingerprint': data_fingerprint, 'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+	manifest.update(metadata or {})
+	json.dump(manifest, open(path.join(tmp_dir, 'manifest.json'), 'w'))
+	os.rename(tmp_dir, artifact_dir)
+
+	for old_version in versions[:max(len(versions) + 1 - KEEP_VERSIONS, 0)]:
+		shutil.rmtree(fh.get_artifact_path(name, old_version))
+	return version
+
+
+
+@profiling.profiled()
+def load_artifact(name, version=None):
+	"""
+	Loads an artifact from disk (use the registry to avoid loading it twice)
+
+	Args:
+		name (str): name of the model
+		version (int): version of the artifact (latest if None)
+
+	Returns:
+		ModelArtifact
+	Raises:
+		Exception if the artifact does not exist
+	"""
+	if version is None:
+		versions = list_versions(name)
+		if not versions:
+			raise Exception("No artifact found for model: " + name)
+		version = versions[-1]
+	artifact_dir = fh.get_artifact_path(name, version)
+	manifest = json.load(open(path.join(artifact_dir, 'manifest.json'), 'r'))
+
+	if manifest['kind'] == 'knn':
+		model = KNNIndex.load_dir(path.join(artifact_dir, 'knn'))
+	else:
+		booster = xgb.Booster(model_file=path.join(artifact_dir, 'booster.bin'))
+		trees_dir = path.join(artifact_dir, 'trees')
+		ensemble = None
+		if path.exists(trees_dir):
+			ensemble = tree_ensemble.TreeEnsemble.load_dir(trees_dir)
+		model = BoosterModel(booster, manifest['features'], ensemble)
+	return ModelArtifact(name, version, manifest, model)
+
+
+
+class ModelRegistry(object):
+	"""
+	Process-wide cache of the loaded artifacts, with LRU eviction
+	"""
+
+	def __init__(self, max_size=REGISTRY_SIZE):
+		self.max_size = max_size
+		self.artifacts = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, name, version=None):
+		"""
+		Returns an artifact, loading it if it is not in memory
+
+		Args:
+			name (str): name of the model
+			version (int): version of the artifact (latest if None)
+
+		Returns:
+			ModelArtifact
+		"""
+		if version is None:
+			versions = list_versions(name)
+			version = versions[-1] if versions else None
+		key = (name, version)
+		with self.lock:
+			if key in self.artifacts:
+				self.artifacts[key] = self.artifacts.pop(key)
+				return self.artifacts[key]
+		artifact = load_artifact(name, version)
+		with self.lock:
+			self.artifacts[key] = artifact
+			while len(self.artifacts) > self.max_size:
+				self.artifacts.popitem(last=False)
+		return artifact
+
+	def clear(self):
+		"""
+		Removes all the artifacts from memory
+		"""
+		with self.lock:
+			self.artifacts.clear()
+
+
+
+# registry of the process
+registry = ModelRegistry()
+
+
+def get_artifact(name, version=None):
+	"""
+	Returns an artifact from the registry of the process
+
+	Args:
+		name (str): name of the model
+		version (int): version of the artifact (latest if None)
+
+	Returns:
+		ModelArtifact
+	"""
+	return registry.get(name, version)
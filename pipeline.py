@@ -0,0 +1,363 @@
+import os.path as path
+import json
+import hashlib
+import time
+import threading
+import traceback
+import multiprocessing
+import Queue
+from collections import OrderedDict
+import file_handler as fh
+import profiling
+
+"""
+Library providing a scheduler of the pipeline stages, described as a DAG of tasks (see
+train_models.py).
+
+A task is a function called with the outputs of its input tasks (in order). Pipeline.run
+executes the tasks needed to produce the requested outputs:
+- each task has a key: hash of its name, of the source code of its module (see
+  file_handler.get_transform_fingerprint), of the keys of its inputs and of its own key
+  items (e.g the fingerprint of the data it loads, the parameters of a model). The outputs
+  are cached as derived data (data/cache/derived/<task name>-<key>): a task is only
+  executed when its key changed, i.e when its code or one of its inputs changed, or when
+  its cached output is no longer valid (valid option, e.g a removed model artifact), and
+  the outputs of its inputs are then computed or read from the cache
+- a task is started as soon as its inputs are available, so that independent tasks run
+  at the same time: in a thread (loading, preprocessing: the I/O and most numpy/pandas
+  operations release the GIL) or in a separate process (process=True, e.g the training
+  of a model). The inputs of a process task are inherited by fork and its output is sent
+  back through a pipe. The OpenMP runtime of xgboost is not fork-safe once its threads
+  exist: every task calling xgboost must be a process task, so that the scheduler process
+  never starts them before forking
+- process tasks are called with an nthread argument: the N_CORES cores are allotted to
+  the process tasks of the run which can run at the same time, a task declaring a number
+  of threads gets it and the others (threads=None) share the remaining cores, so that
+  concurrent trainings do not oversubscribe the cores
+The outputs of the tasks are released as soon as no pending task needs them.
+"""
+
+# number of cores allotted to the process tasks
+N_CORES = multiprocessing.cpu_count()
+
+
+class Task(object):
+	"""
+	Stage of a pipeline (see module documentation)
+	"""
+
+	def __init__(self, name, function, inputs=(), key_items=(), key=None, cache=True,
+			process=False, threads=1, valid=None):
+		"""
+		Args:
+			name (str): name of the task (name of its derived data)
+			function (function): function called with the outputs of the inputs
+			inputs (list): names of the input tasks
+			key_items (list): json serializable items identifying the task, besides
+				its code and its inputs
+			key (str): key of the task (computed if None), e.g to share the derived
+				data of file_handler.load_derived_data
+			cache (bool): indicates if the output is cached
+			process (bool): indicates if the task runs in a separate process
+			threads (int): number of threads of a process task (None for a share of
+				the remaining cores)
+			valid (function): function called with the cached output, returning False
+				if it is outdated and the task must be executed again (always valid if
+				None)
+		"""
+		self.name = name
+		self.function = function
+		self.inputs = list(inputs)
+		self.key_items = list(key_items)
+		self.key = key
+		self.cache = cache
+		self.process = process
+		self.threads = threads
+		self.valid = valid
+
+
+
+def run_process(function, args, nthread):
+	"""
+	Calls a function in a forked process
+
+	Args:
+		function (function): function to call
+		args (list): positional arguments
+		nthread (int): number of threads allotted to the function (nthread argument)
+
+	Returns:
+		output of the function (sent back pickled)
+	Raises:
+		Exception if the function failed
+	"""
+	receiver, sender = multiprocessing.Pipe(False)
+	process = multiprocessing.Process(target=process_main, args=(sender, function, args,
+		nthread))
+	process.start()
+	sender.close()
+	try:
+		status, output = receiver.recv()
+	except EOFError:
+		status, output = 'error', "Process exited with code %s" % process.exitcode
+	process.join()
+	if status == 'error':
+		raise Exception(output)
+	return output
+
+
+
+def process_main(sender, function, args, nthread):
+	"""
+	Main function of the process of a task: sends the output of the task, or the
+	traceback of its failure
+
+	Args:
+		sender (Connection): end of the pipe to the scheduler
+		function (function): function of the task
+		args (list): outputs of the inputs of the task
+		nthread (int): number of threads allotted to the task
+	"""
+	# stages run in the child processes are not recorded
+	profiling.disable()
+	try:
+		sender.send(('ok', function(*args, nthread=nthread)))
+	except Exception:
+		sender.send(('error', traceback.format_exc()))
+	finally:
+		sender.close()
+
+
+
+class Pipeline(object):
+	"""
+	DAG of tasks with cached outputs (see module documentation)
+	"""
+
+	def __init__(self, n_cores=N_CORES):
+		self.n_cores = n_cores
+		self.tasks = OrderedDict()
+		self.timings = {}
+
+	def add(self, name, function, inputs=(), **options):
+		"""
+		Adds a task to the pipeline (its inputs must have been added before)
+
+		Args:
+			name (str): name of the task
+			function (function): function called with the outputs of the inputs
+			inputs (list): names of the input tasks
+			options: other arguments of Task
+
+		Returns:
+			the Pipeline
+		Raises:
+			Exception if an input task is unknown
+		"""
+		for input_name in inputs:
+			if input_name not in self.tasks:
+				raise Exception("Unknown input task of %s: %s" % (name, input_name))
+		self.tasks[name] = Task(name, function, inputs, **options)
+		return self
+
+	def get_keys(self):
+		"""
+		Returns:
+			dict: name of the task -> key of its output
+		"""
+		keys = {}
+		for name, task in self.tasks.items():
+			if task.key is not None:
+				keys[name] = task.key
+				continue
+			content = json.dumps([name, fh.get_transform_fingerprint(task.function),
+				[keys[input_name] for input_name in task.inputs], task.key_items],
+				sort_keys=True)
+			keys[name] = hashlib.sha1(content).hexdigest()[:16]
+		return keys
+
+	def is_cached(self, name, key):
+		"""
+		Args:
+			name (str): name of the task
+			key (str): key of its output
+
+		Returns:
+			True if the output of the task is cached and valid
+		"""
+		task = self.tasks[name]
+		derived_path = fh.get_derived_path(name, key)
+		if not task.cache or not path.exists(path.join(derived_path, fh.DERIVED_MANIFEST)):
+			return False
+		return task.valid is None or task.valid(fh.read_derived_data(derived_path))
+
+	def get_ancestors(self, name):
+		"""
+		Args:
+			name (str): name of the task
+
+		Returns:
+			set of the names of the tasks whose output the task needs, directly or not
+		"""
+		ancestors = set()
+		stack = list(self.tasks[name].inputs)
+		while stack:
+			input_name = stack.pop()
+			if input_name not in ancestors:
+				ancestors.add(input_name)
+				stack.extend(self.tasks[input_name].inputs)
+		return ancestors
+
+	def plan(self, targets, keys, force=False):
+		"""
+		Returns the actions needed to produce the outputs of the targets
+
+		Args:
+			targets (list): names of the requested tasks
+			keys (dict): keys of the tasks (see get_keys)
+			force (bool): indicates if the cached outputs must be ignored
+
+		Returns:
+			dict: name of the task -> 'run' (execute the task) or 'load' (read its
+			output from the cache)
+		"""
+		actions = {}
+		stack = list(targets)
+		while stack:
+			name = stack.pop()
+			if name in actions:
+				continue
+			if not force and self.is_cached(name, keys[name]):
+				actions[name] = 'load'
+			else:
+				actions[name] = 'run'
+				stack.extend(self.tasks[name].inputs)
+		return actions
+
+	def allot_threads(self, actions):
+		"""
+		Allots the cores to the process tasks which are executed (see module
+		documentation): a task shares the cores with the process tasks which are
+		neither its ancestors nor its descendants
+
+		Args:
+			actions (dict): actions of the run (see plan)
+
+		Returns:
+			dict: name of the process task -> number of threads
+		"""
+		tasks = [task for name, task in self.tasks.items()
+			if actions.get(name) == 'run' and task.process]
+		ancestors = dict((task.name, self.get_ancestors(task.name)) for task in tasks)
+		threads = {}
+		for task in tasks:
+			if task.threads:
+				threads[task.name] = task.threads
+				continue
+			concurrent = [other for other in tasks if other.name not in ancestors[task.name]
+				and task.name not in ancestors[other.name]]
+			fixed = sum(other.threads for other in concurrent if other.threads)
+			nb_shared = len([other for other in concurrent if not other.threads])
+			threads[task.name] = max(1, (self.n_cores - fixed) // max(nb_shared, 1))
+		return threads
+
+	def execute(self, name, key, action, args, nthread, events):
+		"""
+		Executes a task or loads its output from the cache, and reports the result
+		in events. Called in a thread
+
+		Args:
+			name (str): name of the task
+			key (str): key of its output
+			action (str): 'run' or 'load'
+			args (list): outputs of the inputs ('run' action)
+			nthread (int): number of threads of a process task
+			events (Queue): queue receiving (name, output, traceback of the failure)
+		"""
+		task = self.tasks[name]
+		derived_path = fh.get_derived_path(name, key)
+		start = time.time()
+		try:
+			if action == 'load':
+				output = fh.read_derived_data(derived_path)
+			else:
+				print "Run task: %s%s" % (name, " (%d threads)" % nthread if nthread else "")
+				with profiling.stage('task.' + name):
+					if task.process:
+						output = run_process(task.function, args, nthread)
+					else:
+						output = task.function(*args)
+				if task.cache:
+					fh.evict_derived_data(name)
+					fh.write_derived_data(derived_path, output)
+			self.timings[name] = (action, time.time() - start)
+			events.put((name, output, None))
+		except Exception:
+			events.put((name, None, traceback.format_exc()))
+
+	def run(self, targets=None, force=False):
+		"""
+		Produces the outputs of the targets, executing the tasks whose output is not
+		cached (see module documentation)
+
+		Args:
+			targets (list): names of the requested tasks (tasks which are not the
+				input of another task if None)
+			force (bool): indicates if the cached outputs must be ignored
+
+		Returns:
+			dict: name of the target -> output
+		Raises:
+			Exception if a task failed
+		"""
+		if targets is None:
+			used = set(input_name for task in self.tasks.values() for input_name in task.inputs)
+			targets = [name for name in self.tasks if name not in used]
+		keys = self.get_keys()
+		actions = self.plan(targets, keys, force)
+		threads = self.allot_threads(actions)
+		# number of executed tasks still needing the output of each task
+		consumers = dict((name, 0) for name in actions)
+		for name, action in actions.items():
+			if action == 'run':
+				for input_name in self.tasks[name].inputs:
+					consumers[input_name] += 1
+
+		outputs = {}
+		events = Queue.Queue()
+		pending = [name for name in self.tasks if name in actions]
+		nb_running = 0
+		self.timings = {}
+		while pending or nb_running:
+			for name in list(pending):
+				inputs = self.tasks[name].inputs if actions[name] == 'run' else []
+				if any(input_name not in outputs for input_name in inputs):
+					continue
+				pending.remove(name)
+				nb_running += 1
+				args = [outputs[input_name] for input_name in inputs]
+				for input_name in inputs:
+					consumers[input_name] -= 1
+					if consumers[input_name] == 0 and input_name not in targets:
+						del outputs[input_name]
+				thread = threading.Thread(target=self.execute, args=(name, keys[name],
+					actions[name], args, threads.get(name), events))
+				thread.daemon = True
+				thread.start()
+				del args
+
+			name, output, error = events.get()
+			nb_running -= 1
+			if error is not None:
+				raise Exception("Task %s failed:\n%s" % (name, error))
+			outputs[name] = output
+		return dict((name, outputs[name]) for name in targets)
+
+	def print_timings(self):
+		"""
+		Prints the action and the duration of the tasks of the last run
+		"""
+		for name in self.tasks:
+			if name in self.timings:
+				action, seconds = self.timings[name]
+				print "%-24s %-5s %8.3fs" % (name, action, seconds)
@@ -1,55 +1,420 @@
 import pandas as pd
 import numpy as np
-import xgboost as xgb
-import utils
+import os, os.path as path
+import multiprocessing
+from collections import deque
 import file_handler as fh
+import ingestion
+import model_registry
+import profiling
+import result_writer
+import prediction_cache
+from feature_store import FeatureStore
 
 """
 Script that loads the models from models folder, performs the prediction on the test
-dataset and output the result in results folder
+dataset and output the result in results folder.
+
+The test set is scored in chunks of CHUNK_SIZE rows (read from the memory-mapped cache
+when it exists): each chunk is preprocessed, scored by both models and its predictions
+are appended to the result files, so that memory usage does not depend on the size of
+the input. Chunks can be scored by a pool of N_JOBS processes. Only the columns used by
+the models are read (see feature_selection.py), and the transformed chunk is held once, as
+a float32 feature store consumed by both models without copy (see feature_store.py).
+
+The predictions of all the models are written in a single pass (see result_writer.py): one
+submission file per model, with the QuoteNumber column of the scored data, optionally
+compressed with gzip (COMPRESS_RESULTS) and with a binary sidecar of all the predictions
+(RESULTS_SIDECAR).
+
+The predictions are cached (CACHE_PREDICTIONS, see prediction_cache.py): identical rows of a
+chunk are scored once and the rows already scored by the models are not scored again. The
+cache is bound to the versions of the loaded models, and can be persisted in
+PREDICTION_CACHE_DIR (saved at the end of predict_batches) to be reused by the next runs.
+Long-lived processes (daemon of homesite.py, scoring_service.py) call reload_scorers before
+each command or batch: when a model was retrained by another process, its new version is
+loaded with a new cache. With KEEP_FEATURE_STORES (set by the daemon), the preprocessed
+feature store of a scored dataset is kept in memory, and the next predict_batches calls
+score its slices without reading and transforming the data again, until the data or the
+models change (see get_feature_store).
 """
 
-knn_features = ['PropertyField37','SalesField5','PersonalField9','Field7','PersonalField2',
-'PersonalField1','SalesField4','PersonalField10A','SalesField1B', 'PersonalField10B',
-'PersonalField12']
+# number of rows scored at once
+CHUNK_SIZE = 100000
+
+# number of processes scoring the chunks (1 to score in the main process)
+N_JOBS = 1
+
+# number of threads sharing the knn queries of a chunk
+KNN_THREADS = 1
+
+# result files, by name of the predictions
+result_files = {
+	'xgb': 'results/a_xgb_results.csv',
+	'knn': 'results/a_knn_results.csv',
+	'avg': 'results/a_avg_results.csv',
+}
+
+# indicates if the result files are compressed with gzip (.csv.gz)
+COMPRESS_RESULTS = False
+
+# directory of the binary sidecar of the predictions (columnar format, not written if None)
+RESULTS_SIDECAR = None
+
+# indicates if the predictions of the models are cached
+CACHE_PREDICTIONS = True
+
+# directory of the persisted prediction cache, relative to the root directory (kept in
+# memory only if None)
+PREDICTION_CACHE_DIR = None
+
+# indicates if the preprocessed feature stores of the scored datasets are kept in memory
+# and reused by predict_batches (set by the daemon of homesite.py)
+KEEP_FEATURE_STORES = False
+
+# preprocessing and models used by score_chunk (loaded once per process)
+scorers = None
+
+# versions of the artifacts of the loaded scorers (None if the scorers were set directly,
+# they are then never reloaded)
+scorer_versions = None
+
+# cache of the predictions of the scorers (None if the predictions are not cached)
+cache = None
+
+# feature stores kept in memory (KEEP_FEATURE_STORES): name of the dataset -> (key of the
+# data and of the models, QuoteNumber values, FeatureStore)
+feature_stores = {}
+
+
+def load_scorers():
+	"""
+	Loads the fitted preprocessing and the models of the current process, and the cache
+	of their predictions (a new cache if the versions of the models changed)
+	"""
+	global scorers, scorer_versions, cache
+	if scorers is None:
+		xgb_artifact = model_registry.get_artifact('xgb')
+		knn_artifact = model_registry.get_artifact('knn')
+		scorers = (xgb_artifact.preprocessor, xgb_artifact.model, knn_artifact.model)
+		versions = {'xgb': xgb_artifact.version, 'knn': knn_artifact.version}
+		scorer_versions = versions
+		if not CACHE_PREDICTIONS:
+			cache = None
+		elif cache is None or cache.versions != versions:
+			cache = prediction_cache.PredictionCache(versions,
+				cache_dir=path.join(fh.get_root_dir(), PREDICTION_CACHE_DIR)
+				if PREDICTION_CACHE_DIR else None)
+
+
+
+def get_latest_versions():
+	"""
+	Returns:
+		dict: name of the model -> latest version of its artifact (None if not trained)
+	"""
+	return dict((name, (model_registry.list_versions(name) or [None])[-1])
+		for name in ('xgb', 'knn'))
+
+
+
+def reload_scorers():
+	"""
+	Loads the scorers again if a new version of an artifact was saved since they were
+	loaded (e.g by a training run of another process), with a new prediction cache
+
+	Returns:
+		True if the scorers were reloaded
+	"""
+	global scorers
+	if scorers is None or scorer_versions is None:
+		return False
+	versions = get_latest_versions()
+	if versions == scorer_versions:
+		return False
+	scorers = None
+	load_scorers()
+	return True
+
+
+
+def get_input_columns():
+	"""
+	Returns:
+		list of the raw columns needed to score data (QuoteNumber and the input
+		columns of the fitted preprocessing)
+	"""
+	load_scorers()
+	return ['QuoteNumber'] + scorers[0].get_input_columns()
+
+
+
+def get_input_schema():
+	"""
+	Returns:
+		schema reading the columns encoded by the fitted preprocessing as categories,
+		so that numeric-looking categorical values of a csv file are read as strings
+		(see ingestion.get_categorical_schema)
+	"""
+	load_scorers()
+	return ingestion.get_categorical_schema(scorers[0].encoder.vocabularies.keys())
+
+
+
+@profiling.profiled()
+def score_chunk(chunk):
+	"""
+	Preprocesses a chunk of raw data and scores it with both models
+
+	Args:
+		chunk (DataFrame): raw data (with the QuoteNumber column)
+
+	Returns:
+		DataFrame with the QuoteNumber column and a column per prediction
+		(xgb, knn and their average avg)
+	"""
+	preds = pd.DataFrame({'QuoteNumber': chunk.QuoteNumber.values}, index=chunk.index)
+	for name, values in score_data(chunk).items():
+		preds[name] = values
+	return preds
+
+
+
+def score_data(data_f):
+	"""
+	Preprocesses raw data and scores it with both models
+
+	Args:
+		data_f (DataFrame): raw data
+
+	Returns:
+		dict of np.arrays: predictions of each model (xgb, knn) and their average (avg)
+	"""
+	load_scorers()
+	# features held once in a float32 buffer shared by both models (see feature_store.py)
+	return score_features(scorers[0].transform_store(data_f))
+
+
+
+def score_features(test):
+	"""
+	Scores preprocessed data with both models, through the prediction cache
+
+	Args:
+		test (FeatureStore): preprocessed data
+
+	Returns:
+		dict of np.arrays: predictions of each model (xgb, knn) and their average (avg)
+	"""
+	if cache is None:
+		preds = score_store(test)
+	else:
+		with profiling.stage('prediction_cache') as current:
+			preds = cache.predict(test, score_store)
+			current.set_shape(test)
+	return {'xgb': preds['xgb'], 'knn': preds['knn'], 'avg': (preds['knn'] + preds['xgb']) / 2}
+
+
+
+def score_store(test):
+	"""
+	Scores preprocessed data with both models
+
+	Args:
+		test (FeatureStore): preprocessed data
+
+	Returns:
+		dict of np.arrays: predictions of each model (xgb, knn)
+	"""
+	_, clf_xgb, clf_knn = scorers
+	with profiling.stage('predict_xgb') as current:
+		preds_xgb = clf_xgb.predict_proba(test)[:,1]
+		current.set_shape(test)
+	with profiling.stage('predict_knn') as current:
+		preds_knn = clf_knn.predict_proba(test, n_jobs=KNN_THREADS)[:,1]
+		current.set_shape(test)
+	return {'xgb': preds_xgb, 'knn': preds_knn}
+
+
+
+def score_chunk_counted(chunk):
+	"""
+	Scores a chunk in a scoring process (see score_chunk)
+
+	Args:
+		chunk (DataFrame): raw data (with the QuoteNumber column)
+
+	Returns:
+		DataFrame returned by score_chunk, and counters of the prediction cache of the
+		process spent on the chunk (None if the predictions are not cached)
+	"""
+	load_scorers()
+	before = cache.get_counters() if cache is not None else None
+	preds = score_chunk(chunk)
+	if before is None:
+		return preds, None
+	after = cache.get_counters()
+	return preds, dict((name, after[name] - before[name]) for name in after)
+
+
+
+def get_counted(result):
+	"""
+	Waits for a chunk scored by a scoring process and adds the counters of its prediction
+	cache to the counters of the cache of the main process
+
+	Args:
+		result (AsyncResult): result of score_chunk_counted
+
+	Returns:
+		DataFrame returned by score_chunk
+	"""
+	preds, counters = result.get()
+	if counters is not None and cache is not None:
+		cache.add_counters(counters)
+	return preds
+
+
+
+def iter_predictions(chunks, n_jobs=N_JOBS):
+	"""
+	Generator scoring the given chunks, in order. With several processes, at most
+	2 * n_jobs chunks are pending at the same time to keep memory bounded, and the
+	counters of the prediction caches of the processes are added to the counters of
+	the cache of the main process
+
+	Args:
+		chunks (iterable): chunks of raw data
+		n_jobs (int): number of processes
+
+	Returns:
+		Generator of DataFrames returned by score_chunk
+	"""
+	if n_jobs <= 1:
+		for chunk in chunks:
+			yield score_chunk(chunk)
+		return
+
+	pool = multiprocessing.Pool(n_jobs, initializer=load_scorers)
+	try:
+		pending = deque()
+		for chunk in chunks:
+			pending.append(pool.apply_async(score_chunk_counted, (chunk,)))
+			if len(pending) >= 2 * n_jobs:
+				yield get_counted(pending.popleft())
+		while pending:
+			yield get_counted(pending.popleft())
+	finally:
+		pool.terminate()
+
+
+
+def get_feature_store(tag_name, chunk_size=CHUNK_SIZE):
+	"""
+	Returns the preprocessed features of a dataset, kept in memory (see
+	KEEP_FEATURE_STORES) and built again when the data or the models changed
+
+	Args:
+		tag_name (str): base name of the data
+		chunk_size (int): number of rows transformed at once
+
+	Returns:
+		np.array of the QuoteNumber values and FeatureStore of the features
+	"""
+	load_scorers()
+	key = (fh.get_data_fingerprint(tag_name), scorer_versions)
+	if tag_name not in feature_stores or feature_stores[tag_name][0] != key:
+		# the previous matrix is released before the new one is built
+		feature_stores.pop(tag_name, None)
+		quote_numbers, parts = [], []
+		for chunk in fh.iter_data(tag_name, chunk_size, get_input_columns(),
+				schema=get_input_schema()):
+			quote_numbers.append(chunk.QuoteNumber.values)
+			parts.append(scorers[0].transform_store(chunk).matrix)
+		columns = scorers[0].get_feature_names()
+		matrix = np.concatenate(parts) if parts else np.zeros((0, len(columns)), np.float32)
+		feature_stores[tag_name] = (key, np.concatenate(quote_numbers) if quote_numbers
+			else np.zeros(0, dtype=np.int64), FeatureStore(matrix, columns))
+	return feature_stores[tag_name][1:]
+
+
+
+def iter_store_predictions(tag_name, chunk_size=CHUNK_SIZE):
+	"""
+	Generator scoring a dataset chunk by chunk, from its feature store kept in memory
+	(see get_feature_store)
+
+	Args:
+		tag_name (str): base name of the data
+		chunk_size (int): number of rows scored at once
+
+	Returns:
+		Generator of DataFrames (see score_chunk)
+	"""
+	quote_numbers, store = get_feature_store(tag_name, chunk_size)
+	for start in xrange(0, len(quote_numbers), chunk_size):
+		rows = slice(start, start + chunk_size)
+		preds = pd.DataFrame({'QuoteNumber': quote_numbers[rows]})
+		for name, values in score_features(FeatureStore(store.matrix[rows],
+				store.columns)).items():
+			preds[name] = values
+		yield preds
+
+
+
+@profiling.profiled()
+def predict_batches(tag_name='test', chunk_size=CHUNK_SIZE, n_jobs=N_JOBS,
+		compress=COMPRESS_RESULTS, sidecar_dir=RESULTS_SIDECAR, output_dir=None):
+	"""
+	Scores the given data chunk by chunk and appends the predictions to the
+	result files. With KEEP_FEATURE_STORES, the chunks are slices of the feature store
+	kept in memory (see get_feature_store), scored in the main process
+
+	Args:
+		tag_name (str): base name of the data to score
+		chunk_size (int): number of rows scored at once
+		n_jobs (int): number of processes
+		compress (bool): indicates if the result files are compressed with gzip
+		sidecar_dir (str): directory of the binary sidecar, relative to the root
+			directory (not written if None)
+		output_dir (str): directory of the result files (paths of result_files,
+			relative to the root directory, if None)
+
+	Returns:
+		number of rows scored
+	"""
+	root_dir = fh.get_root_dir()
+	if output_dir and not path.exists(output_dir):
+		os.makedirs(output_dir)
+	writer = result_writer.ResultWriter(dict((name, path.join(output_dir,
+		path.basename(file_path)) if output_dir else path.join(root_dir, file_path))
+		for name, file_path in result_files.items()), compress,
+		path.join(root_dir, sidecar_dir) if sidecar_dir else None)
+	with writer:
+		if KEEP_FEATURE_STORES:
+			predictions = iter_store_predictions(tag_name, chunk_size)
+		else:
+			predictions = iter_predictions(fh.iter_data(tag_name, chunk_size,
+				get_input_columns(), schema=get_input_schema()), n_jobs)
+		for preds in predictions:
+			with profiling.stage('write_results') as current:
+				writer.write(preds.QuoteNumber.values, dict((name, preds[name].values)
+					for name in result_files))
+				current.set_shape(len(preds.index), len(result_files))
+			print "%d rows scored" % writer.nb_rows
+	if cache is not None:
+		# with scoring processes, the counters include theirs but the rows are cached
+		# by the processes (their caches are neither kept nor saved)
+		stats = cache.get_stats()
+		in_processes = n_jobs > 1 and not KEEP_FEATURE_STORES
+		print "Prediction cache: %.1f%% hits, %.1f%% duplicates%s" % (
+			100 * stats['hit_rate'], 100 * stats['duplicate_rate'],
+			"" if in_processes else ", %d rows cached" % stats['entries'])
+		if cache.cache_dir is not None and not in_processes:
+			cache.save()
+	return writer.nb_rows
+
+
 
 if __name__ == "__main__":
-	# load data
-	train = fh.load_data('train')
-	test = fh.load_data('test')
-
-	# transform data 
-	Y_train = train.QuoteConversion_Flag.values
-	train = train.drop(['QuoteNumber', 'QuoteConversion_Flag'], axis=1)
-	test = test.drop('QuoteNumber', axis=1)
-	train = utils.transform_dates(train)
-	test = utils.transform_dates(test)
-	train = train.fillna(-1)
-	test = test.fillna(-1)
-	train, test = utils.transform_categorical_features_test_train(train, test)
-
-	# transform data for knn
-	knn_train = train.loc[:, knn_features]
-	knn_test = test.loc[:, knn_features]
-	knn_train.apply(lambda x: (x - np.min(x)) / (np.max(x) - np.min(x)))
-	knn_test.apply(lambda x: (x - np.min(x)) / (np.max(x) - np.min(x)))
-	print "Data loaded"
-
-	sample = pd.read_csv('results/sample_submission.csv')
-
-	# XGBoost
-	clf_xgb = fh.load_model('xgb')
-	preds_xgb = clf_xgb.predict_proba(test)[:,1]
-	sample.QuoteConversion_Flag = preds_xgb
-	sample.to_csv('results/a_xgb_results.csv', index=False)
-
-	# KNN
-	clf_knn = fh.load_model('knn')
-	preds_knn = clf_knn.predict_proba(knn_test)[:,1]
-	sample.QuoteConversion_Flag = preds_knn	
-	sample.to_csv('results/a_knn_results.csv', index=False)
-	
-	# Averages predictions
-	preds_avg = (preds_knn + preds_xgb) / 2
-	sample.QuoteConversion_Flag = preds_avg	
-	sample.to_csv('results/a_avg_results.csv', index=False)
+	predict_batches()
@@ -0,0 +1,266 @@
+import numpy as np
+import os, os.path as path
+import json
+import glob
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from feature_store import FeatureStore
+
+"""
+Library providing the cache of the predictions of the models, in front of the scoring of
+predict.py (see predict.score_data): quote traffic contains many identical requests
+(requotes of the same property and coverage) whose predictions are computed once.
+
+The key of a row is the sha1 of the versions of the model artifacts and of the bytes of
+the preprocessed feature row (float32 row of the feature store, with a single
+representation of the missing values and of zero), so that it is stable across processes.
+PredictionCache.predict scores a feature store:
+- identical rows of the batch are scored once (the rows are deduplicated before the lookup)
+- the predictions of the rows found in the cache are reused, the other rows are scored
+  together and added to the cache
+- the cache keeps the predictions of the last CACHE_SIZE distinct rows (LRU eviction)
+- the cache can be persisted in a directory (predictions-<key of the versions>.npy, see
+  save), and is loaded again by the next process using the same versions of the models
+The cache is bound to the versions of the models: a retrained model has a new version, for
+which a new cache is built (see predict.load_scorers), and the persisted predictions of the
+other versions are removed. get_stats returns the hit rate and latency counters.
+"""
+
+# maximum number of distinct rows kept in the cache
+CACHE_SIZE = 1000000
+
+# names of the cached predictions
+MODELS = ['xgb', 'knn']
+
+# names of the counters of a cache (see PredictionCache.get_counters)
+COUNTERS = ['nb_batches', 'nb_rows', 'nb_distinct', 'nb_scored', 'nb_evictions',
+	'lookup_seconds', 'score_seconds']
+
+
+def get_versions_key(versions):
+	"""
+	Args:
+		versions (dict): name of the model -> version of its artifact
+
+	Returns:
+		String identifying the versions
+	"""
+	return hashlib.sha1(json.dumps(versions, sort_keys=True)).hexdigest()[:16]
+
+
+
+def get_row_bytes(matrix):
+	"""
+	Returns the bytes of the rows of a feature matrix, with a single representation of the
+	missing values and of zero
+
+	Args:
+		matrix (np.array): feature matrix (n_rows, n_columns)
+
+	Returns:
+		np.array of the rows as np.void values (n_columns * 4 bytes)
+	"""
+	matrix = np.asarray(matrix, dtype=np.float32)
+	# -0. + 0. is 0.
+	matrix = np.where(np.isnan(matrix), np.float32(np.nan), matrix + np.float32(0))
+	return np.ascontiguousarray(matrix).view(np.dtype((np.void,
+		4 * matrix.shape[1]))).ravel()
+
+
+
+class PredictionCache(object):
+	"""
+	LRU cache of the predictions of the feature rows (see module documentation)
+	"""
+
+	def __init__(self, versions, max_size=CACHE_SIZE, cache_dir=None):
+		"""
+		Args:
+			versions (dict): name of the model -> version of its artifact
+			max_size (int): maximum number of distinct rows kept
+			cache_dir (str): directory where the cache is persisted (kept in memory only
+				if None). Predictions persisted for these versions are loaded
+		"""
+		self.versions = versions
+		self.max_size = max_size
+		self.cache_dir = cache_dir
+		self.prefix = get_versions_key(versions)
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.reset_stats()
+		if cache_dir is not None:
+			self.load()
+
+	def get_cache_path(self):
+		"""
+		Returns:
+			path of the persisted cache of the versions
+		"""
+		return path.join(self.cache_dir, "predictions-%s.npy" % self.prefix)
+
+	def get_keys(self, row_bytes):
+		"""
+		Args:
+			row_bytes (np.array): rows as np.void values (see get_row_bytes)
+
+		Returns:
+			list of the keys of the rows (sha1 digests)
+		"""
+		width = row_bytes.dtype.itemsize
+		data = row_bytes.tostring()
+		return [hashlib.sha1(self.prefix + data[start:start + width]).digest()
+			for start in xrange(0, len(data), width)]
+
+	def predict(self, store, score):
+		"""
+		Returns the predictions of the rows of a store, scoring only the distinct rows
+		which are not in the cache
+
+		Args:
+			store (FeatureStore): preprocessed rows
+			score (function): function scoring a FeatureStore, returning a dict of
+				np.arrays: predictions of each model (see MODELS)
+
+		Returns:
+			dict of np.arrays (float64): predictions of each model
+		"""
+		start = time.time()
+		row_bytes = get_row_bytes(store.matrix)
+		if len(row_bytes):
+			_, first, inverse = np.unique(row_bytes, return_index=True, return_inverse=True)
+		else:
+			first, inverse = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+		keys = self.get_keys(row_bytes[first])
+		values = np.empty((len(keys), len(MODELS)))
+		missing = []
+		with self.lock:
+			for i, key in enumerate(keys):
+				entry = self.entries.pop(key, None)
+				if entry is None:
+					missing.append(i)
+				else:
+					values[i] = entry
+					self.entries[key] = entry
+		lookup_seconds = time.time() - start
+
+		if missing:
+			start = time.time()
+			predictions = score(FeatureStore(store.matrix[first[missing]], store.columns))
+			for j, name in enumerate(MODELS):
+				values[missing, j] = predictions[name]
+			with self.lock:
+				for i in missing:
+					self.entries[keys[i]] = tuple(values[i])
+				evicted = max(len(self.entries) - self.max_size, 0)
+				for _ in xrange(evicted):
+					self.entries.popitem(last=False)
+				self.nb_evictions += evicted
+			score_seconds = time.time() - start
+		else:
+			score_seconds = 0.
+
+		with self.lock:
+			self.nb_batches += 1
+			self.nb_rows += len(row_bytes)
+			self.nb_distinct += len(keys)
+			self.nb_scored += len(missing)
+			self.lookup_seconds += lookup_seconds
+			self.score_seconds += score_seconds
+		return dict((name, values[inverse, j]) for j, name in enumerate(MODELS))
+
+	def save(self):
+		"""
+		Persists the cache in its directory (the persisted predictions of the other
+		versions of the models are removed)
+		"""
+		with self.lock:
+			entries = np.empty(len(self.entries), dtype=[('key', 'V20')] +
+				[(name, 'f8') for name in MODELS])
+			entries['key'] = np.array(self.entries.keys(), dtype='V20')
+			for j, name in enumerate(MODELS):
+				entries[name] = [entry[j] for entry in self.entries.itervalues()]
+		if not path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		cache_path = self.get_cache_path()
+		with open(cache_path + '.tmp', 'wb') as cache_file:
+			np.save(cache_file, entries)
+		os.rename(cache_path + '.tmp', cache_path)
+		print "Save prediction cache: %s (%d rows)" % (cache_path, len(entries))
+
+	def load(self):
+		"""
+		Loads the predictions persisted for the versions of the models, and removes the
+		persisted predictions of the other versions
+		"""
+		for other_path in glob.glob(path.join(self.cache_dir, "predictions-*.npy")):
+			if other_path != self.get_cache_path():
+				print "Remove outdated prediction cache: " + other_path
+				os.remove(other_path)
+		if not path.exists(self.get_cache_path()):
+			return
+		entries = np.load(self.get_cache_path())[-self.max_size:]
+		values = zip(*[entries[name].tolist() for name in MODELS])
+		with self.lock:
+			for key, entry in zip(entries['key'], values):
+				self.entries[key.tostring()] = entry
+
+	def clear(self):
+		"""
+		Removes all the predictions from memory
+		"""
+		with self.lock:
+			self.entries.clear()
+
+	def reset_stats(self):
+		"""
+		Resets the hit rate and latency counters
+		"""
+		self.nb_batches = 0
+		self.nb_rows = 0
+		self.nb_distinct = 0
+		self.nb_scored = 0
+		self.nb_evictions = 0
+		self.lookup_seconds = 0.
+		self.score_seconds = 0.
+
+	def get_counters(self):
+		"""
+		Returns:
+			dict of the raw counters (see COUNTERS)
+		"""
+		with self.lock:
+			return dict((name, getattr(self, name)) for name in COUNTERS)
+
+	def add_counters(self, counters):
+		"""
+		Adds the counters of another cache to the counters (e.g the counters of the cache
+		of a scoring process)
+
+		Args:
+			counters (dict): counters returned by get_counters
+		"""
+		with self.lock:
+			for name in COUNTERS:
+				setattr(self, name, getattr(self, name) + counters[name])
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict of counters: number of batches, rows, distinct rows of the batches and
+			scored rows, hit rate (ratio of rows which were not scored) and duplicate
+			rate (ratio of rows identical to another row of their batch), number of
+			rows in the cache and of evicted rows, mean time (ms) of the lookups and of
+			the scoring of the missing rows per batch
+		"""
+		with self.lock:
+			nb_batches = max(self.nb_batches, 1)
+			return {'batches': self.nb_batches, 'rows': self.nb_rows,
+				'distinct_rows': self.nb_distinct, 'scored_rows': self.nb_scored,
+				'hit_rate': 1. - 1. * self.nb_scored / self.nb_rows if self.nb_rows else 0.,
+				'duplicate_rate': 1. - 1. * self.nb_distinct / self.nb_rows
+				if self.nb_rows else 0., 'entries': len(self.entries),
+				'evictions': self.nb_evictions,
+				'lookup_ms': 1000. * self.lookup_seconds / nb_batches,
+				'score_ms': 1000. * self.score_seconds / nb_batches}
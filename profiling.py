@@ -0,0 +1,294 @@
+import os, os.path as path
+import sys
+import time
+import json
+import resource
+import threading
+import atexit
+import functools
+
+"""
+Library providing the stage-level instrumentation of the pipeline.
+
+The main stages of the scripts (loading, preprocessing, fitting, scoring, writing,...) are
+wrapped with the profiled decorator or the stage context manager:
+
+	@profiling.profiled('load_data')
+	def load_data(...):
+
+	with profiling.stage('write_results') as current:
+		...
+		current.set_shape(data_f)
+
+Each stage records its wall time, CPU time (user + system), the increase of the peak
+resident memory of the process (peak RSS delta, in MB) and the number of rows/columns it
+handled (taken from the DataFrame/array it returns or receives, or set with set_shape).
+Stages can be nested (the parent stage is recorded).
+
+Profiling is disabled by default and costs a flag test per call. It is enabled with the
+HOMESITE_PROFILE environment variable (e.g. HOMESITE_PROFILE=1 python train_models.py) or
+with enable(). A json report of the run (stages in order and totals by stage name) is then
+written in results/profiles/<script>-<date>.json when the process exits, so that runs can
+be compared over time. Stages run in the processes of a pool are not recorded.
+"""
+
+# directory of the json reports
+REPORT_DIR = path.join(path.dirname(path.abspath(__file__)), "results", "profiles")
+
+# profiling state of the process
+enabled = False
+records = []
+run_start = None
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def enable(register_report=True):
+	"""
+	Enables the profiling of the stages in the current process
+
+	Args:
+		register_report (bool): indicates if the report must be written when the
+			process exits
+	"""
+	global enabled, run_start
+	if not enabled:
+		enabled = True
+		run_start = time.time()
+		if register_report:
+			atexit.register(write_report)
+
+
+
+def disable():
+	"""
+	Disables the profiling (recorded stages are kept until reset)
+	"""
+	global enabled
+	enabled = False
+
+
+
+def reset():
+	"""
+	Removes the recorded stages
+	"""
+	global run_start
+	with _lock:
+		del records[:]
+	run_start = time.time()
+
+
+
+def get_peak_rss():
+	"""
+	Returns:
+		peak resident memory of the process in MB (ru_maxrss is in KB on Linux,
+		in bytes on OS X)
+	"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+
+def get_shape(value):
+	"""
+	Returns the number of rows and columns of a stage output (first item of a tuple)
+
+	Args:
+		value (object): DataFrame, Series, np.array or tuple
+
+	Returns:
+		tuple (rows, columns), None if value has no shape
+	"""
+	if isinstance(value, tuple) and value:
+		value = value[0]
+	shape = getattr(value, 'shape', None)
+	if not isinstance(shape, tuple) or not shape:
+		return None
+	return (int(shape[0]), int(shape[1]) if len(shape) > 1 else 1)
+
+
+
+class Stage(object):
+	"""
+	Context manager measuring a stage (see module documentation)
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.shape = None
+
+	def set_shape(self, value, nb_columns=None):
+		"""
+		Sets the number of rows and columns handled by the stage
+
+		Args:
+			value (object): DataFrame/np.array, or number of rows
+			nb_columns (int): number of columns when value is a number of rows
+		"""
+		self.shape = get_shape(value) if nb_columns is None else (int(value), int(nb_columns))
+
+	def __enter__(self):
+		stack = getattr(_local, 'stack', None)
+		if stack is None:
+			stack = _local.stack = []
+		self.parent = stack[-1].name if stack else None
+		stack.append(self)
+		self.peak_rss = get_peak_rss()
+		self.cpu = sum(os.times()[:2])
+		self.start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		wall = time.time() - self.start
+		cpu = sum(os.times()[:2]) - self.cpu
+		peak_rss = get_peak_rss()
+		_local.stack.pop()
+		record = {'name': self.name, 'parent': self.parent, 'start': self.start - run_start,
+			'wall': wall, 'cpu': cpu, 'peak_rss_delta': peak_rss - self.peak_rss,
+			'peak_rss': peak_rss, 'rows': None, 'columns': None,
+			'failed': exc_type is not None}
+		if self.shape is not None:
+			record['rows'], record['columns'] = self.shape
+		with _lock:
+			records.append(record)
+		return False
+
+
+
+class NullStage(object):
+	"""
+	Context manager used when the profiling is disabled (does nothing)
+	"""
+
+	def set_shape(self, value, nb_columns=None):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_null_stage = NullStage()
+
+
+
+def stage(name):
+	"""
+	Returns the context manager measuring a stage
+
+	Args:
+		name (str): name of the stage
+
+	Returns:
+		Stage (NullStage if the profiling is disabled)
+	"""
+	return Stage(name) if enabled else _null_stage
+
+
+
+def profiled(name=None):
+	"""
+	Decorator measuring each call of a function as a stage. The shape of the stage is
+	taken from the returned value (from the first DataFrame/2d array argument if the
+	returned value has no shape)
+
+	Args:
+		name (str): name of the stage (name of the function if None)
+
+	Returns:
+		decorator
+	"""
+	def decorator(function):
+		stage_name = name or function.__name__
+
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return function(*args, **kwargs)
+			with Stage(stage_name) as current:
+				result = function(*args, **kwargs)
+				current.set_shape(result)
+				if current.shape is None:
+					shapes = [get_shape(arg) for arg in args if getattr(arg, 'ndim', 0) == 2]
+					current.shape = shapes[0] if shapes else None
+			return result
+		return wrapper
+	return decorator
+
+
+
+def get_report():
+	"""
+	Returns the report of the run: recorded stages (in order of completion) and
+	their totals by stage name
+
+	Returns:
+		dict (json serializable)
+	"""
+	with _lock:
+		stages = list(records)
+	totals = {}
+	for record in stages:
+		total = totals.setdefault(record['name'], {'calls': 0, 'wall': 0., 'cpu': 0.,
+			'peak_rss_delta': 0., 'rows': 0})
+		total['calls'] += 1
+		total['wall'] += record['wall']
+		total['cpu'] += record['cpu']
+		total['peak_rss_delta'] += record['peak_rss_delta']
+		total['rows'] += record['rows'] or 0
+	return {'script': path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+		'argv': sys.argv[1:], 'pid': os.getpid(),
+		'date': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_start)),
+		'wall': time.time() - run_start, 'peak_rss': get_peak_rss(),
+		'stages': stages, 'totals': totals}
+
+
+
+def write_report(report_path=None):
+	"""
+	Writes the report of the run in a json file (nothing is written if no stage was
+	recorded)
+
+	Args:
+		report_path (str): path of the report (results/profiles/<script>-<date>.json
+			if None)
+
+	Returns:
+		path of the report, None if nothing was written
+	"""
+	if not records:
+		return None
+	report = get_report()
+	if report_path is None:
+		script = path.splitext(report['script'] or 'python')[0]
+		report_path = path.join(REPORT_DIR, "%s-%s-%d.json" % (script,
+			time.strftime('%Y%m%d-%H%M%S', time.localtime(run_start)), report['pid']))
+	if not path.exists(path.dirname(report_path)):
+		os.makedirs(path.dirname(report_path))
+	json.dump(report, open(report_path, 'w'), indent=1, sort_keys=True)
+	print "Generate profiling report: " + report_path
+	print_report(report)
+	return report_path
+
+
+
+def print_report(report):
+	"""
+	Prints the totals of a report, by descending wall time
+
+	Args:
+		report (dict): report returned by get_report
+	"""
+	print "%-32s %6s %9s %9s %10s %10s" % ('stage', 'calls', 'wall (s)', 'cpu (s)',
+		'rss (MB)', 'rows')
+	for name, total in sorted(report['totals'].items(), key=lambda item: -item[1]['wall']):
+		print "%-32s %6d %9.3f %9.3f %10.1f %10d" % (name, total['calls'], total['wall'],
+			total['cpu'], total['peak_rss_delta'], total['rows'])
+
+
+
+if os.environ.get('HOMESITE_PROFILE', '') not in ('', '0'):
+	enable()
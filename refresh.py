@@ -0,0 +1,133 @@
+import sys
+import xgboost as xgb
+import file_handler as fh
+import model_registry
+import profiling
+import external_memory
+import train_models
+
+"""
+Script refreshing the trained models with the new quotes, instead of training them again
+on the whole history (see train_models.py).
+
+New quotes are appended to the 'train' partitioned dataset (see file_handler.py):
+	python refresh.py data/csv/new_quotes_1.csv data/csv/new_quotes_2.csv
+appends each csv file as a partition (files already appended are skipped), then refreshes
+the latest xgb and knn artifacts with the partitions they were not trained on (the
+trained partitions are recorded in the manifests of the artifacts):
+- the encoder vocabularies are extended with the new categorical values (the codes of the
+  known values are unchanged, see CategoricalEncoder.extend)
+- the XGBoost booster continues boosting for REFRESH_ROUNDS rounds on the new partitions,
+  or on the last WINDOW partitions if WINDOW is set (sliding window)
+- the new quotes are added to the reference points of the KNN index (see
+  KNNIndex.extend): the main points of the index are shared with the previous version
+The refreshed models are saved as new versions of the artifacts, so that only the new
+partitions are read and the cost of a refresh depends on the number of new quotes.
+"""
+
+# name of the partitioned dataset of the new quotes
+DATASET = 'train'
+
+# number of boosting rounds added by a refresh
+REFRESH_ROUNDS = 10
+
+# number of last partitions the booster is refreshed on (only the new partitions if None)
+WINDOW = None
+
+
+@profiling.profiled()
+def refresh_xgb(artifact, X, y, partitions, preprocessor):
+	"""
+	Continues the boosting of the xgb model on new data and saves it as a new version
+	of the artifact
+
+	Args:
+		artifact (model_registry.ModelArtifact): latest xgb artifact
+		X (FeatureStore): transformed new data
+		y (np.array): target values
+		partitions (list): ids of the partitions the refreshed model is trained on
+		preprocessor (utils.Preprocessor): extended preprocessing
+
+	Returns:
+		version of the new artifact
+	"""
+	booster = artifact.model.booster
+	features = artifact.manifest['features']
+	booster_parameters, _ = external_memory.get_booster_parameters(
+		train_models.get_xgb_parameters())
+	data_dm = X.get_dmatrix(features, y, booster.feature_names)
+	booster = xgb.train(booster_parameters, data_dm, REFRESH_ROUNDS, xgb_model=booster)
+	return model_registry.save_artifact('xgb', booster, features,
+		artifact.manifest['parameters'], preprocessor.to_dict(),
+		artifact.manifest['data_fingerprint'], {'partitions': partitions})
+
+
+
+@profiling.profiled()
+def refresh_knn(artifact, X, y, partitions, preprocessor):
+	"""
+	Adds new data to the reference points of the knn model and saves it as a new
+	version of the artifact
+
+	Args:
+		artifact (model_registry.ModelArtifact): latest knn artifact
+		X (FeatureStore): transformed new data
+		y (np.array): target values
+		partitions (list): ids of the partitions of the reference points
+		preprocessor (utils.Preprocessor): extended preprocessing
+
+	Returns:
+		version of the new artifact
+	"""
+	index = artifact.model.extend(X, y)
+	return model_registry.save_artifact('knn', index, index.features,
+		artifact.manifest['parameters'], preprocessor.to_dict(),
+		artifact.manifest['data_fingerprint'], {'partitions': partitions})
+
+
+
+def refresh(dataset=DATASET, window=WINDOW):
+	"""
+	Refreshes the latest xgb and knn artifacts with the partitions they were not
+	trained on (see module documentation)
+
+	Args:
+		dataset (str): name of the partitioned dataset
+		window (int): number of last partitions the booster is refreshed on (only the
+			new partitions if None)
+
+	Returns:
+		list of the ids of the new partitions
+	"""
+	xgb_artifact = model_registry.load_artifact('xgb')
+	knn_artifact = model_registry.load_artifact('knn')
+	partitions = fh.list_partitions(dataset)
+	trained = knn_artifact.manifest.get('partitions', [])
+	new_partitions = [partition_id for partition_id in partitions if partition_id not in trained]
+	if not new_partitions:
+		print "No new partition to refresh the models with"
+		return []
+	print "Refresh models with partitions: " + str(new_partitions)
+
+	# only the columns of the selected features are loaded
+	preprocessor = xgb_artifact.preprocessor
+	columns = preprocessor.get_input_columns() + [preprocessor.target]
+	data_f = fh.load_partitions(dataset, new_partitions, columns)
+	preprocessor.extend(data_f)
+	X = preprocessor.transform_store(data_f)
+	refresh_knn(knn_artifact, X, X.target, trained + new_partitions, preprocessor)
+
+	if window is not None and partitions[-window:] != new_partitions:
+		# sliding window: the booster is refreshed on the last partitions
+		data_f = fh.load_partitions(dataset, partitions[-window:], columns)
+		X = preprocessor.transform_store(data_f)
+	refresh_xgb(xgb_artifact, X, X.target, trained + new_partitions, preprocessor)
+	model_registry.registry.clear()
+	return new_partitions
+
+
+
+if __name__ == "__main__":
+	for csv_path in sys.argv[1:]:
+		fh.append_csv_partition(DATASET, csv_path)
+	refresh()
@@ -0,0 +1,352 @@
+import pandas as pd
+import numpy as np
+import os, os.path as path
+import json
+import gzip
+import shutil
+import profiling
+
+"""
+Library providing the fast csv writer of the results (predict.py, stacking.py) and of the
+DataFrames saved as csv files (see file_handler.generate_csv_file).
+
+The csv lines are built with numpy instead of a formatting call per value: each field of a
+block of rows is a matrix of bytes (one row per line) and a mask of the bytes to emit.
+Integers and fixed-precision floats are written digit by digit (right-aligned, the leading
+padding being masked), the other values are formatted once per distinct value (as in
+generate_data.py) and looked up. The matrices of the fields and of the separators are
+stacked and the masked bytes, taken in row order, are the lines of the block.
+
+ResultWriter writes the predictions of any number of models in a single pass over the
+scored chunks, one submission file per model (QuoteNumber,QuoteConversion_Flag, the
+QuoteNumber column coming from the scored data):
+- probabilities are written with PRECISION decimals
+- files can be compressed with gzip (.csv.gz, COMPRESS_LEVEL)
+- the QuoteNumber and prediction columns can also be written in a binary sidecar: a
+  directory in the columnar cache format (see file_handler.read_columnar_cache), whose
+  .npy files can be memory-mapped by the downstream consumers
+Files are written under temporary names and renamed when the writer is closed, so that a
+partially written result is never read.
+"""
+
+# number of decimals of the written probabilities
+PRECISION = 6
+
+# gzip compression level of the compressed results (1: fastest)
+COMPRESS_LEVEL = 1
+
+# number of rows formatted at once
+BLOCK_ROWS = 100000
+
+# name of the file describing the columns of a sidecar (as a columnar cache)
+SIDECAR_MANIFEST = 'manifest.json'
+
+# bytes of the separators
+COMMA, NEWLINE, DOT, MINUS = [np.uint8(ord(char)) for char in ',\n.-']
+
+
+def format_integers(values):
+	"""
+	Formats integers as decimal digits
+
+	Args:
+		values (np.array): integer values
+
+	Returns:
+		np.array of bytes (n_rows, width) and np.array of booleans: mask of the bytes
+		of each value
+	"""
+	values = np.asarray(values, dtype=np.int64)
+	magnitudes = np.abs(values).astype(np.uint64)
+	width = len(str(magnitudes.max())) if len(values) else 1
+	digits = np.empty((len(values), width), dtype=np.uint8)
+	remaining = magnitudes.copy()
+	for k in xrange(width - 1, -1, -1):
+		digits[:, k] = remaining % np.uint64(10) + np.uint64(48)
+		remaining //= np.uint64(10)
+
+	# number of digits of each value (at least one, for 0)
+	lengths = np.ones(len(values), dtype=np.int64)
+	for k in xrange(1, width):
+		lengths += magnitudes >= np.uint64(10 ** k)
+	mask = np.arange(width) >= (width - lengths)[:, np.newaxis]
+
+	negative = values < 0
+	if negative.any():
+		digits = np.column_stack((np.where(negative, MINUS, COMMA).astype(np.uint8), digits))
+		mask = np.column_stack((negative, mask))
+	return digits, mask
+
+
+
+def format_floats(values, precision=PRECISION):
+	"""
+	Formats floats with a fixed number of decimals (missing values as empty fields)
+
+	Args:
+		values (np.array): float values
+		precision (int): number of decimals
+
+	Returns:
+		np.array of bytes (n_rows, width) and np.array of booleans: mask of the bytes
+		of each value
+	"""
+	values = np.asarray(values, dtype=np.float64)
+	missing = ~np.isfinite(values)
+	scale = 10 ** precision
+	finite = np.where(missing, 0., values)
+	rounded = np.round(np.abs(finite) * scale)
+	if len(values) and rounded.max() >= 2. ** 62:
+		# too large for the integer formatting
+		return format_lookup(np.where(missing, np.nan, values), precision)
+	rounded = rounded.astype(np.int64)
+
+	digits, mask = format_integers(rounded // scale)
+	if precision > 0:
+		fraction, _ = format_integers(rounded % scale + scale)
+		# the leading 1 of fraction is replaced by the dot
+		fraction[:, 0] = DOT
+		digits = np.column_stack((digits, fraction))
+		mask = np.column_stack((mask, np.ones(fraction.shape, dtype=bool)))
+
+	negative = (finite < 0) & (rounded > 0)
+	if negative.any():
+		digits = np.column_stack((np.where(negative, MINUS, COMMA).astype(np.uint8), digits))
+		mask = np.column_stack((negative, mask))
+	mask[missing] = False
+	return digits, mask
+
+
+
+def format_lookup(values, precision=None):
+	"""
+	Formats values of any type: each distinct value is formatted once (missing values
+	as empty fields, strings containing commas are quoted)
+
+	Args:
+		values (np.array): values
+		precision (int): number of decimals of the floats (repr of the floats if None)
+
+	Returns:
+		np.array of bytes (n_rows, width) and np.array of booleans: mask of the bytes
+		of each value
+	"""
+	codes, uniques = pd.factorize(values)
+	if values.dtype.kind == 'f':
+		lookup = [repr(float(value)) if precision is None else '%.*f' % (precision, value)
+			for value in uniques]
+	else:
+		lookup = [value.encode('utf-8') if isinstance(value, unicode) else str(value)
+			for value in uniques]
+		lookup = ['"%s"' % value.replace('"', '""') if ',' in value or '"' in value
+			else value for value in lookup]
+	# missing values (code -1) map to the last item of the lookup
+	width = max([len(value) for value in lookup] + [1])
+	table = np.array(lookup + [''], dtype='S%d' % width).view(np.uint8)
+	table = table.reshape((len(lookup) + 1, width))
+	lengths = np.array([len(value) for value in lookup] + [0])
+	return table[codes], (np.arange(width) < lengths[:, np.newaxis])[codes]
+
+
+
+def format_column(values, precision=None):
+	"""
+	Formats the values of a column with the fastest formatting of its type
+
+	Args:
+		values (np.array): values of the column
+		precision (int): number of decimals of the floats (repr of the floats if None)
+
+	Returns:
+		np.array of bytes (n_rows, width) and np.array of booleans: mask of the bytes
+		of each value
+	"""
+	values = np.asarray(values)
+	if values.dtype.kind in 'iu':
+		return format_integers(values)
+	if values.dtype.kind == 'f' and precision is not None:
+		return format_floats(values, precision)
+	if values.dtype.kind == 'M':
+		values = pd.Series(values).astype(str).values
+	return format_lookup(values)
+
+
+
+def join_fields(fields):
+	"""
+	Builds the csv lines of formatted fields (see module documentation)
+
+	Args:
+		fields (list): bytes and masks of the fields returned by the format functions
+
+	Returns:
+		String containing the lines
+	"""
+	nb_rows = len(fields[0][0])
+	separator = np.empty((nb_rows, 1), dtype=np.uint8)
+	separator.fill(COMMA)
+	end = np.empty((nb_rows, 1), dtype=np.uint8)
+	end.fill(NEWLINE)
+	present = np.ones((nb_rows, 1), dtype=bool)
+
+	matrices, masks = [], []
+	for i, (digits, mask) in enumerate(fields):
+		matrices += [digits, separator if i < len(fields) - 1 else end]
+		masks += [mask, present]
+	return np.hstack(matrices)[np.hstack(masks)].tostring()
+
+
+
+def open_output(file_path, compress=False):
+	"""
+	Opens a file for writing, compressed with gzip if requested
+
+	Args:
+		file_path (str): path of the file
+		compress (bool): indicates if the file is compressed
+
+	Returns:
+		file object
+	"""
+	if compress:
+		return gzip.open(file_path, 'wb', COMPRESS_LEVEL)
+	return open(file_path, 'wb')
+
+
+
+@profiling.profiled('write_csv')
+def write_csv(csv_path, data, index=True, precision=None, compress=False):
+	"""
+	Writes a DataFrame in a csv file (same content as DataFrame.to_csv)
+
+	Args:
+		csv_path (str): path of the file
+		data (DataFrame): data to write
+		index (bool): indicates if the index is written (first column)
+		precision (int): number of decimals of the floats (repr of the floats if None)
+		compress (bool): indicates if the file is compressed with gzip
+	"""
+	header = [str(col) for col in data.columns]
+	if index:
+		header.insert(0, '' if data.index.name is None else str(data.index.name))
+	tmp_path = csv_path + '.tmp'
+	with open_output(tmp_path, compress) as output:
+		output.write(','.join(header) + '\n')
+		for start in xrange(0, len(data.index), BLOCK_ROWS):
+			rows = slice(start, start + BLOCK_ROWS)
+			fields = [format_column(data.index.values[rows])] if index else []
+			fields += [format_column(np.asarray(data[col].values)[rows], precision)
+				for col in data.columns]
+			output.write(join_fields(fields))
+	os.rename(tmp_path, csv_path)
+
+
+
+class ResultWriter(object):
+	"""
+	Writer of the results of the models, in a single pass over the scored chunks (see
+	module documentation)
+	"""
+
+	def __init__(self, result_files, compress=False, sidecar_dir=None, precision=PRECISION,
+			id_column='QuoteNumber', value_column='QuoteConversion_Flag'):
+		"""
+		Args:
+			result_files (dict): name of the predictions -> path of the csv file (.gz is
+				appended if the files are compressed)
+			compress (bool): indicates if the files are compressed with gzip
+			sidecar_dir (str): directory of the binary sidecar (not written if None)
+			precision (int): number of decimals of the probabilities
+			id_column (str): name of the id column
+			value_column (str): name of the prediction column of the files
+		"""
+		self.paths = dict((name, file_path + '.gz' if compress else file_path)
+			for name, file_path in result_files.items())
+		self.names = sorted(self.paths.keys())
+		self.sidecar_dir = sidecar_dir
+		self.precision = precision
+		self.id_column = id_column
+		self.nb_rows = 0
+		self.outputs = {}
+		for name in self.names:
+			self.outputs[name] = open_output(self.paths[name] + '.tmp', compress)
+			self.outputs[name].write('%s,%s\n' % (id_column, value_column))
+		self.sidecar = None
+		if sidecar_dir is not None:
+			if path.exists(sidecar_dir + '.tmp'):
+				shutil.rmtree(sidecar_dir + '.tmp')
+			os.makedirs(sidecar_dir + '.tmp')
+			self.sidecar = [[column, None, open(path.join(sidecar_dir + '.tmp',
+				"%04d.raw" % i), 'wb')] for i, column in enumerate([id_column] + self.names)]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+		return False
+
+	def write(self, ids, predictions):
+		"""
+		Appends the predictions of a chunk to the result files
+
+		Args:
+			ids (np.array): ids of the rows (QuoteNumber)
+			predictions (dict): name of the predictions -> np.array of the probabilities
+		"""
+		id_field = format_column(ids)
+		for name in self.names:
+			self.outputs[name].write(join_fields([id_field,
+				format_floats(predictions[name], self.precision)]))
+		if self.sidecar is not None:
+			for entry, values in zip(self.sidecar, [ids] + [predictions[name]
+					for name in self.names]):
+				values = np.ascontiguousarray(values)
+				entry[1] = entry[1] or values.dtype.str
+				values.astype(entry[1], copy=False).tofile(entry[2])
+		self.nb_rows += len(ids)
+
+	def close(self):
+		"""
+		Closes the result files and renames them (the sidecar .npy files are built from
+		the appended values)
+		"""
+		for name in self.names:
+			self.outputs[name].close()
+			os.rename(self.paths[name] + '.tmp', self.paths[name])
+		if self.sidecar is None:
+			return
+
+		tmp_dir = self.sidecar_dir + '.tmp'
+		manifest = {'nrows': self.nb_rows, 'columns': [], 'index': None, 'source': None}
+		for i, (column, dtype, output) in enumerate(self.sidecar):
+			output.close()
+			raw_path = output.name
+			dtype = np.dtype(dtype or np.float64)
+			values = np.lib.format.open_memmap(path.join(tmp_dir, "%04d.npy" % i), mode='w+',
+				dtype=dtype, shape=(self.nb_rows,))
+			if self.nb_rows:
+				values[:] = np.memmap(raw_path, dtype=dtype, mode='r', shape=(self.nb_rows,))
+			del values
+			os.remove(raw_path)
+			manifest['columns'].append({'name': column, 'file': "%04d.npy" % i,
+				'kind': 'numeric', 'dtype': str(dtype)})
+		json.dump(manifest, open(path.join(tmp_dir, SIDECAR_MANIFEST), 'w'), indent=1)
+		if path.exists(self.sidecar_dir):
+			shutil.rmtree(self.sidecar_dir)
+		os.rename(tmp_dir, self.sidecar_dir)
+
+	def abort(self):
+		"""
+		Closes and removes the partially written files
+		"""
+		for name in self.names:
+			self.outputs[name].close()
+			os.remove(self.paths[name] + '.tmp')
+		if self.sidecar is not None:
+			for _, _, output in self.sidecar:
+				output.close()
+			shutil.rmtree(self.sidecar_dir + '.tmp')
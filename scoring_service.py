@@ -0,0 +1,366 @@
+import pandas as pd
+import numpy as np
+import json
+import time
+import threading
+import Queue
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+import predict
+
+"""
+Library providing a long-lived scoring service, to score quotes as they arrive.
+
+ScoringService loads the fitted preprocessing and the models once (see predict.py), then
+scores quote records (dicts of raw features, as in the csv files) and returns the blended
+probability. Concurrent requests are coalesced into micro-batches: a single thread scores
+the requests waiting in the queue together (up to max_batch_size records, waiting at most
+max_wait seconds for more requests), which amortizes the cost of the models calls. When a
+batch fails (e.g a malformed record), its requests are scored one by one, so that only the
+request containing the faulty record gets the error. The service keeps latency (p50/p99)
+and throughput counters (get_stats).
+
+serve starts a local HTTP front end:
+- POST /score with a json record, or a json list of records: returns the list of predictions
+- GET /stats: returns the counters
+ScoringClient is the matching client (e.g ScoringClient('http://localhost:8000').score(records))
+
+Example (in process):
+	service = ScoringService()
+	service.start()
+	service.score([{'Original_Quote_Date': '2014-08-12', 'Field6': 'B', ...}])
+"""
+
+# number of latencies kept to compute the percentiles
+LATENCY_WINDOW = 10000
+
+
+class ScoringRequest(object):
+	"""
+	Records to score, and their predictions once the batch containing them is scored
+	"""
+
+	def __init__(self, records):
+		self.records = records
+		self.created = time.time()
+		self.done = threading.Event()
+		self.predictions = None
+		self.error = None
+
+
+
+class ScoringService(object):
+	"""
+	In-process scoring API, with micro-batching of the concurrent requests
+	"""
+
+	def __init__(self, max_batch_size=256, max_wait=0.002, prediction='avg'):
+		"""
+		Args:
+			max_batch_size (int): maximum number of records scored at once
+			max_wait (float): maximum time (in seconds) waited for other requests
+				before scoring a batch
+			prediction (str): returned prediction (xgb, knn or avg)
+		"""
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.prediction = prediction
+		self.requests = Queue.Queue()
+		self.thread = None
+		self.stopping = False
+		self.lock = threading.Lock()
+		self.reset_stats()
+
+	def start(self):
+		"""
+		Loads the preprocessing and the models and starts the batching thread
+
+		Returns:
+			the started ScoringService
+		"""
+		predict.load_scorers()
+		self.set_columns()
+		self.stopping = False
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def set_columns(self):
+		"""
+		Sets the raw columns of the records read by the loaded preprocessing
+		"""
+		preprocessor = predict.scorers[0]
+		self.columns = preprocessor.get_input_columns()
+		self.numerical_columns = [col for col in preprocessor.input_columns
+			if col not in preprocessor.encoder.vocabularies]
+
+	def stop(self):
+		"""
+		Stops the batching thread (pending requests are scored first, new requests are
+		refused)
+		"""
+		with self.lock:
+			self.stopping = True
+			self.requests.put(None)
+		self.thread.join()
+
+	def score(self, records):
+		"""
+		Scores quote records. Blocks until the batch containing them is scored
+
+		Args:
+			records (list): list of dicts of raw features (missing features are
+				considered as missing values)
+
+		Returns:
+			list of predictions (float), in the order of the records
+		Raises:
+			Exception if the records could not be scored or if the service is stopping
+		"""
+		request = ScoringRequest(records)
+		with self.lock:
+			if self.stopping:
+				raise Exception("Scoring service stopped")
+			self.requests.put(request)
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.predictions
+
+	def score_one(self, record):
+		"""
+		Scores a single quote record
+
+		Args:
+			record (dict): raw features
+
+		Returns:
+			prediction (float)
+		"""
+		return self.score([record])[0]
+
+	def run(self):
+		"""
+		Batching loop: waits for a request, gathers the requests arriving in the
+		next max_wait seconds (up to max_batch_size records) and scores them together.
+		Once stopped, the requests left in the queue are scored
+		"""
+		stopping = False
+		while not stopping:
+			request = self.requests.get()
+			if request is None:
+				break
+			batch = [request]
+			size = len(request.records)
+			deadline = time.time() + self.max_wait
+			while size < self.max_batch_size:
+				try:
+					request = self.requests.get(timeout=max(deadline - time.time(), 0))
+				except Queue.Empty:
+					break
+				if request is None:
+					stopping = True
+					break
+				batch.append(request)
+				size += len(request.records)
+			self.score_batch(batch)
+
+		remaining = []
+		while True:
+			try:
+				request = self.requests.get_nowait()
+			except Queue.Empty:
+				break
+			if request is not None:
+				remaining.append(request)
+		if remaining:
+			self.score_batch(remaining)
+
+	def score_records(self, records):
+		"""
+		Scores quote records with the loaded models
+
+		Args:
+			records (list): list of dicts of raw features
+
+		Returns:
+			list of predictions (float), in the order of the records
+		"""
+		# models retrained since the last batch are loaded (see predict.reload_scorers)
+		if predict.reload_scorers():
+			self.set_columns()
+		data_f = pd.DataFrame.from_records(records, columns=self.columns)
+		# numerical columns made of missing values only are parsed as objects
+		for col in self.numerical_columns:
+			if data_f[col].dtype == object:
+				data_f[col] = pd.to_numeric(data_f[col], errors='coerce')
+		return predict.score_data(data_f)[self.prediction].tolist()
+
+	def score_batch(self, batch):
+		"""
+		Scores the records of several requests at once and wakes up the requests. If
+		the batch fails, its requests are scored one by one
+
+		Args:
+			batch (list): list of ScoringRequest
+		"""
+		try:
+			predictions = self.score_records([record for request in batch
+				for record in request.records])
+			offset = 0
+			for request in batch:
+				request.predictions = predictions[offset:offset + len(request.records)]
+				offset += len(request.records)
+		except Exception as e:
+			if len(batch) == 1:
+				batch[0].error = e
+			else:
+				for request in batch:
+					try:
+						request.predictions = self.score_records(request.records)
+					except Exception as e:
+						request.error = e
+
+		now = time.time()
+		with self.lock:
+			self.nb_batches += 1
+			for request in batch:
+				self.nb_requests += 1
+				self.nb_records += len(request.records)
+				self.latencies.append(now - request.created)
+		for request in batch:
+			request.done.set()
+
+	def reset_stats(self):
+		"""
+		Resets the latency and throughput counters
+		"""
+		with self.lock:
+			self.started = time.time()
+			self.nb_requests = 0
+			self.nb_records = 0
+			self.nb_batches = 0
+			self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict of counters: number of requests/records/batches, mean batch size,
+			p50/p99 latency (ms) of the last requests, throughput (records/s) and the
+			counters of the prediction cache (see PredictionCache.get_stats, None if the
+			predictions are not cached)
+		"""
+		with self.lock:
+			latencies = np.array(self.latencies) * 1000
+			elapsed = time.time() - self.started
+			stats = {'requests': self.nb_requests, 'records': self.nb_records,
+				'batches': self.nb_batches,
+				'mean_batch_size': 1. * self.nb_records / max(self.nb_batches, 1),
+				'throughput': self.nb_records / elapsed if elapsed > 0 else 0.}
+		stats['p50_ms'] = float(np.percentile(latencies, 50)) if len(latencies) else None
+		stats['p99_ms'] = float(np.percentile(latencies, 99)) if len(latencies) else None
+		stats['cache'] = predict.cache.get_stats() if predict.cache is not None else None
+		return stats
+
+
+
+class ScoringHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""
+	HTTP server handling each connection in its own thread (so that concurrent
+	requests are batched by the service)
+	"""
+	daemon_threads = True
+
+	def __init__(self, address, service):
+		BaseHTTPServer.HTTPServer.__init__(self, address, ScoringRequestHandler)
+		self.service = service
+
+
+
+class ScoringRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Handler of the HTTP front end (see module documentation)
+	"""
+
+	def do_POST(self):
+		if self.path != '/score':
+			return self.send_json(404, {'error': 'unknown path ' + self.path})
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.getheader('content-length'))))
+			records = body if isinstance(body, list) else [body]
+			predictions = self.server.service.score(records)
+		except Exception as e:
+			return self.send_json(400, {'error': str(e)})
+		self.send_json(200, predictions if isinstance(body, list) else predictions[0])
+
+	def do_GET(self):
+		if self.path != '/stats':
+			return self.send_json(404, {'error': 'unknown path ' + self.path})
+		self.send_json(200, self.server.service.get_stats())
+
+	def send_json(self, code, content):
+		body = json.dumps(content)
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+
+def serve(host='localhost', port=8000, service=None):
+	"""
+	Starts the HTTP front end (blocking)
+
+	Args:
+		host (str): address to listen on
+		port (int): port to listen on
+		service (ScoringService): started service (a new one if None)
+	"""
+	service = service or ScoringService().start()
+	server = ScoringHTTPServer((host, port), service)
+	print "Scoring service listening on http://%s:%d" % (host, port)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+
+
+class ScoringClient(object):
+	"""
+	Client of the HTTP front end
+	"""
+
+	def __init__(self, base_url='http://localhost:8000'):
+		self.base_url = base_url
+
+	def score(self, records):
+		"""
+		Args:
+			records (list or dict): list of records, or single record
+
+		Returns:
+			list of predictions, or single prediction
+		"""
+		request = urllib2.Request(self.base_url + '/score', json.dumps(records),
+			{'Content-Type': 'application/json'})
+		return json.load(urllib2.urlopen(request))
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict of the service counters
+		"""
+		return json.load(urllib2.urlopen(self.base_url + '/stats'))
+
+
+
+if __name__ == "__main__":
+	serve()
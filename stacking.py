@@ -0,0 +1,199 @@
+import numpy as np
+import os, os.path as path
+import multiprocessing
+import hashlib
+import json
+from sklearn import cross_validation, metrics
+from sklearn.linear_model import LogisticRegression
+import utils
+import file_handler as fh
+import result_writer
+import train_models
+
+"""
+Script to blend the classifiers by stacking.
+
+Each base model (the configurations of train_models.py) is trained on each fold of the
+training set: its out-of-fold predictions (predictions of each row by the model trained
+on the other folds) and its test predictions (averaged over the folds) are cached in
+data/cache/stacking, keyed by the configuration of the model and the fingerprint of the
+data. The folds of a model are trained in parallel (N_JOBS processes).
+The blender (a logistic regression) is then fitted on the cached out-of-fold predictions:
+adding or changing a model only trains this model. The base models are trained on the
+features selected by train_models.py (see feature_selection.py).
+
+The blended predictions of the test set are written in results/a_stack_results.csv and
+the blender is saved in models folder.
+"""
+
+# base models: fitting function and function returning the configuration of the model
+base_models = {
+	'xgb': (train_models.fit_xgb, train_models.get_xgb_parameters),
+	'knn': (train_models.fit_knn, train_models.get_knn_parameters),
+}
+
+# cross validation settings
+NFOLD = 5
+SEED = 1200
+
+# number of processes training the folds
+N_JOBS = multiprocessing.cpu_count()
+
+# data shared with the processes of the pool (fork)
+shared_data = None
+
+
+def get_predictions_path(model_name, key):
+	"""
+	Returns the path of the file caching the predictions of a model
+
+	Args:
+		model_name (str): name of the base model
+		key (str): hash of the configuration of the model and of the data
+
+	Returns:
+		String containing the path of the .npz file
+	"""
+	return path.join(fh.get_root_dir(), "data", "cache", "stacking", model_name+"-"+key+".npz")
+
+
+
+def get_predictions_key(model_name, data_key):
+	"""
+	Returns the key of the cached predictions of a model
+
+	Args:
+		model_name (str): name of the base model
+		data_key (str): fingerprint of the train and test data and of the features
+
+	Returns:
+		String containing the key
+	"""
+	config = base_models[model_name][1]()
+	config.pop('nthread', None)
+	content = json.dumps([model_name, config, data_key, NFOLD, SEED], sort_keys=True)
+	return hashlib.sha1(content).hexdigest()[:16]
+
+
+
+def train_fold(args):
+	"""
+	Trains a base model on a fold and predicts the held-out rows and the test set.
+	Used by the processes of the pool
+
+	Args:
+		args (tuple): name of the base model, index of the fold and number of threads
+
+	Returns:
+		index of the fold, out-of-fold predictions and test predictions
+	"""
+	model_name, fold, nthread = args
+	train, y, test, folds = shared_data
+	train_index, val_index = folds[fold]
+	clf = base_models[model_name][0](train.iloc[train_index], y[train_index], nthread)
+	return (fold, clf.predict_proba(train.iloc[val_index])[:,1],
+		clf.predict_proba(test)[:,1])
+
+
+
+def get_model_predictions(model_name, data_key, n_jobs=N_JOBS):
+	"""
+	Returns the out-of-fold and test predictions of a base model, from cache if
+	they were already computed for the same configuration and data
+
+	Args:
+		model_name (str): name of the base model
+		data_key (str): fingerprint of the train and test data
+		n_jobs (int): number of processes
+
+	Returns:
+		np.array of the out-of-fold predictions and np.array of the test predictions
+	"""
+	predictions_path = get_predictions_path(model_name, get_predictions_key(model_name, data_key))
+	if path.exists(predictions_path):
+		print "Load cached predictions: " + predictions_path
+		cached = np.load(predictions_path)
+		return cached['oof'], cached['test']
+
+	train, y, test, folds = shared_data
+	oof = np.zeros(len(y))
+	test_preds = np.zeros(len(test.index))
+	tasks = [(model_name, fold, max(1, multiprocessing.cpu_count() // n_jobs))
+		for fold in xrange(len(folds))]
+	if n_jobs > 1:
+		pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+		try:
+			results = pool.map(train_fold, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		results = [train_fold(task) for task in tasks]
+	for fold, fold_oof, fold_test in results:
+		oof[folds[fold][1]] = fold_oof
+		test_preds += fold_test / len(folds)
+
+	# evict the predictions computed with another configuration or data
+	stacking_dir = path.dirname(predictions_path)
+	if not path.exists(stacking_dir):
+		os.makedirs(stacking_dir)
+	for entry in os.listdir(stacking_dir):
+		if entry.rsplit('-', 1)[0] == model_name:
+			os.remove(path.join(stacking_dir, entry))
+	print "Generate predictions file: " + predictions_path
+	np.savez(predictions_path, oof=oof, test=test_preds)
+	return oof, test_preds
+
+
+
+def stack(model_names=None, n_jobs=N_JOBS):
+	"""
+	Computes (or loads) the predictions of the base models, fits the blender on the
+	out-of-fold predictions and writes the blended test predictions
+
+	Args:
+		model_names (list): names of the base models (all of them if None)
+		n_jobs (int): number of processes
+
+	Returns:
+		fitted blender (LogisticRegression)
+	"""
+	global shared_data
+	model_names = sorted(model_names or base_models.keys())
+	train, y, preprocessor = fh.load_derived_data('train_features', ['train'],
+		utils.prepare_train)
+	selection = train_models.get_feature_selection(train, y,
+		fh.get_derived_key(['train'], utils.prepare_train))
+	train = train.loc[:, selection['features']]
+	preprocessor = train_models.select_preprocessor(preprocessor, selection['features'])
+	raw_test = fh.load_data('test', columns=['QuoteNumber'] + preprocessor.get_input_columns())
+	test = preprocessor.transform(raw_test)
+	folds = list(cross_validation.StratifiedKFold(y, n_folds=NFOLD, shuffle=True,
+		random_state=SEED))
+	shared_data = (train, y, test, folds)
+	data_key = hashlib.sha1(json.dumps([fh.get_derived_key(['train', 'test'],
+		utils.prepare_train), selection['features']])).hexdigest()[:16]
+
+	oof = np.zeros((len(y), len(model_names)))
+	test_preds = np.zeros((len(test.index), len(model_names)))
+	for i, model_name in enumerate(model_names):
+		oof[:, i], test_preds[:, i] = get_model_predictions(model_name, data_key, n_jobs)
+		print "%s out-of-fold auc: %.5f" % (model_name, metrics.roc_auc_score(y, oof[:, i]))
+
+	blender = LogisticRegression()
+	scores = cross_validation.cross_val_score(blender, oof, y, cv=NFOLD, scoring='roc_auc')
+	print "Blender auc: %.5f (+/- %.5f)" % (scores.mean(), scores.std())
+	blender.fit(oof, y)
+	print "Blender weights: %s" % dict(zip(model_names, blender.coef_[0]))
+	fh.save_model('stacking', {'models': model_names, 'blender': blender})
+
+	with result_writer.ResultWriter({'stack': path.join(fh.get_root_dir(), 'results',
+			'a_stack_results.csv')}) as writer:
+		writer.write(raw_test.QuoteNumber.values,
+			{'stack': blender.predict_proba(test_preds)[:,1]})
+	return blender
+
+
+
+if __name__ == "__main__":
+	stack()
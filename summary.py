@@ -1,9 +1,32 @@
-import os.path as path
+import os, os.path as path
+import json
+import hashlib
+import multiprocessing
 import pandas as pd
 import numpy as np
+import matplotlib
+# headless backend: plots are rendered by the processes of a pool
+matplotlib.use('Agg')
 import seaborn as sns
 import matplotlib.pyplot as plt
 import file_handler as fh
+import data_profile
+
+"""
+Library of functions for plotting and describing the dataset's features.
+
+The plots are drawn from the counters of a single pass profile of the data (see
+data_profile.py) instead of the DataFrame: the input of each plot (its statistics) is
+small, so that the plots are rendered by a pool of N_JOBS processes (Agg backend).
+The hash of the statistics of each plot is kept in plots/<plot_type>/plots.json: a plot
+whose statistics did not change since the last run is not rendered again.
+"""
+
+# number of processes rendering the plots
+N_JOBS = multiprocessing.cpu_count()
+
+# version of the rendering functions (changing it renders all the plots again)
+PLOTS_VERSION = 1
 
 
 def get_plot_path(plot_type, column_name):
@@ -21,144 +44,246 @@ def get_plot_path(plot_type, column_name):
 	return path.join(dir_path, "plots", plot_type,  column_name+".png")
 
 
-def generate_boxplots(data_f):
+
+def get_profile(data):
 	"""
-	Generates the box plots (either count plots or histograms) for each 
-	feature of the given DataFrame. The plots are saved in plots/boxplots
+	Returns the profile of the data to plot
 
 	Args:
-		data_f (DataFrame): Pandas DataFrame to analyze
-	"""
-	# plots for numerical columns
-	data_num = data_f.select_dtypes(include=["int64"])
-	for col in data_num.columns:
-		cnt_plt = sns.distplot(data_num.loc[:,col].values)
-		cnt_plt.figure.savefig(get_plot_path("boxplots", col))
-		plt.clf()
+		data (DataFrame or DatasetProfile): Pandas DataFrame, or its profile
+			(e.g data_profile.profile_data('train'))
 
-	# plots for categorical columns
-	data_cat = data_f.select_dtypes(include=["object"])
-	for col in data_cat.columns:
-		cnt_plt = sns.countplot(x=col, data=data_cat, palette="Greens_d")
-		cnt_plt.figure.savefig(get_plot_path("boxplots", col))
-		plt.clf()
+	Returns:
+		DatasetProfile
+	"""
+	return data_profile.profile_frame(data) if isinstance(data, pd.DataFrame) else data
 
 
 
-def analyze_modes(data_f):
+def generate_boxplots(data, n_jobs=N_JOBS, force=False):
 	"""
-	Analyze for each feature of the given DataFrame what is the mode
-	and count the occurences of the mode
+	Generates the box plots (either count plots or histograms) for each 
+	feature of the given data. The plots are saved in plots/boxplots
 
 	Args:
-		data_f (DataFrame): Pandas DataFrame to analyze
+		data (DataFrame or DatasetProfile): Pandas DataFrame to analyze, or its profile
+		n_jobs (int): number of processes
+		force (bool): indicates if the unchanged plots must be rendered again
 
 	Returns:
-		dict(k,v) with k: column name
-					   v: mode of the column and occurences count of the mode
+		number of rendered plots
 	"""
-	result = {}
-	data_set_size = len(data_f.index)
-	modes = data_f.mode()
-	for col in data_f.columns:
-		mode = modes.loc[0,col]
-		mode_matching_df = data_f[data_f[col] == mode]
-		proportion_equal_mode = (1. * len(mode_matching_df.index)) / data_set_size
-		result[col] = {"mode": mode, "count": proportion_equal_mode}
-	return result
+	profile = get_profile(data)
+	jobs = []
+	for col in profile.column_names:
+		counts = profile.columns[col].counts
+		values = sorted(counts.keys())
+		# histograms for numerical columns, count plots for categorical columns
+		if values and all(isinstance(value, (int, long)) for value in values):
+			kind = 'histogram'
+		elif values and all(isinstance(value, basestring) for value in values):
+			kind = 'countplot'
+		else:
+			continue
+		jobs.append((col, {'kind': kind, 'values': values,
+			'counts': [counts[value][0] for value in values]}))
+	return render_plots("boxplots", jobs, n_jobs, force)
+
+
+
+def render_boxplot(args):
+	"""
+	Renders a box plot. Used by the processes of the pool
+
+	Args:
+		args (tuple): name of the column, statistics of the plot and path of the plot
+	"""
+	col, stats, plot_path = args
+	f, ax = plt.subplots(1)
+	if stats['kind'] == 'histogram':
+		values = np.array(stats['values'])
+		ax.hist(values, bins=min(len(values), 50), weights=stats['counts'], normed=True,
+			color=sns.color_palette()[0], alpha=0.6)
+	else:
+		sns.barplot(x=stats['values'], y=stats['counts'], palette="Greens_d", ax=ax)
+		ax.set_ylabel("count")
+	ax.set_xlabel(col)
+	f.savefig(plot_path)
+	plt.close(f)
 
 
 
-def expand_array(array, size):
+def render_plots(plot_type, jobs, n_jobs=N_JOBS, force=False):
 	"""
-	Adds 0s to the given array to make it have the given size
+	Renders the plots whose statistics changed since the last run (or whose file is
+	missing) and updates the hashes of plots/<plot_type>/plots.json
 
 	Args:
-		array (np.array): Numpy array to expand
-		size (int): new size of the array
+		plot_type (string): type of the plots (boxplots or purity)
+		jobs (list): list of (column name, statistics of the plot (json serializable))
+		n_jobs (int): number of processes
+		force (bool): indicates if the unchanged plots must be rendered again
 
 	Returns:
-		np.array of the given size based on the given array
+		number of rendered plots
 	"""
-	zeros = np.zeros(size - array.size, dtype=array.dtype)
-	return np.concatenate((array, zeros))
+	render = {"boxplots": render_boxplot, "purity": render_purity_plot}[plot_type]
+	plots_dir = path.dirname(get_plot_path(plot_type, ""))
+	hashes_path = path.join(plots_dir, "plots.json")
+	hashes = json.load(open(hashes_path, 'r')) if path.exists(hashes_path) else {}
+	if not path.exists(plots_dir):
+		os.makedirs(plots_dir)
+
+	tasks, new_hashes = [], {}
+	for col, stats in jobs:
+		new_hashes[col] = hashlib.sha1(json.dumps([PLOTS_VERSION, stats],
+			sort_keys=True)).hexdigest()
+		plot_path = get_plot_path(plot_type, col)
+		if force or hashes.get(col) != new_hashes[col] or not path.exists(plot_path):
+			tasks.append((col, stats, plot_path))
+	print "%s: %d plots to render (%d unchanged)" % (plot_type, len(tasks),
+		len(jobs) - len(tasks))
+
+	if n_jobs > 1 and len(tasks) > 1:
+		pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+		try:
+			pool.map(render, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for task in tasks:
+			render(task)
+	json.dump(new_hashes, open(hashes_path, 'w'), indent=1, sort_keys=True)
+	return len(tasks)
 
 
 
-def resize_arrays(array_1, array_2):
+def analyze_modes(data):
 	"""
-	Resize, if needed, the two given arrays so that they have the same size.
-	The potential smaller array will be expanded with zeros
+	Analyze for each feature of the given data what is the mode
+	and count the occurences of the mode. The counts come from a single pass
+	profile of the data (see data_profile.py)
 
 	Args:
-		array_1 (np.array): first array
-		array_2 (np.array): second array
+		data (DataFrame or DatasetProfile): Pandas DataFrame to analyze, or its
+			profile (e.g data_profile.profile_data('train'))
 
 	Returns:
-		array_1, array_2 with same size
+		dict(k,v) with k: column name
+					   v: mode of the column and occurences count of the mode
 	"""
-	if array_1.size == array_2.size:
-		return array_1, array_2
-	elif array_1.size < array_2.size:
-		return expand_array(array_1, array_2.size), array_2
-	else:
-		return array_1, expand_array(array_2, array_1.size)
+	profile = get_profile(data)
+	result = {}
+	for col in profile.column_names:
+		mode, proportion_equal_mode = profile.columns[col].get_mode()
+		result[col] = {"mode": mode, "count": proportion_equal_mode}
+	return result
 
 
 
-def generate_purity_plots(data_f):
+def generate_purity_plots(data, n_jobs=N_JOBS, force=False):
 	"""
-	Generates the purity plot for each feature of the given DataFrame. Purity plots
+	Generates the purity plot for each feature of the given data. Purity plots
 	present for each possible value of a given feature, the ratio of QuoteConversion_Flag
-	(target feature)
+	(target feature). The ratios come from a single pass profile of the data
+	(see data_profile.py)
 	The plots are saved in plots/purity
 
 	Args:
-		data_f (DataFrame): Pandas DataFrame to analyze
+		data (DataFrame or DatasetProfile): Pandas DataFrame to analyze, or its
+			profile (e.g data_profile.profile_data('train'))
+		n_jobs (int): number of processes
+		force (bool): indicates if the unchanged plots must be rendered again
+
+	Returns:
+		number of rendered plots
 	"""
-	data_num = data_f.select_dtypes(include=["int64"])	
-	for col in data_num.columns:
+	profile = get_profile(data)
+	jobs = []
+	for col in get_purity_columns(profile):
 		# Remove -1 occurences
-		df = data_num[data_num[col] != -1]
+		ratios = dict((value, ratio) for value, ratio
+			in profile.columns[col].get_positive_ratios().items() if value != -1)
+		values = range(int(max(ratios.keys())) + 1)
+		jobs.append((col, {'values': values,
+			'positive_ratios': [ratios[i][1] if i in ratios else None for i in values]}))
+	return render_plots("purity", jobs, n_jobs, force)
 
-		# Split on QuoteConversion_Flag value
-		df_pos = df[df["QuoteConversion_Flag"] == 1]
-		df_neg = df[df["QuoteConversion_Flag"] == 0]
 
-		# Bin counts
-		bin_cnt_pos = np.bincount(df_pos[col].values)
-		bin_cnt_neg = np.bincount(df_neg[col].values)
-		bin_cnt_pos, bin_cnt_neg = resize_arrays(bin_cnt_pos, bin_cnt_neg)
-		bin_cnt_tot = bin_cnt_pos + bin_cnt_neg
 
-		# Combine results to have percentages (purity for each possible value)
-		pos_ratios = np.true_divide(bin_cnt_pos, bin_cnt_tot)
-		neg_ratios = np.true_divide(bin_cnt_neg, bin_cnt_tot)
+def render_purity_plot(args):
+	"""
+	Renders a purity plot. Used by the processes of the pool
 
-		# Plot
-		f, ax = plt.subplots(1, figsize=(10,5))
-		bar_l = [i for i in range(len(bin_cnt_pos))]
-		ax.bar(bar_l, pos_ratios, label='Positive', color="#cc99ff", edgecolor='white')
-		ax.bar(bar_l, neg_ratios, bottom=pos_ratios, label='Negative', color="#339966", edgecolor='white')
-		plt.xticks(np.array(bar_l) + 0.4, bar_l)
-		ax.set_ylabel("Percentage")
-		plt.legend()
-		ax.figure.savefig(get_plot_path("purity", col))
-		plt.clf()
+	Args:
+		args (tuple): name of the column, statistics of the plot and path of the plot
+	"""
+	col, stats, plot_path = args
+	bar_l = stats['values']
+	pos_ratios = np.array(stats['positive_ratios'], dtype=np.float64)
+	neg_ratios = 1 - pos_ratios
 
+	# Plot
+	f, ax = plt.subplots(1, figsize=(10,5))
+	ax.bar(bar_l, pos_ratios, label='Positive', color="#cc99ff", edgecolor='white')
+	ax.bar(bar_l, neg_ratios, bottom=pos_ratios, label='Negative', color="#339966", edgecolor='white')
+	plt.xticks(np.array(bar_l) + 0.4, bar_l)
+	ax.set_ylabel("Percentage")
+	plt.legend()
+	f.savefig(plot_path)
+	plt.close(f)
 
 
-if __name__ == "__main__":
+
+def get_purity_columns(profile):
+	"""
+	Returns the columns having a purity plot: integer columns (non negative values
+	except -1) counted exactly by the profile
+
+	Args:
+		profile (DatasetProfile): profile of the data
+
+	Returns:
+		list of column names
+	"""
+	columns = []
+	for col in profile.column_names:
+		column = profile.columns[col]
+		values = [value for value in column.counts.keys() if value != -1]
+		if col != profile.target and column.exact and values and all(
+				isinstance(value, (int, long)) and value >= 0 for value in values):
+			columns.append(col)
+	return columns
+
+
+
+def summarize(tag_name='train'):
+	"""
+	Describes a dataset, renders its plots and prints the near-constant features
+
+	Args:
+		tag_name (str): base name of the data
+	"""
 	# load data
-	data_f = dh.load_data("train")
+	data_f = fh.load_data(tag_name)
 	print data_f.describe()
 
-	# generate plots (boxplots and purity plots)
-	generate_boxplots(data_f)
-	generate_purity_plots(data_f)
+	# profile the data in a single pass (counts by value of each column)
+	profile = data_profile.profile_data(tag_name)
+	print profile.summary()
+
+	# generate plots (boxplots and purity plots), only the changed ones are rendered
+	generate_boxplots(profile)
+	generate_purity_plots(profile)
 
 	# analyze for which features the mode represents more than 99% of the values
-	modes =  analyze_modes(data_f)
+	modes =  analyze_modes(profile)
 	filtered_modes = [(col, modes[col]) for col in modes.keys() if modes[col]["count"] < 0.99]
 	for f in filtered_modes:
-		print f
\ No newline at end of file
+		print f
+
+
+
+if __name__ == "__main__":
+	summarize("train")
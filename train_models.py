@@ -1,67 +1,368 @@
-import numpy as np
+import os.path as path
+import sys
 import utils
 import file_handler as fh
-from sklearn import neighbors
+import model_registry
+import profiling
+import external_memory
+import feature_selection
+import pipeline
+import feature_store
+from knn_index import KNNIndex
 import xgboost as xgb
 
 """
 Script to train the different classifiers based on the parameters
 tuning done thanks to the benchmark scripts
+
+Two training modes are available (see TRAINING_MODE):
+- memory (default): the transformed training set is loaded in memory (derived data cache)
+- external: the training set is streamed from the cache in batches bounded by
+  external_memory.BATCH_MEMORY, and XGBoost trains from its external memory mode
+  (see external_memory.py), for training sets larger than the memory
+
+Before training, the columns of the feature matrix are pruned (see feature_selection.py,
+selection computed on a sample of the training set in external mode). The selection is
+saved in parameters/features.json with the fingerprint of the training data and the
+artifacts only keep the selected features: the XGBoost classifier uses all of them, the
+KNN classifier the KNN_FEATURES first ones by gain.
+
+In memory mode, the stages are run by the scheduler of pipeline.py (see get_pipeline):
+the train and test sets are loaded concurrently, the classifiers are trained in separate
+processes sharing the cores, and a stage is only executed again when its inputs changed
+(python train_models.py --force executes all the stages). The selected features are held
+once, in a memory-mapped feature store (see feature_store.py) the training processes
+attach to.
 """
 
-def train_xgb(X_train, y):
+# number of features of the KNN classifier (most important features given by XGBoost)
+KNN_FEATURES = 11
+
+# number of neighbors of the KNN classifier
+KNN_NEIGHBORS = 50
+
+# training mode: 'memory' or 'external'
+TRAINING_MODE = 'memory'
+
+
+def get_xgb_parameters():
+	"""
+	Returns the parameters of the XGBoost classifier: the ones defined with
+	benchmark_xgb.py (parameters/xgb.json, if the search was run)
+
+	Returns:
+		dict of the parameters of XGBClassifier
+	"""
+	parameters = dict(n_estimators=25,
+                    nthread=-1,
+                    max_depth=15,
+                    learning_rate=0.025,
+                    silent=False,
+                    subsample=1,
+                    colsample_bytree=0.9)
+	if path.exists(fh.get_parameters_path('xgb')):
+		parameters.update(fh.load_parameters('xgb'))
+	return parameters
+
+
+def get_knn_parameters(selection=None):
+	"""
+	Returns the parameters of the KNN classifier (defined with benchmark_knn.py)
+
+	Args:
+		selection (dict): selection of the features (saved selection if None, see
+			get_feature_selection)
+
+	Returns:
+		dict with the number of neighbors and the features
+	"""
+	if selection is None:
+		selection = fh.load_parameters('features')
+	return {'n_neighbors': KNN_NEIGHBORS, 'features': selection['ranking'][:KNN_FEATURES]}
+
+
+def get_feature_selection(X_train, y, data_fingerprint=None, nthread=None):
+	"""
+	Returns the selection of the features of the training set (see
+	feature_selection.py). The selection is saved in parameters/features.json and
+	computed again only when the training data changed
+
+	Args:
+		X_train (pd.DataFrame) : training set (or a sample of it)
+		y (np.array) : target values
+		data_fingerprint (str) : fingerprint of the training data (the selection is
+			neither loaded nor saved if None)
+		nthread (int) : number of threads ranking the columns (parameters value if None)
+
+	Returns:
+		dict returned by feature_selection.select_features
+	"""
+	if data_fingerprint is not None and path.exists(fh.get_parameters_path('features')):
+		selection = fh.load_parameters('features')
+		if selection.get('data_fingerprint') == data_fingerprint:
+			return selection
+	parameters = get_xgb_parameters()
+	if nthread is not None:
+		parameters['nthread'] = nthread
+	selection = feature_selection.select_features(X_train, y, parameters)
+	feature_selection.print_selection(selection, X_train)
+	if data_fingerprint is not None:
+		selection['data_fingerprint'] = data_fingerprint
+		fh.save_parameters('features', selection)
+	return selection
+
+
+def select_preprocessor(preprocessor, features):
+	"""
+	Returns a copy of a fitted preprocessing restricted to the given features
+
+	Args:
+		preprocessor (utils.Preprocessor) : fitted preprocessing
+		features (list) : names of the features to keep
+
+	Returns:
+		restricted utils.Preprocessor (None if preprocessor is None)
+	"""
+	if preprocessor is None:
+		return None
+	return utils.Preprocessor.from_dict(preprocessor.to_dict()).select(features)
+
+
+@profiling.profiled()
+def fit_xgb(X_train, y, nthread=None):
+	"""
+	Fits the XGBoost classifier
+
+	Args:
+		X_train (pd.DataFrame or FeatureStore) : training set
+		y (np.array) : target values
+		nthread (int) : number of threads (parameters value if None)
+
+	Returns:
+		fitted XGBClassifier
+	"""
+	parameters = get_xgb_parameters()
+	if nthread is not None:
+		parameters['nthread'] = nthread
+	clf = xgb.XGBClassifier(**parameters)
+	if hasattr(X_train, 'get_matrix'):
+		# the DMatrix is built from the buffer of the store, without copy
+		clf.fit(X_train.get_matrix(), y, eval_metric="auc")
+		clf.get_booster().feature_names = list(X_train.columns)
+	else:
+		clf.fit(X_train, y, eval_metric="auc")
+	return clf
+
+
+@profiling.profiled()
+def fit_knn(X_train, y, nthread=None, selection=None):
+	"""
+	Fits the KNN classifier. The features are min-max normalized (see knn_index.py)
+
+	Args:
+		X_train (pd.DataFrame or FeatureStore) : training set
+		y (np.array) : target values
+		nthread (int) : unused (same signature as fit_xgb)
+		selection (dict) : selection of the features (saved selection if None)
+
+	Returns:
+		fitted KNNIndex
+	"""
+	parameters = get_knn_parameters(selection)
+	return KNNIndex(parameters['n_neighbors']).fit(X_train, y, parameters['features'])
+
+
+def train_xgb(X_train, y, preprocessor=None, data_fingerprint=None, selection=None,
+		nthread=None):
 	"""
 	Train the XGBoost classifier with the parameters defined
-	with benchmark_xgb.py
+	with benchmark_xgb.py (parameters/xgb.json, if the search was run).
+	The model is saved as a new version of the xgb artifact
 
 	Args:
-		X_train (pd.DataFrame) : training set
+		X_train (pd.DataFrame or FeatureStore) : training set (a store must hold the
+			selected features only, in order)
 		y (np.array) : target values
+		preprocessor (utils.Preprocessor) : fitted preprocessing of the training set
+		data_fingerprint (str) : fingerprint of the training data
+		selection (dict) : selection of the features (all the columns if None)
+		nthread (int) : number of threads (parameters value if None)
+
+	Returns:
+		version of the artifact
 	"""  
-	clf = xgb.XGBClassifier(n_estimators=25,
-                        	nthread=-1,
-                        	max_depth=15,
-                        	learning_rate=0.025,
-                        	silent=False,
-                        	subsample=1,
-                        	colsample_bytree=0.9)             
-	xgb_model = clf.fit(X_train, y, eval_metric="auc")
-	fh.save_model('xgb', clf)
+	features = selection['features'] if selection else list(X_train.columns)
+	preprocessor = select_preprocessor(preprocessor, features)
+	if not hasattr(X_train, 'get_matrix'):
+		X_train = X_train.loc[:, features]
+	return model_registry.save_artifact('xgb', fit_xgb(X_train, y, nthread),
+		features,
+		get_xgb_parameters(), preprocessor.to_dict() if preprocessor else None,
+		data_fingerprint, {'dropped_features': selection['dropped']} if selection else None)
 
 
-def train_knn(X_train, y):
+def train_xgb_external(tag_name='train', batch_memory=external_memory.BATCH_MEMORY,
+		schema=None):
+	"""
+	Train the XGBoost classifier out of core, from the cache of the training set
+	(see external_memory.py). The features are selected on the first rows of the
+	training set. The model is saved as a new version of the xgb artifact
+
+	Args:
+		tag_name (str) : base name of the training data
+		batch_memory (int) : memory budget of a batch of rows, in MB
+		schema (dict) : schema of the training data, shared by all the passes (see
+			file_handler.get_data_schema, read once if None)
+
+	Returns:
+		fitted utils.Preprocessor, fingerprint of the training data and selection of
+		the features
+	"""
+	if schema is None:
+		schema = fh.get_data_schema(tag_name)
+	preprocessor = external_memory.fit_preprocessor(tag_name,
+		external_memory.get_data_batch_rows(tag_name, batch_memory, schema), schema)
+	data_fingerprint = fh.get_derived_key([tag_name], utils.prepare_train)
+	sample = next(fh.iter_data(tag_name, feature_selection.SAMPLE_ROWS, schema=schema))
+	selection = get_feature_selection(preprocessor.transform(sample),
+		sample[preprocessor.target].values, data_fingerprint)
+	del sample
+
+	preprocessor.select(selection['features'])
+	booster, _, _ = external_memory.train_xgb_external(tag_name, get_xgb_parameters(),
+		batch_memory, preprocessor, schema)
+	model_registry.save_artifact('xgb', booster, preprocessor.get_feature_names(),
+		get_xgb_parameters(), preprocessor.to_dict(), data_fingerprint,
+		{'dropped_features': selection['dropped']})
+	return preprocessor, data_fingerprint, selection
+
+
+def train_knn(X_train, y, preprocessor=None, data_fingerprint=None, selection=None,
+		nthread=None):
 	"""
 	Train the KNN classifier with the parameters defined
-	with benchmark_knn.py
+	with benchmark_knn.py. The model is saved as a new version of the knn artifact
 
 	Args:
-		X_train (pd.DataFrame) : training set
+		X_train (pd.DataFrame or FeatureStore) : training set
 		y (np.array) : target values
+		preprocessor (utils.Preprocessor) : fitted preprocessing of the training set
+		data_fingerprint (str) : fingerprint of the training data
+		selection (dict) : selection of the features (saved selection if None)
+		nthread (int) : unused (same signature as train_xgb)
+
+	Returns:
+		version of the artifact
+	"""
+	parameters = get_knn_parameters(selection)
+	preprocessor = select_preprocessor(preprocessor, parameters['features'])
+	return model_registry.save_artifact('knn', fit_knn(X_train, y, selection=selection),
+		parameters['features'], parameters, preprocessor.to_dict() if preprocessor else None,
+		data_fingerprint)
+
+
+def get_pipeline(tag_name='train', test_tag_name='test'):
 	"""
-	features = ['PropertyField37','SalesField5','PersonalField9','Field7','PersonalField2',
-	'PersonalField1','SalesField4','PersonalField10A','SalesField1B', 'PersonalField10B',
-	'PersonalField12']
-	train = X_train.loc[:, features]
-	train.apply(lambda x: (x - np.min(x)) / (np.max(x) - np.min(x)))
-	clf = neighbors.KNeighborsClassifier(50)
-	clf.fit(train.values, y)
-	res = clf.predict_proba(train.values)[:,1]
-	fh.save_model('knn', clf)
+	Returns the training pipeline (see pipeline.py). Tasks:
+	- train, test: loading of the train and test sets (the test set is loaded to
+	  generate its cache, read by predict.py)
+	- train_features: preprocessing of the train set (same derived data as
+	  fh.load_derived_data('train_features', ...), shared with the other scripts)
+	- feature_selection: pruning of the columns, in a separate process (it trains
+	  xgboost, whose OpenMP threads must not exist in the process forking the
+	  trainings, see pipeline.py)
+	- feature_store: selected features written once in a memory-mapped float32 store
+	  (see feature_store.py), with the target and the fitted preprocessing
+	- xgb, knn: training of the classifiers in separate processes (the knn task takes
+	  one core, the xgb task the others), attached to the same store: outputs are the
+	  versions of the artifacts (executed again if the artifact was removed)
+
+	Args:
+		tag_name (str) : base name of the training data
+		test_tag_name (str) : base name of the test data (not loaded if it does not exist)
+
+	Returns:
+		pipeline.Pipeline
+	"""
+	data_fingerprint = fh.get_derived_key([tag_name], utils.prepare_train)
+
+	def load_train():
+		return fh.load_data(tag_name)
+
+	def load_test():
+		return len(fh.load_data(test_tag_name, columns=['QuoteNumber']).index)
+
+	def select(features, nthread=None):
+		return get_feature_selection(features[0], features[1], data_fingerprint, nthread)
+
+	def has_artifact(name):
+		return lambda version: version in model_registry.list_versions(name)
+
+	def write_store(features, selection):
+		feature_store.evict_stores(tag_name)
+		store = feature_store.FeatureStore.from_columns(features[0], selection['features'],
+			features[1], feature_store.get_store_path(tag_name, data_fingerprint,
+			selection['features']))
+		return store, features[2]
+
+	def run_xgb(store, selection, nthread=None):
+		return train_xgb(store[0], store[0].target, store[1], data_fingerprint, selection,
+			nthread)
+
+	def run_knn(store, selection, nthread=None):
+		return train_knn(store[0], store[0].target, store[1], data_fingerprint, selection,
+			nthread)
+
+	training = pipeline.Pipeline()
+	training.add('train', load_train, key_items=[fh.get_data_fingerprint(tag_name)],
+		cache=False)
+	if path.exists(fh.get_csv_path(test_tag_name)) or fh.find_cache_file(test_tag_name):
+		training.add('test', load_test, key_items=[fh.get_data_fingerprint(test_tag_name)])
+	training.add('train_features', utils.prepare_train, ['train'], key=data_fingerprint)
+	training.add('feature_selection', select, ['train_features'], cache=False,
+		process=True, threads=None)
+	training.add('feature_store', write_store, ['train_features', 'feature_selection'])
+	training.add('xgb', run_xgb, ['feature_store', 'feature_selection'],
+		key_items=[get_xgb_parameters()], process=True, threads=None,
+		valid=has_artifact('xgb'))
+	training.add('knn', run_knn, ['feature_store', 'feature_selection'],
+		key_items=[KNN_NEIGHBORS, KNN_FEATURES], process=True, threads=1,
+		valid=has_artifact('knn'))
+	return training
+
+
+def train(mode=TRAINING_MODE, force=False):
+	"""
+	Trains both classifiers on the train set and saves them as new versions of the
+	artifacts
+
+	Args:
+		mode (str) : training mode ('memory' or 'external')
+		force (bool) : indicates if the cached stages must be executed again (memory mode)
+
+	Returns:
+		dict: name of the model -> version of its artifact (memory mode)
+	"""
+	if mode == 'external':
+		# out-of-core training, only the knn features are loaded in memory
+		schema = fh.get_data_schema('train')
+		preprocessor, data_fingerprint, selection = train_xgb_external('train',
+			schema=schema)
+		knn_features = get_knn_parameters(selection)['features']
+		train, y = external_memory.load_features('train',
+			select_preprocessor(preprocessor, knn_features), knn_features, schema=schema)
+		train_knn(train, y, preprocessor, data_fingerprint, selection)
+		return None
+
+	# load and transform data, prune the columns, then train classifiers on the kept
+	# ones (only the stages whose inputs changed are executed)
+	training = get_pipeline('train', 'test')
+	versions = training.run(force=force)
+	training.print_timings()
+	print "Artifacts: xgb %d, knn %d" % (versions['xgb'], versions['knn'])
+	return versions
 
 
 
 if __name__ == "__main__":
-	# load data
-	train = fh.load_data('train')
-	test = fh.load_data('test')
-
-	# transform data
-	y = train.QuoteConversion_Flag.values
-	train = train.drop(['QuoteNumber', 'QuoteConversion_Flag'], axis=1)
-	train = utils.transform_dates(train)
-	train = train.fillna(-1)
-	train, test = utils.transform_categorical_features_test_train(train, test)
-
-	# train classifiers
-	train_xgb(train, y)
-	train_knn(train, y)
+	train(force='--force' in sys.argv[1:])
@@ -0,0 +1,348 @@
+import numpy as np
+import os, os.path as path
+import json
+import hashlib
+import ctypes
+import subprocess
+import xgboost as xgb
+import file_handler as fh
+
+"""
+Library providing the compiled form of the XGBoost models: the trees of a booster exported
+as flat arrays, evaluated without the xgboost wrapper (no DMatrix, no DataFrame conversion),
+which dominates the latency of small batches.
+
+TreeEnsemble holds the nodes of all the trees in flat arrays (the nodes of a tree are
+contiguous, in the order of their ids, roots gives the position of the root of each tree):
+- feature: index of the split feature in the feature order of the artifact (-1 for leaves)
+- threshold: float32 split condition (the row goes to the left child if value < threshold)
+- left, right, missing: children of the node (missing values go to the missing child).
+  The children of a leaf are the leaf itself, so that a node reached at any depth stays
+  on its leaf
+- value: float32 leaf values
+The margin of a row is the sum of its leaves in tree order (float32, as xgboost) plus the
+base margin of the booster, and the probability its logistic transform (binary:logistic).
+
+Two evaluators:
+- NumPy: all the rows of a batch go down all the trees at once, one level per iteration
+  (max_depth iterations of gathers)
+- C: a small kernel walking the flat arrays row by row (KERNEL_SOURCE), compiled locally
+  with the C compiler (CC environment variable, cc by default) the first time it is used
+  and cached in data/cache/trees. The NumPy evaluator is used when no compiler is available
+The export is verified against xgboost (see TreeEnsemble.verify) on probe rows built from
+the split thresholds (values at, just below and missing for each split), so that both
+branches of the splits are exercised.
+"""
+
+# maximum absolute difference with the probabilities of xgboost accepted by verify
+TOLERANCE = 1e-6
+
+# number of probe rows of verify
+VERIFY_ROWS = 2000
+
+# evaluator of the exported trees: 'c' (compiled kernel, NumPy if it cannot be built) or 'numpy'
+BACKEND = 'c'
+
+# C kernel computing the margins of a batch of rows (see module documentation)
+KERNEL_SOURCE = r"""
+#include <math.h>
+
+void predict_margin(const float *X, long n_rows, long n_cols, long n_trees,
+		const int *roots, const int *feature, const float *threshold, const int *left,
+		const int *right, const int *missing, const float *value, float base_margin,
+		float *out)
+{
+	long i, t;
+	for (i = 0; i < n_rows; i++) {
+		const float *row = X + i * n_cols;
+		float sum = 0.0f;
+		for (t = 0; t < n_trees; t++) {
+			int node = roots[t];
+			while (feature[node] >= 0) {
+				float x = row[feature[node]];
+				node = isnan(x) ? missing[node] : (x < threshold[node] ? left[node] : right[node]);
+			}
+			sum += value[node];
+		}
+		out[i] = sum + base_margin;
+	}
+}
+"""
+
+# names of the arrays of a TreeEnsemble, saved as .npy files
+ARRAYS = ['roots', 'feature', 'threshold', 'left', 'right', 'missing', 'value']
+
+# compiled kernel of the process (False if it cannot be built)
+kernel = None
+
+
+def get_kernel():
+	"""
+	Returns the compiled C kernel, building it if it is not in the cache
+
+	Returns:
+		ctypes function predict_margin (None if the kernel cannot be built)
+	"""
+	global kernel
+	if kernel is None:
+		key = hashlib.sha1(KERNEL_SOURCE).hexdigest()[:16]
+		library_path = path.join(fh.get_root_dir(), "data", "cache", "trees",
+			"kernel-%s.so" % key)
+		try:
+			if not path.exists(library_path):
+				build_kernel(library_path)
+			function = ctypes.CDLL(library_path).predict_margin
+		except (OSError, subprocess.CalledProcessError) as error:
+			print "C kernel of the trees not available, NumPy evaluator used: %s" % error
+			kernel = False
+			return None
+		# arrays are passed as addresses (contiguous arrays of the dtypes of the kernel)
+		function.argtypes = [ctypes.c_void_p] + [ctypes.c_long] * 3 + \
+			[ctypes.c_void_p] * 7 + [ctypes.c_float, ctypes.c_void_p]
+		function.restype = None
+		kernel = function
+	return kernel or None
+
+
+
+def build_kernel(library_path):
+	"""
+	Compiles KERNEL_SOURCE into a shared library (written under a temporary name, so that
+	concurrent processes do not load a partial file)
+
+	Args:
+		library_path (str): path of the shared library
+	"""
+	if not path.exists(path.dirname(library_path)):
+		os.makedirs(path.dirname(library_path))
+	tmp_path = "%s.%d.tmp" % (library_path, os.getpid())
+	source_path = tmp_path + '.c'
+	with open(source_path, 'w') as source:
+		source.write(KERNEL_SOURCE)
+	try:
+		subprocess.check_call([os.environ.get('CC', 'cc'), '-O2', '-shared', '-fPIC', '-o',
+			tmp_path, source_path, '-lm'])
+		os.rename(tmp_path, library_path)
+	finally:
+		os.remove(source_path)
+
+
+
+def get_feature_index(split, positions):
+	"""
+	Returns the index of the split feature of a dumped node
+
+	Args:
+		split (int or str): split of the node: index of the feature, its name when the
+			booster has feature names, or its default name (f<index>)
+		positions (dict): name of the feature -> index
+
+	Returns:
+		index of the feature (int)
+	"""
+	if isinstance(split, int):
+		return split
+	if split in positions:
+		return positions[split]
+	return int(split[1:])
+
+
+
+class TreeEnsemble(object):
+	"""
+	Trees of a booster in flat arrays, with NumPy and C evaluators (see module
+	documentation)
+	"""
+
+	def __init__(self, features, arrays, base_margin=0., max_depth=0):
+		"""
+		Args:
+			features (list): names of the features, in the order of the input matrix
+			arrays (dict): flat arrays of the nodes, by name (see ARRAYS)
+			base_margin (float): margin added to the sum of the leaves
+			max_depth (int): depth of the deepest leaf
+		"""
+		self.features = list(features)
+		for name in ARRAYS:
+			dtype = np.float32 if name in ('threshold', 'value') else np.int32
+			setattr(self, name, np.ascontiguousarray(arrays[name], dtype=dtype))
+		self.base_margin = np.float32(base_margin)
+		self.max_depth = max_depth
+		self.addresses = [getattr(self, name).ctypes.data for name in ARRAYS]
+
+	@classmethod
+	def from_booster(cls, booster, features):
+		"""
+		Exports the trees of a booster
+
+		Args:
+			booster (xgb.Booster): trained booster (binary:logistic objective)
+			features (list): names of the features, in the order of the training matrix
+
+		Returns:
+			TreeEnsemble
+		"""
+		positions = dict((str(col), j) for j, col in enumerate(features))
+		nodes = dict((name, []) for name in ARRAYS if name != 'roots')
+		roots = []
+		max_depth = 0
+		for dump in booster.get_dump(dump_format='json'):
+			tree = json.loads(dump)
+			tree_nodes = {}
+			stack = [(tree, 0)]
+			while stack:
+				node, depth = stack.pop()
+				tree_nodes[node['nodeid']] = (node, depth)
+				stack.extend((child, depth + 1) for child in node.get('children', []))
+			# node ids of a pruned tree are not contiguous: nodes are stored in id order
+			node_ids = sorted(tree_nodes)
+			positions_of = dict((node_id, len(nodes['value']) + i)
+				for i, node_id in enumerate(node_ids))
+			roots.append(positions_of[0])
+			for node_id in node_ids:
+				node, depth = tree_nodes[node_id]
+				if 'leaf' in node:
+					nodes['feature'].append(-1)
+					nodes['threshold'].append(0.)
+					for child in ('left', 'right', 'missing'):
+						nodes[child].append(positions_of[node_id])
+					nodes['value'].append(node['leaf'])
+					max_depth = max(max_depth, depth)
+				else:
+					nodes['feature'].append(get_feature_index(node['split'], positions))
+					nodes['threshold'].append(node['split_condition'])
+					nodes['left'].append(positions_of[node['yes']])
+					nodes['right'].append(positions_of[node['no']])
+					nodes['missing'].append(positions_of[node['missing']])
+					nodes['value'].append(0.)
+		nodes['roots'] = roots
+		ensemble = cls(features, nodes, 0., max_depth)
+
+		# base margin of the booster: margin of a row of missing values, less its leaves
+		empty = np.empty((1, len(features)), dtype=np.float32)
+		empty.fill(np.nan)
+		margin = booster.predict(xgb.DMatrix(empty, feature_names=booster.feature_names),
+			output_margin=True)[0]
+		ensemble.base_margin = np.float32(margin - ensemble.predict_margin(empty,
+			'numpy')[0])
+		return ensemble
+
+	@property
+	def n_trees(self):
+		return len(self.roots)
+
+	def predict_margin(self, X, backend=None):
+		"""
+		Computes the margins of a batch of rows
+
+		Args:
+			X (np.array): feature matrix (n_rows, n_features), columns in the order of
+				the features
+			backend (str): 'c' or 'numpy' (BACKEND if None)
+
+		Returns:
+			np.array of float32 margins
+		"""
+		X = np.ascontiguousarray(X, dtype=np.float32)
+		function = get_kernel() if (backend or BACKEND) == 'c' else None
+		if function is not None:
+			margins = np.empty(len(X), dtype=np.float32)
+			function(X.ctypes.data, len(X), X.shape[1], self.n_trees, *(self.addresses +
+				[float(self.base_margin), margins.ctypes.data]))
+			return margins
+
+		# all the rows go down all the trees, one level per iteration
+		rows = np.arange(len(X))[:, np.newaxis]
+		nodes = np.tile(self.roots, (len(X), 1))
+		for _ in xrange(self.max_depth):
+			values = X[rows, np.maximum(self.feature[nodes], 0)]
+			with np.errstate(invalid='ignore'):
+				below = values < self.threshold[nodes]
+			nodes = np.where(np.isnan(values), self.missing[nodes], np.where(below,
+				self.left[nodes], self.right[nodes]))
+		leaves = self.value[nodes]
+		# sum of the leaves in tree order, in float32 (as xgboost)
+		margins = np.zeros(len(X), dtype=np.float32)
+		for t in xrange(self.n_trees):
+			margins += leaves[:, t]
+		return margins + self.base_margin
+
+	def predict(self, X, backend=None):
+		"""
+		Args:
+			X (np.array): feature matrix (see predict_margin)
+			backend (str): 'c' or 'numpy' (BACKEND if None)
+
+		Returns:
+			np.array of the probabilities of the class 1
+		"""
+		margins = self.predict_margin(X, backend)
+		return np.float32(1) / (np.float32(1) + np.exp(-margins))
+
+	def get_probe_rows(self, nb_rows=VERIFY_ROWS, seed=0):
+		"""
+		Builds rows exercising the splits: each value is a threshold of its feature, the
+		float32 value just below it, or missing
+
+		Args:
+			nb_rows (int): number of rows
+			seed (int): seed of the random generator
+
+		Returns:
+			np.array (nb_rows, n_features) of float32
+		"""
+		random = np.random.RandomState(seed)
+		X = np.empty((nb_rows, len(self.features)), dtype=np.float32)
+		X.fill(np.nan)
+		for j in xrange(len(self.features)):
+			thresholds = np.unique(self.threshold[self.feature == j])
+			if not len(thresholds):
+				continue
+			candidates = np.concatenate((thresholds, np.nextafter(thresholds,
+				np.float32(-np.inf)), [np.nan])).astype(np.float32)
+			X[:, j] = candidates[random.randint(len(candidates), size=nb_rows)]
+		return X
+
+	def verify(self, booster, X=None):
+		"""
+		Compares the probabilities of the evaluators with the ones of xgboost
+
+		Args:
+			booster (xgb.Booster): booster the trees were exported from
+			X (np.array): feature matrix (probe rows if None, see get_probe_rows)
+
+		Returns:
+			maximum absolute difference of the probabilities (of both evaluators)
+		"""
+		X = self.get_probe_rows() if X is None else np.asarray(X, dtype=np.float32)
+		expected = booster.predict(xgb.DMatrix(X, feature_names=booster.feature_names))
+		return max(float(np.abs(self.predict(X, backend) - expected).max()) if len(X) else 0.
+			for backend in ('numpy', 'c'))
+
+	def save_dir(self, trees_dir):
+		"""
+		Saves the arrays in the given directory
+
+		Args:
+			trees_dir (str): path of the directory (created)
+		"""
+		os.makedirs(trees_dir)
+		for name in ARRAYS:
+			np.save(path.join(trees_dir, name + '.npy'), getattr(self, name))
+		json.dump({'features': self.features, 'base_margin': float(self.base_margin),
+			'max_depth': self.max_depth}, open(path.join(trees_dir, 'trees.json'), 'w'))
+
+	@classmethod
+	def load_dir(cls, trees_dir):
+		"""
+		Loads the arrays saved in the given directory
+
+		Args:
+			trees_dir (str): path of the directory
+
+		Returns:
+			TreeEnsemble
+		"""
+		meta = json.load(open(path.join(trees_dir, 'trees.json'), 'r'))
+		arrays = dict((name, np.load(path.join(trees_dir, name + '.npy'))) for name in ARRAYS)
+		return cls(meta['features'], arrays, meta['base_margin'], meta['max_depth'])
@@ -1,12 +1,26 @@
 from sklearn import preprocessing
 import pandas as pd
+import numpy as np
+import ingestion
+import profiling
+from feature_store import FeatureStore
 
 """
 Library of utility function to tranform DataFrames (columns and values
 manipulations)
+
+The Preprocessor class is the transformation chain used by all the scripts: it is fitted
+once (train time), serialized with the models and applied identically at predict time.
+The functions transform_dates, transform_categorical_features_* are the original,
+step by step, implementation of this chain (kept as reference, see benchmark_perf.py).
 """
 
+# features extracted from the date column by the Preprocessor (in the order of
+# extract_date_parts)
+DATE_FEATURES = ['Year', 'Month', 'weekday']
+
 
+@profiling.profiled()
 def transform_dates(data_f):
     """
     Transform the date feature into 3 useful new features: Year, Month, weekday 
@@ -26,6 +40,41 @@ def transform_dates(data_f):
     return data_f
 
 
+def get_categorical_columns(data_f):
+    """
+    Returns the names of the categorical features (object or category dtype)
+
+    Args:
+        data_f (DataFrame): input Pandas DataFrame
+
+    Returns:
+        list of column names
+    """
+    return [col for col in data_f.columns
+            if data_f[col].dtype == 'object' or str(data_f[col].dtype) == 'category']
+
+
+@profiling.profiled()
+def fill_missing(data_f, value=-1):
+    """
+    Replaces the missing values by the given value. The value is added to the
+    categories of the category columns that contain missing values
+
+    Args:
+        data_f (DataFrame): input Pandas DataFrame
+        value (object): value replacing the missing values
+
+    Returns:
+        transformed DataFrame
+    """
+    for col in data_f.columns:
+        if str(data_f[col].dtype) == 'category' and data_f[col].isnull().any() \
+                and value not in data_f[col].cat.categories:
+            data_f[col] = data_f[col].cat.add_categories([value])
+    return data_f.fillna(value)
+
+
+@profiling.profiled()
 def transform_categorical_features_test_train(data_f_test, data_f_train):
     """
     Transforms categorical features into ints using the LabelEncoder from
@@ -37,7 +86,7 @@ def transform_categorical_features_test_train(data_f_test, data_f_train):
     Returns:
         transformed DataFrame
     """
-    categorical_columns = [col for col in data_f_test.columns if data_f_test[col].dtype=='object']
+    categorical_columns = get_categorical_columns(data_f_test)
     for col in categorical_columns:
         lbl = preprocessing.LabelEncoder()
         lbl.fit(list(data_f_test[col].values) + list(data_f_train[col].values))
@@ -46,6 +95,7 @@ def transform_categorical_features_test_train(data_f_test, data_f_train):
     return data_f_test, data_f_train
 
 
+@profiling.profiled()
 def transform_categorical_features_train(data_f):
     """
     Transforms categorical features into ints using the LabelEncoder from
@@ -57,9 +107,466 @@ def transform_categorical_features_train(data_f):
     Returns:
         transformed DataFrame
     """
-    categorical_columns = [col for col in data_f.columns if data_f[col].dtype=='object']
+    categorical_columns = get_categorical_columns(data_f)
     for col in categorical_columns:
         lbl = preprocessing.LabelEncoder()
         lbl.fit(list(data_f[col].values))
         data_f[col] = lbl.transform(list(data_f[col].values))
     return data_f
+
+
+class Preprocessor(object):
+    """
+    Transformation chain of the raw data into the feature matrix given to the
+    classifiers:
+    - drop of the id and target columns
+    - date column replaced by Year, Month and weekday features (appended at the end)
+    - missing values of numerical columns set to fill_value
+    - categorical columns encoded as ints by a CategoricalEncoder (missing values are
+      set to fill_value, values unseen at fit time to CategoricalEncoder.unseen_value)
+    The output can be restricted to the features kept by feature_selection.py (select):
+    the other columns are then neither read nor encoded.
+
+    All the steps are vectorized, and the output DataFrame is built once from the
+    transformed columns (no intermediate copies of the whole frame).
+    """
+
+    def __init__(self, drop_columns=('QuoteNumber',), target='QuoteConversion_Flag',
+                 date_column='Original_Quote_Date', fill_value=-1):
+        self.drop_columns = list(drop_columns)
+        self.target = target
+        self.date_column = date_column
+        self.fill_value = fill_value
+        self.input_columns = None
+        self.date_features = list(DATE_FEATURES)
+        self.encoder = CategoricalEncoder(missing_value=fill_value)
+
+    @profiling.profiled('preprocessor.fit')
+    def fit(self, data_f):
+        """
+        Learns the input columns and the vocabularies of the categorical features
+
+        Args:
+            data_f (DataFrame): train set
+
+        Returns:
+            the fitted Preprocessor
+        """
+        excluded = set(self.drop_columns + [self.target, self.date_column])
+        self.input_columns = [col for col in data_f.columns if col not in excluded]
+        categorical_columns = [col for col in get_categorical_columns(data_f)
+                               if col not in excluded]
+        self.encoder.fit(data_f, categorical_columns)
+        return self
+
+    def partial_fit(self, data_f):
+        """
+        Learns the input columns and the vocabularies from a chunk of the train set:
+        fitting on the successive chunks gives the same state as fitting on the whole
+        train set, without loading it in memory
+
+        Args:
+            data_f (DataFrame): chunk of the train set
+
+        Returns:
+            the fitted Preprocessor
+        """
+        if self.input_columns is None:
+            return self.fit(data_f)
+        self.encoder.partial_fit(data_f, list(self.encoder.vocabularies.keys()))
+        return self
+
+    def extend(self, data_f):
+        """
+        Adds the categorical values of new data to the vocabularies, keeping the
+        codes of the known values (so that a model trained on the previous data stays
+        valid, see refresh.py)
+
+        Args:
+            data_f (DataFrame): new data
+
+        Returns:
+            the extended Preprocessor
+        """
+        self.encoder.extend(data_f)
+        return self
+
+    def select(self, features):
+        """
+        Restricts the output features to the given ones (see feature_selection.py)
+
+        Args:
+            features (list): names of the output features to keep
+
+        Returns:
+            the restricted Preprocessor
+        """
+        features = set(features)
+        self.input_columns = [col for col in self.input_columns if col in features]
+        self.date_features = [name for name in self.date_features if name in features]
+        # new dicts: the state of the encoder may be shared with other instances
+        self.encoder.vocabularies = dict((col, vocabulary) for col, vocabulary
+                                         in self.encoder.vocabularies.items()
+                                         if col in features)
+        self.encoder._indexes = dict((col, index) for col, index
+                                     in self.encoder._indexes.items() if col in features)
+        return self
+
+    def get_input_columns(self):
+        """
+        Returns:
+            list of the raw columns read by transform
+        """
+        if self.date_features:
+            return self.input_columns + [self.date_column]
+        return list(self.input_columns)
+
+    @profiling.profiled('preprocessor.transform')
+    def transform_columns(self, data_f):
+        """
+        Transforms raw data into the columns of the feature matrix
+
+        Args:
+            data_f (DataFrame): raw data (with the same columns as the train set,
+                the target being optional)
+
+        Returns:
+            dict: name of the feature -> np.array of its values
+        """
+        columns = {}
+        with profiling.stage('preprocessor.encode_categorical') as current:
+            for col in self.input_columns:
+                if col in self.encoder.vocabularies:
+                    columns[col] = self.encoder.transform_column(data_f[col], col)
+            current.set_shape(len(data_f.index), len(columns))
+
+        with profiling.stage('preprocessor.fill_numerical') as current:
+            for col in self.input_columns:
+                if col not in self.encoder.vocabularies:
+                    columns[col] = self.fill_numerical(data_f[col].values)
+            current.set_shape(len(data_f.index),
+                              len(self.input_columns) - len(self.encoder.vocabularies))
+
+        if self.date_features:
+            with profiling.stage('preprocessor.date_parts') as current:
+                parts = dict(zip(DATE_FEATURES, extract_date_parts(data_f[self.date_column])))
+                for name in self.date_features:
+                    columns[name] = np.where(parts[name] < 0, self.fill_value,
+                                             parts[name]).astype(np.int16)
+                current.set_shape(len(data_f.index), len(self.date_features))
+
+        return columns
+
+    def transform(self, data_f):
+        """
+        Transforms raw data into the feature matrix
+
+        Args:
+            data_f (DataFrame): raw data (with the same columns as the train set,
+                the target being optional)
+
+        Returns:
+            transformed DataFrame
+        """
+        return pd.DataFrame(self.transform_columns(data_f), index=data_f.index,
+                            columns=self.get_feature_names())
+
+    def transform_store(self, data_f, store_dir=None):
+        """
+        Transforms raw data into a feature store: the columns are copied once into
+        its float32 buffer (see feature_store.py)
+
+        Args:
+            data_f (DataFrame): raw data (the target is stored with the features if
+                it is a column of data_f)
+            store_dir (str): directory where the store is written (kept in memory if
+                None)
+
+        Returns:
+            feature_store.FeatureStore
+        """
+        target = data_f[self.target].values if self.target in data_f.columns else None
+        return FeatureStore.from_columns(self.transform_columns(data_f),
+                                         self.get_feature_names(), target, store_dir)
+
+    def fit_transform(self, data_f):
+        """
+        Fits the Preprocessor and transforms data_f
+
+        Args:
+            data_f (DataFrame): train set
+
+        Returns:
+            transformed DataFrame
+        """
+        return self.fit(data_f).transform(data_f)
+
+    def get_feature_names(self):
+        """
+        Returns:
+            list of the names of the output features, in order
+        """
+        return self.input_columns + self.date_features
+
+    def fill_numerical(self, values):
+        """
+        Replaces the missing values of a numerical column (copy only if needed)
+
+        Args:
+            values (np.array): values of the column
+
+        Returns:
+            np.array without missing values
+        """
+        if values.dtype.kind == 'f':
+            mask = np.isnan(values)
+            if mask.any():
+                values = values.copy()
+                values[mask] = self.fill_value
+        return values
+
+    def to_dict(self):
+        """
+        Returns:
+            dict containing the fitted state (json serializable)
+        """
+        return {'drop_columns': self.drop_columns, 'target': self.target,
+                'date_column': self.date_column, 'fill_value': self.fill_value,
+                'input_columns': self.input_columns, 'date_features': self.date_features,
+                'encoder': self.encoder.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Builds a fitted Preprocessor from the state returned by to_dict
+
+        Args:
+            state (dict): fitted state
+
+        Returns:
+            Preprocessor
+        """
+        # column names are str, as in the DataFrames read from the csv files (json
+        # gives unicode strings)
+        preprocessor = cls([str(col) for col in state['drop_columns']], str(state['target']),
+                           str(state['date_column']), state['fill_value'])
+        preprocessor.input_columns = [str(col) for col in state['input_columns']]
+        preprocessor.date_features = [str(name) for name
+                                      in state.get('date_features', DATE_FEATURES)]
+        preprocessor.encoder = CategoricalEncoder.from_dict(state['encoder'])
+        return preprocessor
+
+
+class CategoricalEncoder(object):
+    """
+    Encodes categorical columns as ints, using for each column a vocabulary (sorted
+    distinct values seen by fit, then the values added by extend): a value is encoded
+    by its position in the vocabulary, found with a hash table lookup (pd.Index).
+    Missing values are encoded as missing_value and values which are not in the
+    vocabulary as unseen_value. The vocabularies are json serializable (to_dict), so
+    that they are saved with the models and new data can be encoded without reloading
+    the train set.
+    """
+
+    def __init__(self, missing_value=-1, unseen_value=-2):
+        self.missing_value = missing_value
+        self.unseen_value = unseen_value
+        self.vocabularies = {}
+        self._indexes = {}
+
+    def fit(self, data_f, columns=None):
+        """
+        Learns the vocabularies of the given columns
+
+        Args:
+            data_f (DataFrame): train set
+            columns (list): names of the columns to encode (all the categorical
+                columns if None)
+
+        Returns:
+            the fitted CategoricalEncoder
+        """
+        if columns is None:
+            columns = get_categorical_columns(data_f)
+        self.vocabularies = dict((col, sorted(get_distinct_values(data_f[col])))
+                                 for col in columns)
+        self._indexes = {}
+        return self
+
+    def partial_fit(self, data_f, columns=None):
+        """
+        Adds the values of a chunk of the train set to the vocabularies
+
+        Args:
+            data_f (DataFrame): chunk of the train set
+            columns (list): names of the columns to encode (all the categorical
+                columns if None)
+
+        Returns:
+            the fitted CategoricalEncoder
+        """
+        if columns is None:
+            columns = get_categorical_columns(data_f)
+        for col in columns:
+            values = set(self.vocabularies.get(col, []))
+            values.update(get_distinct_values(data_f[col]))
+            self.vocabularies[col] = sorted(values)
+        self._indexes = {}
+        return self
+
+    def extend(self, data_f):
+        """
+        Appends the values of data_f which are not in the vocabularies at their end,
+        so that the codes of the known values are unchanged (unlike partial_fit)
+
+        Args:
+            data_f (DataFrame): new data
+
+        Returns:
+            the extended CategoricalEncoder
+        """
+        for col in self.vocabularies:
+            if col not in data_f.columns:
+                continue
+            known = self.get_index(col)
+            new_values = [value for value in get_distinct_values(data_f[col])
+                          if value not in known]
+            if new_values:
+                self.vocabularies[col] = list(self.vocabularies[col]) + sorted(new_values)
+                self._indexes.pop(col)
+        return self
+
+    def get_index(self, col):
+        """
+        Returns the hash table (pd.Index) of the vocabulary of a column, built once
+
+        Args:
+            col (str): name of the column
+
+        Returns:
+            pd.Index
+        """
+        if col not in self._indexes:
+            self._indexes[col] = pd.Index(self.vocabularies[col])
+        return self._indexes[col]
+
+    def transform_column(self, series, col):
+        """
+        Encodes a column with its vocabulary
+
+        Args:
+            series (pd.Series): values of the column (object or category dtype)
+            col (str): name of the column
+
+        Returns:
+            np.array of codes
+        """
+        vocabulary = self.get_index(col)
+        dtype = ingestion.get_int_dtype(min(self.missing_value, self.unseen_value, 0),
+                                        max(self.missing_value, self.unseen_value,
+                                            len(vocabulary)))
+        if str(series.dtype) == 'category':
+            # only the categories are looked up, the codes are then remapped
+            lookup = vocabulary.get_indexer(series.cat.categories)
+            lookup[lookup == -1] = self.unseen_value
+            lookup = np.append(lookup, self.missing_value).astype(dtype)
+            return lookup[series.cat.codes.values]
+
+        codes = vocabulary.get_indexer(series.values).astype(dtype)
+        codes[codes == -1] = self.unseen_value
+        codes[pd.isnull(series.values)] = self.missing_value
+        return codes
+
+    def transform(self, data_f):
+        """
+        Encodes the fitted columns of a DataFrame
+
+        Args:
+            data_f (DataFrame): input Pandas DataFrame
+
+        Returns:
+            transformed DataFrame
+        """
+        for col in self.vocabularies:
+            data_f[col] = self.transform_column(data_f[col], col)
+        return data_f
+
+    def to_dict(self):
+        """
+        Returns:
+            dict containing the vocabularies and codes (json serializable)
+        """
+        return {'missing_value': self.missing_value, 'unseen_value': self.unseen_value,
+                'vocabularies': self.vocabularies}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Builds a fitted CategoricalEncoder from the state returned by to_dict
+
+        Args:
+            state (dict): fitted state
+
+        Returns:
+            CategoricalEncoder
+        """
+        encoder = cls(state['missing_value'], state['unseen_value'])
+        encoder.vocabularies = state['vocabularies']
+        return encoder
+
+
+def get_distinct_values(series):
+    """
+    Returns the distinct non missing values of a column
+
+    Args:
+        series (pd.Series): values of the column (object or category dtype)
+
+    Returns:
+        list of values
+    """
+    if str(series.dtype) == 'category':
+        used = np.unique(series.cat.codes.values)
+        return series.cat.categories[used[used >= 0]].tolist()
+    return pd.unique(series.dropna().values).tolist()
+
+
+def extract_date_parts(series):
+    """
+    Vectorized extraction of the year, month and weekday of a date column. Only the
+    distinct dates are parsed
+
+    Args:
+        series (pd.Series): dates as strings (object or category dtype)
+
+    Returns:
+        3 np.arrays: year, month and weekday (-1 for missing dates)
+    """
+    if str(series.dtype) == 'category':
+        codes, uniques = series.cat.codes.values, series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series.values)
+    dates = pd.DatetimeIndex(pd.to_datetime(uniques))
+    parts = []
+    for values in (dates.year, dates.month, dates.dayofweek):
+        # missing dates (code -1) map to the last item of the lookup
+        lookup = np.append(np.asarray(values, dtype=np.int16), -1)
+        parts.append(lookup[codes])
+    return parts
+
+
+def prepare_train(data_f):
+    """
+    Fits the Preprocessor on the train set and transforms it.
+    Meant to be used with file_handler.load_derived_data, so that the output is
+    shared by the scripts
+
+    Args:
+        data_f (DataFrame): train set
+
+    Returns:
+        transformed train set, target values and the fitted Preprocessor
+    """
+    preprocessor = Preprocessor()
+    return (preprocessor.fit_transform(data_f), data_f[preprocessor.target].values,
+            preprocessor)